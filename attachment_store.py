@@ -0,0 +1,160 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+# Constants
+BLOBS_FOLDER_PATH = "blobs"
+INDEX_FILE_NAME = "index.json"
+REFERENCES_FILE_NAME = "attachments.json"
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+def iter_base64_field(chunks, field="data"):
+    """Decodes a base64url string field of a streamed JSON response chunk by chunk.
+
+    Only the undecoded tail of the current chunk is kept in memory, so the peak
+    usage is bounded by the chunk size whatever the size of the attachment.
+    """
+    marker = f'"{field}"'.encode("ASCII")
+    header = b""
+    pending = b""
+    in_field = False
+
+    for chunk in chunks:
+        if not in_field:
+            header += chunk
+            start = header.find(marker)
+            if start == -1:
+                continue
+            # Skip the colon and the opening quote of the value
+            quote = header.find(b'"', start + len(marker))
+            if quote == -1:
+                continue
+            chunk = header[quote + 1 :]
+            header = b""
+            in_field = True
+
+        end = chunk.find(b'"')
+        if end != -1:
+            chunk = chunk[:end]
+        pending += chunk
+        usable = len(pending) - len(pending) % 4
+        if usable:
+            yield base64.urlsafe_b64decode(pending[:usable])
+            pending = pending[usable:]
+        if end != -1:
+            break
+
+    if not in_field:
+        raise ValueError(f"Field {field} not found in the response.")
+    if pending:
+        yield base64.urlsafe_b64decode(pending + b"=" * (-len(pending) % 4))
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AttachmentStore:
+    """Content-addressed store holding every attachment once, keyed by SHA-256."""
+
+    def __init__(self, root=BLOBS_FOLDER_PATH):
+        self.root = root
+        self.index_path = os.path.join(root, INDEX_FILE_NAME)
+        self.lock = threading.Lock()
+        self.index = {"attachments": {}, "blobs": {}}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        with self.lock:
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.index, f, indent=4)
+            os.replace(tmp_path, self.index_path)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def lookup(self, attachment_id):
+        """Returns the hash of an already stored attachment, or None."""
+        with self.lock:
+            sha256 = self.index["attachments"].get(attachment_id)
+        if sha256 and os.path.exists(self.blob_path(sha256)):
+            return sha256
+        return None
+
+    def put(self, data, attachment_id=None, filename=None):
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self.register(sha256, len(data), attachment_id, filename)
+        return sha256
+
+    def put_stream(self, chunks, attachment_id=None, filename=None):
+        """Writes decoded chunks to a temporary file and renames it into the store."""
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.root, f"download.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            sha256 = digest.hexdigest()
+            path = self.blob_path(sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.register(sha256, size, attachment_id, filename)
+        return sha256
+
+    def register(self, sha256, size, attachment_id=None, filename=None):
+        with self.lock:
+            self.index["blobs"].setdefault(sha256, {"size": size, "filename": filename})
+            if attachment_id:
+                self.index["attachments"][attachment_id] = sha256
+
+    def link(self, sha256, folder_name, filename):
+        """Places a reference to the blob in an email folder under its filename."""
+        path = os.path.join(folder_name, filename)
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            # Hard links keep the folder layout the OCR scripts expect at no disk cost
+            os.link(self.blob_path(sha256), path)
+        except OSError:
+            shutil.copyfile(self.blob_path(sha256), path)
+
+        references = load_references(folder_name)
+        references[filename] = sha256
+        with open(os.path.join(folder_name, REFERENCES_FILE_NAME), "w") as f:
+            json.dump(references, f, indent=4)
+        return path
+
+
+def load_references(folder_name):
+    """Returns the filename -> SHA-256 map of the attachments in an email folder."""
+    references_file = os.path.join(folder_name, REFERENCES_FILE_NAME)
+    if os.path.exists(references_file):
+        with open(references_file, "r") as f:
+            return json.load(f)
+    return {}
@@ -0,0 +1,237 @@
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the OpenAI files and batches endpoints, for testing the
+# --batch mode without spending anything:
+#   python batch_stub_server.py --port 8001 --delay 5
+#   OPENAI_BASE_URL=http://localhost:8001/v1 python json_preprocessing.py --batch
+# benchmarks/check_batch_runner.py runs BatchRunner against it and checks the answers.
+
+DEFAULT_PORT = 8001
+STUB_TTL = "@prefix ex: <http://example.org/> .\n\nex:{name} a ex:Document .\n"
+# Requests whose last message contains it end up in the error file
+FAILURE_MARKER = "STUB_FAILURE"
+
+files = {}
+batches = {}
+lock = threading.Lock()
+
+
+def new_id(prefix):
+    return f"{prefix}-{uuid.uuid4().hex[:24]}"
+
+
+def stub_answer(body, index):
+    """Answers JSON mode requests with a minimal object, the others with Turtle.
+
+    The JSON object repeats the last message as its summary, so that answers can
+    be matched with the prompts they were given for.
+    """
+    name = f"stub_document_{index}"
+    if body.get("response_format", {}).get("type") == "json_object":
+        return json.dumps(
+            {
+                "document_name": name,
+                "document_type": "stub",
+                "summary": body["messages"][-1]["content"],
+            }
+        )
+    return STUB_TTL.format(name=name)
+
+
+def completion_line(request, index):
+    body = request["body"]
+    completion = {
+        "id": new_id("chatcmpl"),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": stub_answer(body, index)},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+    return {
+        "id": new_id("batch_req"),
+        "custom_id": request["custom_id"],
+        "response": {
+            "status_code": 200,
+            "request_id": new_id("req"),
+            "body": completion,
+        },
+        "error": None,
+    }
+
+
+def error_line(request):
+    return {
+        "id": new_id("batch_req"),
+        "custom_id": request["custom_id"],
+        "response": None,
+        "error": {"code": "server_error", "message": "Stub failure"},
+    }
+
+
+def store_lines(lines, filename, purpose):
+    file_id = new_id("file")
+    files[file_id] = {
+        "content": "".join(json.dumps(line) + "\n" for line in lines).encode("UTF-8"),
+        "filename": filename,
+        "purpose": purpose,
+    }
+    return file_id
+
+
+def run_batch(batch, input_content):
+    lines = []
+    errors = []
+    for index, line in enumerate(input_content.decode("UTF-8").splitlines()):
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        if FAILURE_MARKER in request["body"]["messages"][-1]["content"]:
+            errors.append(error_line(request))
+        else:
+            lines.append(completion_line(request, index))
+    if lines:
+        batch["output_file_id"] = store_lines(lines, "batch_output.jsonl", "batch_output")
+    if errors:
+        batch["error_file_id"] = store_lines(errors, "batch_errors.jsonl", "batch_output")
+    batch["request_counts"] = {
+        "total": len(lines) + len(errors),
+        "completed": len(lines),
+        "failed": len(errors),
+    }
+
+
+def file_object(file_id):
+    stored = files[file_id]
+    return {
+        "id": file_id,
+        "object": "file",
+        "bytes": len(stored["content"]),
+        "created_at": int(time.time()),
+        "filename": stored["filename"],
+        "purpose": stored["purpose"],
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0
+
+    def send_json(self, data, status=200):
+        content = json.dumps(data).encode("UTF-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        with lock:
+            if path == "/v1/files":
+                self.upload_file()
+            elif path == "/v1/batches":
+                self.create_batch()
+            else:
+                self.send_json({"error": {"message": f"Unknown path {path}"}}, 404)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        with lock:
+            match = re.fullmatch(r"/v1/batches/([\w-]+)", path)
+            if match and match.group(1) in batches:
+                return self.send_json(self.batch_status(batches[match.group(1)]))
+            match = re.fullmatch(r"/v1/files/([\w-]+)/content", path)
+            if match and match.group(1) in files:
+                content = files[match.group(1)]["content"]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                return self.wfile.write(content)
+            self.send_json({"error": {"message": f"Unknown path {path}"}}, 404)
+
+    def upload_file(self):
+        # Multipart form with a "purpose" field and a "file" part
+        message = BytesParser(policy=default).parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("UTF-8")
+            + self.read_body()
+        )
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        file_id = new_id("file")
+        files[file_id] = {
+            "content": fields["file"][1],
+            "filename": fields["file"][0] or "upload.jsonl",
+            "purpose": fields.get("purpose", (None, b"batch"))[1].decode("UTF-8"),
+        }
+        self.send_json(file_object(file_id))
+
+    def create_batch(self):
+        request = json.loads(self.read_body())
+        input_file_id = request["input_file_id"]
+        if input_file_id not in files:
+            return self.send_json({"error": {"message": "Unknown input file"}}, 400)
+        batch = {
+            "id": new_id("batch"),
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": input_file_id,
+            "completion_window": request["completion_window"],
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "errors": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        run_batch(batch, files[input_file_id]["content"])
+        batches[batch["id"]] = batch
+        self.send_json(self.batch_status(batch))
+
+    def batch_status(self, batch):
+        # The batch is computed at once but only reported done after the delay
+        if time.time() - batch["created_at"] < self.delay:
+            counts = dict(batch["request_counts"], completed=0, failed=0)
+            return dict(
+                batch,
+                status="in_progress",
+                output_file_id=None,
+                error_file_id=None,
+                request_counts=counts,
+            )
+        return dict(batch, status="completed", completed_at=int(time.time()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub of the batch endpoints.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=0,
+        help="Seconds before a batch is reported as completed.",
+    )
+    args = parser.parse_args()
+
+    StubHandler.delay = args.delay
+    server = ThreadingHTTPServer(("localhost", args.port), StubHandler)
+    print(f"Batch stub listening on http://localhost:{args.port}/v1")
+    server.serve_forever()
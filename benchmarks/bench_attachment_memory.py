@@ -0,0 +1,91 @@
+import argparse
+import base64
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from attachment_store import DEFAULT_CHUNK_SIZE, AttachmentStore, iter_base64_field
+
+
+def write_response(data, path):
+    """Writes an attachments.get response body, as Gmail would send it."""
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "size": len(data),
+                "data": base64.urlsafe_b64encode(data).decode("ASCII"),
+            },
+            f,
+        )
+
+
+def read_chunks(path, chunk_size):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            yield chunk
+
+
+def download_whole(response_path, output_path):
+    # Same steps as the original get_attachments(): full body, full decode, write
+    with open(response_path, "rb") as f:
+        attachment = json.loads(f.read())
+    data = base64.urlsafe_b64decode(attachment["data"].encode("UTF-8"))
+    with open(output_path, "wb") as f:
+        f.write(data)
+
+
+def download_streamed(response_path, store, chunk_size):
+    return store.put_stream(iter_base64_field(read_chunks(response_path, chunk_size)))
+
+
+def measure(function, *args):
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - started_at
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare peak memory of whole-payload and streamed downloads."
+    )
+    parser.add_argument("--pdf", help="Attachment to use instead of random bytes.")
+    parser.add_argument("--size-mb", type=int, default=25)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            data = f.read()
+    else:
+        data = os.urandom(args.size_mb * 1024 * 1024)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        response_path = os.path.join(tmp_dir, "response.json")
+        write_response(data, response_path)
+        size_mb = len(data) / 1024 / 1024
+        del data
+
+        store = AttachmentStore(root=os.path.join(tmp_dir, "blobs"))
+        whole_peak, whole_time = measure(
+            download_whole, response_path, os.path.join(tmp_dir, "whole.bin")
+        )
+        stream_peak, stream_time = measure(
+            download_streamed, response_path, store, args.chunk_size
+        )
+
+    print(f"Attachment size: {size_mb:.1f} MB, chunk size: {args.chunk_size} bytes")
+    print(f"Whole payload: peak {whole_peak / 1024 / 1024:.1f} MB in {whole_time:.2f}s")
+    print(f"Streamed:      peak {stream_peak / 1024 / 1024:.1f} MB in {stream_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
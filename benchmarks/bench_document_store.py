@@ -0,0 +1,90 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_store import DocumentStore
+
+DOCUMENT_TYPES = ["contract", "invoice", "letter", "proposal", "certificate", "payslip"]
+WORDS = "loyer bail salaire assurance facture rappel attestation contrat prime".split()
+
+
+def synthetic_document(index, companies):
+    company = random.choice(companies)
+    return {
+        "document_name": f"{company} document {index}",
+        "document_type": random.choice(DOCUMENT_TYPES),
+        "date": f"{random.randint(2015, 2025)}-{random.randint(1, 12):02d}-"
+        f"{random.randint(1, 28):02d}",
+        "sender": {
+            "name": f"Sender {index % 5000}",
+            "email": f"sender{index % 5000}@{company.lower()}.ch",
+        },
+        "company": {"name": company},
+        "summary": " ".join(random.choices(WORDS, k=20)),
+    }
+
+
+def timed(function, runs):
+    timings = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started_at)
+    return len(result), statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time document store queries over synthetic JSON outputs."
+    )
+    parser.add_argument("--documents", type=int, default=100000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    companies = [f"Company{index}" for index in range(200)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        store = DocumentStore(os.path.join(tmp_dir, "documents.sqlite"))
+        email = None
+        started_at = time.perf_counter()
+        for index in range(args.documents):
+            document = synthetic_document(index, companies)
+            store.put(f"outputs/{index}/json_output.json", document)
+            if index == 123:
+                email = document["sender"]["email"]
+        elapsed = time.perf_counter() - started_at
+        print(
+            f"Indexed {args.documents} documents in {elapsed:.1f}s "
+            f"({args.documents / elapsed:.0f} docs/s)."
+        )
+
+        queries = {
+            "type + company + year": lambda: store.query(
+                document_type="contract",
+                company="Company42",
+                date_from="2024-01-01",
+                date_to="2024-12-31",
+            ),
+            "sender": lambda: store.query(sender="Sender 123"),
+            "email": lambda: store.query(email=email),
+            "type + year, 100 latest": lambda: store.query(
+                document_type="invoice", date_from="2024-01-01", date_to="2024-12-31"
+            ),
+            "full text + company": lambda: store.query(
+                text="loyer AND bail", company="Company42"
+            ),
+        }
+        for label, query in queries.items():
+            count, median = timed(query, args.runs)
+            print(f"{label:<26} {count:>4} documents, median {median:.2f} ms")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules an email-only run should never import
+HEAVY_MODULES = ["torch", "doctr", "neo4j", "langchain", "langchain_openai"]
+
+# Runs in a fresh interpreter, from the import of the entry point to the moment
+# every email is read and ready for the LLM stage
+STARTUP_SCRIPT = """
+import json, sys, time
+started_at = time.perf_counter()
+import json_preprocessing
+from staged_pipeline import StagedPipeline, walk_corpus
+imported_at = time.perf_counter()
+if {with_predictor}:
+    from ocr import create_local_predictor
+    create_local_predictor()
+documents = StagedPipeline().read_all(walk_corpus())
+read_at = time.perf_counter()
+print(json.dumps({{
+    "import": imported_at - started_at,
+    "ready": read_at - started_at,
+    "documents": len(documents),
+    "heavy": [name for name in {heavy} if name in sys.modules],
+}}))
+"""
+
+
+def write_corpus(folder, emails):
+    """Writes threads/<thread>/<email>/email.txt files, as retrieve_emails.py does."""
+    for index in range(emails):
+        thread_folder = os.path.join(folder, "threads", f"thread_{index // 10}")
+        email_folder = os.path.join(thread_folder, str(index))
+        os.makedirs(email_folder, exist_ok=True)
+        with open(os.path.join(email_folder, "email.txt"), "w", encoding="UTF-8") as f:
+            f.write(f"Subject: Invoice {index}\n\nPlease find the invoice attached.\n")
+
+
+def run_once(folder, with_predictor):
+    script = STARTUP_SCRIPT.format(with_predictor=with_predictor, heavy=HEAVY_MODULES)
+    python_path = [REPO_FOLDER] + os.environ.get("PYTHONPATH", "").split(os.pathsep)
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(python_path))
+    started_at = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=folder,
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    total = time.perf_counter() - started_at
+    # The pipeline prints its summary first, the measurements are on the last line
+    return dict(json.loads(output.strip().splitlines()[-1]), total=total)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the startup of an email-only extraction run."
+    )
+    parser.add_argument("--emails", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--with-predictor",
+        action="store_true",
+        help="Also build the OCR predictor up front, as runs did before.",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_corpus(tmp_dir, args.emails)
+        results = [run_once(tmp_dir, args.with_predictor) for _ in range(args.runs)]
+
+    for key, label in [
+        ("import", "Imports"),
+        ("ready", "Emails read"),
+        ("total", "Process total"),
+    ]:
+        timings = [result[key] for result in results]
+        print(
+            f"{label:<14} median {statistics.median(timings):.3f}s, "
+            f"max {max(timings):.3f}s"
+        )
+    print(f"Documents read: {results[0]['documents']} of {args.emails} emails")
+    print(f"Heavy modules imported: {', '.join(results[0]['heavy']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
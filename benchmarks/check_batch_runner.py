@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import namedtuple
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import OpenAI
+
+import batch_stub_server
+import llm_batch
+from batch_stub_server import FAILURE_MARKER, StubHandler
+from llm_batch import BatchRunner
+from llm_cache import LLMCache
+
+# The message objects of langchain, as far as BatchRunner is concerned
+Message = namedtuple("Message", ["type", "content"])
+MODEL = SimpleNamespace(
+    model_name="gpt-3.5-turbo",
+    temperature=0,
+    model_kwargs={"response_format": {"type": "json_object"}},
+)
+
+
+def document_messages(index, failed):
+    text = f"Document {index}: invoice {index * 7} from Company{index % 3}."
+    if failed:
+        text += f" {FAILURE_MARKER}"
+    return [Message("system", "Extract the metadata as JSON."), Message("human", text)]
+
+
+class QuietStubHandler(StubHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(delay):
+    QuietStubHandler.delay = delay
+    server = ThreadingHTTPServer(("localhost", 0), QuietStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit(f"FAILED: {message}")
+    print(f"ok: {message}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run BatchRunner against batch_stub_server.py and check its answers."
+    )
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument(
+        "--delay",
+        type=float,
+        default=1,
+        help="Seconds before the stub reports a batch as completed.",
+    )
+    args = parser.parse_args()
+
+    server = start_stub(args.delay)
+    llm_batch.POLL_INTERVAL = 0.2
+    client = OpenAI(
+        base_url=f"http://localhost:{server.server_address[1]}/v1", api_key="stub"
+    )
+    failed_index = args.documents // 2
+    documents = {
+        index: document_messages(index, index == failed_index)
+        for index in range(args.documents)
+    }
+
+    # batch_state.json and the input files are written under the working folder
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        cache = LLMCache(os.path.join(tmp_dir, "llm_cache.sqlite"))
+        runner = BatchRunner(MODEL, cache=cache, namespace="json", client=client)
+        keys = {index: runner.add(messages) for index, messages in documents.items()}
+        # The same prompt twice is sent once
+        check(runner.add(documents[0]) == keys[0], "identical prompts share a key")
+        answers = runner.run()
+
+        check(
+            len(batch_stub_server.batches) == 1,
+            "every prompt was sent in a single batch",
+        )
+        check(keys[failed_index] not in answers, "the failed line has no answer")
+        for index, messages in documents.items():
+            if index == failed_index:
+                continue
+            summary = json.loads(answers[keys[index]])["summary"]
+            if summary != messages[-1].content:
+                check(False, f"document {index} got the answer of {summary!r}")
+        check(
+            len(answers) == args.documents - 1,
+            "every other answer maps back to its document",
+        )
+        check(
+            all(cache.get(key) == answer for key, answer in answers.items()),
+            "the answers are stored in the LLM cache",
+        )
+        check(
+            llm_batch.load_batch_state() == {},
+            "the batch state is cleared once the batch is read",
+        )
+
+        # A re-run only sends the prompt that failed
+        for messages in documents.values():
+            runner.add(messages)
+        rerun_answers = runner.run()
+        check(
+            len(batch_stub_server.batches) == 2,
+            "the re-run submitted a second batch",
+        )
+        second_batch = list(batch_stub_server.batches.values())[-1]
+        check(
+            second_batch["request_counts"]["total"] == 1,
+            "only the failed prompt was sent again",
+        )
+        check(
+            rerun_answers == answers,
+            "the cached answers are served again",
+        )
+        cache.close()
+        os.chdir(os.path.dirname(tmp_dir))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunking import chunk_document, merge_json, merge_ttl
+from turtle_parser import IRI, parse
+
+PREFIX = "@prefix ex: <http://example.org/> ."
+FIRST_CHUNK = f"""```turtle
+{PREFIX}
+
+ex:invoice_1 a ex:Document ;
+    ex:date "2021-06-25" ;
+    ex:title "" ;
+    ex:sender [ ex:name "Todan" ] .
+```"""
+SECOND_CHUNK = f"""{PREFIX}
+
+ex:invoice_1_part2 a ex:Document ;
+    ex:title "Invoice 1" ;
+    ex:recipient [ ex:date "2020-01-01" ] ;
+    ex:date "2021-07-01" .
+"""
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit(f"FAILED: {message}")
+    print(f"ok: {message}")
+
+
+def main():
+    check(
+        chunk_document("a short text", None, count_words, max_tokens=10)
+        == ["a short text"],
+        "a document within the budget is one chunk",
+    )
+
+    text = "\n\n".join(f"block {index} " + "word " * 8 for index in range(6))
+    chunks = chunk_document(text, None, count_words, max_tokens=25)
+    check(
+        all(count_words(chunk) <= 25 for chunk in chunks) and len(chunks) == 3,
+        "blocks are packed into chunks within the budget",
+    )
+    check(
+        "\n\n".join(chunks) == text,
+        "chunks are cut on block boundaries and keep every block",
+    )
+    chunks = chunk_document("word " * 30, None, count_words, max_tokens=10)
+    check(
+        len(chunks) == 3 and all(count_words(chunk) == 10 for chunk in chunks),
+        "a block larger than the budget is split on its words",
+    )
+
+    export = {
+        "pages": [
+            {"source": "text_layer", "text": "first " * 6},
+            {
+                "blocks": [
+                    {"lines": [{"words": [{"value": "second"}, {"value": "page"}]}]}
+                ]
+            },
+        ]
+    }
+    chunks = chunk_document("ignored " * 20, export, count_words, max_tokens=10)
+    check(
+        chunks == ["first " * 6, "second page"],
+        "a half full chunk is cut at a page boundary",
+    )
+
+    merged = merge_json(
+        [
+            {"date": "", "company": "Todan", "items": [{"a": 1}], "total": {"x": 1}},
+            {
+                "date": "2021-06-25",
+                "company": "Other",
+                "items": [{"a": 1}, {"b": 2}],
+                "total": {"y": 2},
+            },
+        ]
+    )
+    check(
+        merged
+        == {
+            "date": "2021-06-25",
+            "company": "Todan",
+            "items": [{"a": 1}, {"b": 2}],
+            "total": {"x": 1, "y": 2},
+        },
+        "merge_json keeps the first non-empty scalar and unions lists and objects",
+    )
+
+    ttl = merge_ttl([FIRST_CHUNK, SECOND_CHUNK])
+    check(ttl.count("@prefix") == 1 and "```" not in ttl, "prefixes are kept once")
+    triples = parse(ttl)
+    document = IRI("http://example.org/invoice_1")
+    check(
+        all(s != IRI("http://example.org/invoice_1_part2") for s, _, _ in triples),
+        "the subject of later chunks is renamed to the first one",
+    )
+    values = {str(p).rsplit("/", 1)[-1]: o for s, p, o in triples if s == document}
+    check(
+        values["date"] == "2021-06-25" and values["title"] == "Invoice 1",
+        "the first non-empty literal property wins",
+    )
+    check(
+        "sender" in values and "recipient" in values,
+        "the entities of every chunk are kept",
+    )
+    check(
+        any(str(p).endswith("date") and o == "2020-01-01" for s, p, o in triples),
+        "properties inside an entity are not dropped",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from entity_resolution import EntityIndex, Mention, UnionFind, resolve
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit(f"FAILED: {message}")
+    print(f"ok: {message}")
+
+
+def cluster_of(clusters, document):
+    for cluster in clusters:
+        if any(mention.document == document for mention in cluster):
+            return cluster
+    return None
+
+
+def main():
+    clusters = UnionFind(5)
+    clusters.union(3, 4)
+    clusters.union(1, 3)
+    clusters.union(0, 2)
+    check(
+        clusters.find(4) == clusters.find(1) == 1 and clusters.find(2) == 0,
+        "union-find merges transitively onto the smallest index",
+    )
+    check(clusters.find(0) != clusters.find(1), "separate sets stay apart")
+
+    mentions = [
+        Mention("Company", "Todan Relocation SA", "info@todan-relocation.ch", document="a"),
+        Mention("Company", "TODAN Relocation", document="b"),
+        Mention("Company", "Todan", "billing@todan-relocation.ch", document="c"),
+        Mention("Person", "", "noreply@todan-relocation.ch", document="d"),
+        Mention("Company", "Swisscom AG", phone="+41 58 221 99 11", document="e"),
+        Mention("Company", "Swisscom (Schweiz)", phone="058 221 99 11", document="f"),
+        Mention("Person", "Jane Doe", "jane.doe@gmail.com", document="g"),
+        Mention("Person", "John Doe", "john.doe@gmail.com", document="h"),
+    ]
+    clusters = resolve(mentions)
+    todan = cluster_of(clusters, "a")
+    check(
+        {mention.document for mention in todan} == {"a", "b", "c", "d"},
+        "names, legal forms and the company domain merge into one entity",
+    )
+    check(
+        cluster_of(clusters, "e") is cluster_of(clusters, "f"),
+        "the same phone number merges whatever its prefix",
+    )
+    check(
+        cluster_of(clusters, "g") is not cluster_of(clusters, "h"),
+        "close names on a free mail domain stay apart",
+    )
+    check(len(clusters) == 4, "every mention lands in exactly one cluster")
+
+    index = EntityIndex.from_clusters(clusters)
+    entity_id, name = index.lookup("Todan Relocation")
+    check(
+        entity_id is not None and name == "Todan Relocation SA",
+        "the index maps an alias to the canonical name",
+    )
+    check(
+        index.lookup("", "noreply@todan-relocation.ch")[0] == entity_id,
+        "the index maps an address without a name to its entity",
+    )
+    check(index.lookup("Nobody") == (None, "Nobody"), "unknown names are kept")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "entity_index.json")
+        index.save(path)
+        loaded = EntityIndex.load(path)
+    check(
+        loaded.entities == index.entities and loaded.aliases == index.aliases,
+        "the index survives a save and load",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from turtle_parser import IRI, RDF_NS, XSD_NS, BNode, Literal, TurtleError, parse
+
+EX = "http://example.org/"
+DOCUMENT = r'''@prefix ex: <http://example.org/> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+ex:invoice_42 a ex:Document ;
+    ex:title "Invoice \"42\"\tpaid\n" ;
+    ex:note """Two
+lines""" , 'single' ;
+    ex:amount 1250.50 ;
+    ex:count 3 ;
+    ex:date "2021-06-25"^^xsd:date ;
+    ex:label "Rechnung"@de ;
+    ex:sender [ ex:name "Todan \u00e9" ; ex:email "info@todan.ch" ] ;
+    ex:tags ( "a" "b" ) ;
+    .
+'''
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit(f"FAILED: {message}")
+    print(f"ok: {message}")
+
+
+def objects(triples, subject, predicate):
+    return [o for s, p, o in triples if s == subject and p == IRI(EX + predicate)]
+
+
+def main():
+    triples = parse(DOCUMENT)
+    document = IRI(EX + "invoice_42")
+
+    check(
+        (document, IRI(RDF_NS + "type"), IRI(EX + "Document")) in triples,
+        '"a" is rdf:type and prefixed names expand',
+    )
+    check(
+        objects(triples, document, "title") == ['Invoice "42"\tpaid\n'],
+        "escaped quotes, tabs and newlines are unescaped",
+    )
+    check(
+        objects(triples, document, "note") == ["Two\nlines", "single"],
+        '"," continues the object list, long and single quoted strings included',
+    )
+    amount = objects(triples, document, "amount")[0]
+    count = objects(triples, document, "count")[0]
+    check(
+        amount == "1250.50" and amount.datatype == XSD_NS + "decimal"
+        and count.datatype == XSD_NS + "integer",
+        "numbers are typed literals",
+    )
+    date = objects(triples, document, "date")[0]
+    label = objects(triples, document, "label")[0]
+    check(
+        date.datatype == XSD_NS + "date" and label.language == "de",
+        "datatypes and language tags are kept",
+    )
+
+    sender = objects(triples, document, "sender")[0]
+    check(isinstance(sender, BNode), "[ ... ] is a blank node")
+    check(
+        objects(triples, sender, "name") == ["Todan é"]
+        and objects(triples, sender, "email") == ["info@todan.ch"],
+        '";" continues the predicate list inside a blank node, \\u escapes included',
+    )
+    tags = objects(triples, document, "tags")[0]
+    first = [o for s, p, o in triples if s == tags and p == RDF_NS + "first"]
+    check(first == ["a"], "collections are rdf:first/rdf:rest lists")
+    check(
+        all(isinstance(o, Literal) for o in objects(triples, document, "note")),
+        "strings are literals",
+    )
+
+    try:
+        parse("@prefix ex: <http://example.org/> .\nex:a ex:b")
+    except TurtleError:
+        check(True, "a truncated statement raises TurtleError")
+    else:
+        check(False, "a truncated statement raises TurtleError")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import json
+import os
+import re
+
+from graph_export import CODE_FENCE_PATTERN
+
+# Document tokens per request, well within the gpt-3.5-turbo context with the prompt
+DEFAULT_CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "6000"))
+TTL_SUBJECT_PATTERN = re.compile(r"^(ex:\S+)\s+a\s+ex:Document\b", re.MULTILINE)
+# A one-line literal property, e.g. '    ex:date "2021-06-25" ;'
+TTL_PROPERTY_PATTERN = re.compile(
+    r'^\s+(ex:\w+)\s+("(?:[^"\\]|\\.)*"|[^\s\[]\S*)\s*([;.])\s*$'
+)
+TTL_STRING_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+def export_units(export):
+    """Returns the text of every block of a document export, pages in order.
+
+    Each unit ends with the index of its page, so that chunks can be cut at page
+    boundaries when possible.
+    """
+    units = []
+    for page_index, page in enumerate(export.get("pages", [])):
+        if page.get("source") == "text_layer":
+            blocks = [block for block in page["text"].split("\n\n") if block.strip()]
+        else:
+            blocks = [
+                "\n".join(
+                    " ".join(word["value"] for word in line["words"])
+                    for line in block["lines"]
+                )
+                for block in page.get("blocks", [])
+            ]
+        units.extend((block, page_index) for block in blocks)
+    return units
+
+
+def text_units(text):
+    return [(block, 0) for block in text.split("\n\n") if block.strip()]
+
+
+def split_oversized(unit, max_tokens, count_tokens):
+    """Splits a block larger than the budget on its lines, then on its words."""
+    text, page_index = unit
+    separator = "\n" if "\n" in text else " "
+    pieces = []
+    current = []
+    for part in text.split(separator):
+        candidate = separator.join(current + [part])
+        if current and count_tokens(candidate) > max_tokens:
+            pieces.append((separator.join(current), page_index))
+            current = [part]
+        else:
+            current.append(part)
+    if current:
+        pieces.append((separator.join(current), page_index))
+    return pieces
+
+
+def chunk_document(text, export, count_tokens, max_tokens=DEFAULT_CHUNK_TOKENS):
+    """Splits a document into texts of at most max_tokens, on block boundaries."""
+    if count_tokens(text) <= max_tokens:
+        return [text]
+
+    units = export_units(export) if export else text_units(text)
+    chunks = []
+    current = []
+    current_tokens = 0
+    for unit in units:
+        tokens = count_tokens(unit[0])
+        if tokens > max_tokens:
+            pieces = split_oversized(unit, max_tokens, count_tokens)
+        else:
+            pieces = [unit]
+        for piece_text, page_index in pieces:
+            piece_tokens = count_tokens(piece_text)
+            # Prefer starting a new chunk on a new page once the chunk is half full
+            new_page = current and page_index != current[-1][1]
+            if current and (
+                current_tokens + piece_tokens > max_tokens
+                or (new_page and current_tokens > max_tokens // 2)
+            ):
+                chunks.append("\n\n".join(block for block, _ in current))
+                current = []
+                current_tokens = 0
+            current.append((piece_text, page_index))
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(block for block, _ in current))
+    return chunks
+
+
+def is_empty(value):
+    return value in (None, "", [], {})
+
+
+def merge_json(results):
+    """Merges the JSON extracted from each chunk, earlier chunks taking precedence.
+
+    Objects are merged key by key, lists are concatenated without duplicates and
+    the first non-empty scalar wins, so the result only depends on chunk order.
+    """
+    merged = {}
+    for result in results:
+        merged = merge_values(merged, result)
+    return merged
+
+
+def merge_values(left, right):
+    if isinstance(left, dict) and isinstance(right, dict):
+        merged = dict(left)
+        for key, value in right.items():
+            merged[key] = merge_values(merged[key], value) if key in merged else value
+        return merged
+    if isinstance(left, list) and isinstance(right, list):
+        seen = set()
+        merged = []
+        for item in left + right:
+            marker = json.dumps(item, sort_keys=True, ensure_ascii=False)
+            if marker not in seen:
+                seen.add(marker)
+                merged.append(item)
+        return merged
+    return right if is_empty(left) else left
+
+
+def merge_ttl(results):
+    """Concatenates the Turtle extracted from each chunk about a single document.
+
+    Prefixes are kept once and the document subject of every chunk is renamed to
+    the one of the first chunk, so all the statements describe the same node. As
+    in merge_json, the first chunk giving a literal property wins: later values
+    of that property are dropped, while the entities of every chunk are kept.
+    """
+    prefixes = []
+    bodies = []
+    subject = None
+    properties = set()  # Literal properties of the document, from earlier chunks
+    for result in results:
+        body = []
+        for line in CODE_FENCE_PATTERN.sub("", result).strip().splitlines():
+            if line.startswith("@prefix"):
+                if line not in prefixes:
+                    prefixes.append(line)
+            else:
+                body.append(line)
+        body = "\n".join(body).strip()
+
+        match = TTL_SUBJECT_PATTERN.search(body)
+        if match:
+            if subject is None:
+                subject = match.group(1)
+            elif match.group(1) != subject:
+                body = re.sub(
+                    rf"(?<!\S){re.escape(match.group(1))}(?!\S)", subject, body
+                )
+            body, chunk_properties = drop_properties(body, properties)
+            properties |= chunk_properties
+        bodies.append(body)
+    return "\n".join(prefixes) + "\n\n" + "\n\n".join(bodies) + "\n"
+
+
+def drop_properties(body, properties):
+    """Drops the literal properties of the document already given by a chunk.
+
+    Returns the body and the non-empty literal properties it gives. Only the
+    one-line properties of the document statement, outside any entity, count.
+    """
+    lines = []
+    given = set()
+    depth = 0
+    in_document = False
+    for line in body.splitlines():
+        if TTL_SUBJECT_PATTERN.match(line):
+            in_document = True
+        match = TTL_PROPERTY_PATTERN.match(line)
+        if in_document and depth == 0 and match:
+            predicate, value, end = match.groups()
+            if predicate in properties:
+                if end == "." and lines:
+                    # The dropped line ended the statement, the previous one does
+                    lines[-1] = re.sub(r";\s*$", ".", lines[-1])
+                    in_document = False
+                continue
+            if value != '""':
+                given.add(predicate)
+        depth += line_depth(line)
+        if depth == 0 and line.rstrip().endswith("."):
+            in_document = False
+        lines.append(line)
+    return "\n".join(lines), given
+
+
+def line_depth(line):
+    """Returns how many entities a line opens, minus those it closes."""
+    line = TTL_STRING_PATTERN.sub('""', line)
+    return line.count("[") - line.count("]")
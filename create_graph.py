@@ -1,92 +1,311 @@
-from neo4j import GraphDatabase
-from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+import argparse
 import json
 import os
+import time
 from dotenv import load_dotenv, find_dotenv
+from llm_engine import create_engine
+from llm_cache import LLMCache
+from graph_export import (
+    SOURCE_FOLDERS,
+    TTL_OUTPUT_FILE,
+    entity_type,
+    iter_output_files,
+    property_value,
+    stable_id,
+    ttl_records,
+)
+from turtle_parser import TurtleError
+from entity_resolution import ENTITY_INDEX_FILE_PATH, EntityIndex
+from manifest import Manifest, processing_version
+from staged_pipeline import StagedPipeline, walk_corpus
 
 # Load environment variables
 load_dotenv(find_dotenv())
 
+NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
+NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
+NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "topsecret")
+NEO4J_BATCH_SIZE = int(os.getenv("NEO4J_BATCH_SIZE", "1000"))  # Rows per transaction
+
+# Labels MERGEd on their name by the loader, each backed by a uniqueness
+# constraint so that MERGE is an index seek instead of a label scan
+MERGE_LABELS = ["Document", "Sender", "Company"]
+CONSTRAINT_QUERY = """
+CREATE CONSTRAINT {name} IF NOT EXISTS
+FOR (n:{label}) REQUIRE n.{key} IS UNIQUE
+"""
+INDEX_WAIT_SECONDS = 300
+
+# Every query writes a whole batch of rows in one round trip
+DOCUMENTS_QUERY = """
+UNWIND $rows AS row
+MERGE (d:Document {name: row.doc_name})
+"""
+SENDERS_QUERY = """
+UNWIND $rows AS row
+MERGE (s:Sender {name: row.name})
+SET s.entity_id = row.entity_id
+MERGE (d:Document {name: row.doc_name})
+MERGE (s)-[:SENT]->(d)
+"""
+COMPANIES_QUERY = """
+UNWIND $rows AS row
+MERGE (c:Company {name: row.name})
+SET c.entity_id = row.entity_id
+MERGE (d:Document {name: row.doc_name})
+MERGE (c)-[:RELATED_TO]->(d)
+"""
+DOCUMENT_PROPERTIES_QUERY = """
+UNWIND $rows AS row
+MERGE (d:Document {name: row.doc_name})
+SET d += row.properties
+"""
+# Entities of the Turtle outputs, labels cannot be query parameters: they are
+# written into the query, backtick-quoted
+ENTITY_QUERY = """
+UNWIND $rows AS row
+MERGE (e:{label} {{{key}: row.key}})
+SET e += row.properties
+MERGE (d:Document {{name: row.doc_name}})
+MERGE {pattern}
+"""
+
 # Set up Neo4J connection
 class Neo4JConnector:
     def __init__(self, uri, user, password):
+        # The driver is only imported by the runs that connect to Neo4j
+        from neo4j import GraphDatabase
+
         self.driver = GraphDatabase.driver(uri, auth=(user, password))
+        # One long-lived session, its connection comes from the driver's pool
+        self.session = self.driver.session()
 
     def close(self):
+        self.session.close()
         self.driver.close()
 
     def execute_query(self, query, parameters=None):
-        with self.driver.session() as session:
-            result = session.run(query, parameters)
-            return result.data()
+        result = self.session.run(query, parameters)
+        return result.data()
+
+    def create_constraints(self):
+        """Creates the constraints the loader relies on, if they do not exist yet."""
+        for label in MERGE_LABELS:
+            self.create_constraint(label)
+
+    def create_constraint(self, label, key='name'):
+        name = quote_name(f"{label.lower()}_{key}_unique")
+        query = CONSTRAINT_QUERY.format(name=name, label=quote_name(label), key=quote_name(key))
+        self.session.run(query).consume()
+        # The backing index is populated in the background, wait for it
+        self.session.run(f"CALL db.awaitIndexes({INDEX_WAIT_SECONDS})").consume()
+
+    def check_constraints(self):
+        """Prints, for each label, whether EXPLAIN plans its MERGE as an index seek."""
+        usable = True
+        for label in MERGE_LABELS:
+            summary = self.session.run(
+                f"EXPLAIN MERGE (n:{label} {{name: $name}})", {'name': ''}
+            ).consume()
+            operators = plan_operators(summary.plan)
+            seek = any('IndexSeek' in operator for operator in operators)
+            usable = usable and seek
+            status = 'index seek' if seek else 'NO INDEX, ' + ', '.join(operators)
+            print(f"MERGE (:{label} {{name}}): {status}")
+        return usable
+
+    def write_rows(self, query, rows):
+        """Runs an UNWIND query over rows in one explicit, retried transaction."""
+        self.session.execute_write(lambda tx: tx.run(query, rows=rows).consume())
+
+def quote_name(name):
+    """Quotes a label, relationship type or property name written into a query."""
+    return '`' + name.replace('`', '``') + '`'
+
+def plan_operators(plan):
+    """Returns the operator types of a query plan and of its children."""
+    operators = [plan['operatorType'].split('@')[0]]
+    for child in plan.get('children', []):
+        operators += plan_operators(child)
+    return operators
+
+class GraphLoader:
+    """Gathers Document, Sender and Company rows and writes them in batches.
+
+    With an entity index, senders and companies are written under the canonical
+    name and id entity_resolution.py found for them.
+    """
+
+    def __init__(self, connector, batch_size=NEO4J_BATCH_SIZE, entity_index=None):
+        self.connector = connector
+        self.entity_index = entity_index
+        self.batch_size = batch_size
+        self.rows = {
+            DOCUMENTS_QUERY: [],
+            DOCUMENT_PROPERTIES_QUERY: [],
+            SENDERS_QUERY: [],
+            COMPANIES_QUERY: [],
+        }
+        self.pending = 0
+        self.written = 0
+        self.elapsed = 0.0
+
+    def add(self, entry):
+        if 'document_name' not in entry:
+            return
+        doc_name = entry['document_name']
+        self.rows[DOCUMENTS_QUERY].append({'doc_name': doc_name})
+        self.pending += 1
+
+        sender = entry.get('sender')
+        if isinstance(sender, dict) and sender.get('name'):
+            entity_id, name = self.resolve(sender)
+            self.rows[SENDERS_QUERY].append({'name': name, 'entity_id': entity_id, 'doc_name': doc_name})
+            self.pending += 1
+
+        # Add more relationships based on the structure of your JSON data
+        company = entry.get('company')
+        if isinstance(company, dict) and company.get('name'):
+            entity_id, name = self.resolve(company)
+            self.rows[COMPANIES_QUERY].append({'name': name, 'entity_id': entity_id, 'doc_name': doc_name})
+            self.pending += 1
+
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def add_record(self, document_name, properties, entities):
+        """Queues a document and its nested entities, as read from a Turtle output.
+
+        Entities with a name are merged on it, so that the same sender or company
+        found in many documents is a single node. The others are merged on an id
+        hashed from their document and content.
+        """
+        self.rows[DOCUMENT_PROPERTIES_QUERY].append({
+            'doc_name': document_name,
+            'properties': non_empty_properties(properties),
+        })
+        self.pending += 1
+        for key, entity in entities:
+            entity = non_empty_properties(entity)
+            label, relationship_type, to_document = entity_type(key)
+            if entity.get('name'):
+                entity_id, entity['name'] = self.resolve(entity)
+                if entity_id is not None:
+                    entity['entity_id'] = entity_id
+                merge_key, value = 'name', entity['name']
+            else:
+                content = json.dumps(entity, sort_keys=True, ensure_ascii=False)
+                merge_key, value = 'id', stable_id(label, document_name, key, content)
+            query = self.entity_query(label, relationship_type, to_document, merge_key)
+            self.rows[query].append({
+                'key': value, 'doc_name': document_name, 'properties': entity
+            })
+            self.pending += 1
+
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def resolve(self, entity):
+        """Returns (canonical id, canonical name) of an entity with a name."""
+        if self.entity_index is None:
+            return None, entity['name']
+        return self.entity_index.lookup(entity['name'], entity.get('email'))
+
+    def entity_query(self, label, relationship_type, to_document, merge_key):
+        relationship_type = quote_name(relationship_type)
+        if to_document:
+            pattern = f'(e)-[:{relationship_type}]->(d)'
+        else:
+            pattern = f'(d)-[:{relationship_type}]->(e)'
+        query = ENTITY_QUERY.format(label=quote_name(label), key=quote_name(merge_key), pattern=pattern)
+        if query not in self.rows:
+            # New labels get their constraint before their first MERGE
+            self.connector.create_constraint(label, merge_key)
+            self.rows[query] = []
+        return query
+
+    def flush(self):
+        started_at = time.monotonic()
+        # Documents go first, the relationship queries then match them
+        for query, rows in self.rows.items():
+            for start in range(0, len(rows), self.batch_size):
+                self.connector.write_rows(query, rows[start:start + self.batch_size])
+            self.written += len(rows)
+            rows.clear()
+        self.pending = 0
+        self.elapsed += time.monotonic() - started_at
+
+    def summary(self):
+        rate = self.written / self.elapsed if self.elapsed else 0
+        print(f"{self.written} graph rows written in {self.elapsed:.1f}s ({rate:.0f} rows/s).")
 
 def load_json(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
         return json.load(file)
 
-def create_knowledge_graph(connector, json_data):
-    # Define nodes and relationships based on JSON structure
+def non_empty_properties(properties):
+    values = {key: property_value(value) for key, value in properties.items()}
+    return {key: value for key, value in values.items() if value}
+
+def load_ttl_outputs(loader, folders=SOURCE_FOLDERS):
+    """Streams the Turtle outputs into the graph, one file in memory at a time."""
+    files = 0
+    for file_path in iter_output_files(folders, (TTL_OUTPUT_FILE,)):
+        try:
+            for record in ttl_records(file_path):
+                loader.add_record(*record)
+        except TurtleError as e:
+            print(f"Skipping {file_path}: {e}")
+            continue
+        files += 1
+    loader.flush()
+    print(f"Loaded {files} Turtle files.")
+
+def create_knowledge_graph(connector, json_data, loader=None):
+    # Define nodes and relationships based on JSON structure. With a loader, the
+    # rows are only written once it has gathered a full batch
+    batch = loader or GraphLoader(connector)
     for entry in json_data:
-        if 'document_name' in entry:
-            doc_name = entry['document_name']
-            query = """
-            MERGE (d:Document {name: $doc_name})
-            """
-            connector.execute_query(query, {'doc_name': doc_name})
-
-            if 'sender' in entry:
-                sender_name = entry['sender'].get('name')
-                if sender_name:
-                    query = """
-                    MERGE (s:Sender {name: $sender_name})
-                    MERGE (d:Document {name: $doc_name})
-                    MERGE (s)-[:SENT]->(d)
-                    """
-                    connector.execute_query(query, {'sender_name': sender_name, 'doc_name': doc_name})
-
-            # Add more relationships based on the structure of your JSON data
-            if 'company' in entry:
-                company_name = entry['company'].get('name')
-                if company_name:
-                    query = """
-                    MERGE (c:Company {name: $company_name})
-                    MERGE (d:Document {name: $doc_name})
-                    MERGE (c)-[:RELATED_TO]->(d)
-                    """
-                    connector.execute_query(query, {'company_name': company_name, 'doc_name': doc_name})
+        batch.add(entry)
+    if loader is None:
+        batch.flush()
 
 def initialize_model(api_key):
+    from langchain_openai import ChatOpenAI
+
     model = ChatOpenAI(api_key=api_key, model="gpt-3.5-turbo")
     return model
 
-def generate_structured_data(model, document_text, json_template):
+def build_messages(document_text, json_template):
+    from langchain.prompts import PromptTemplate
+    from langchain_core.messages import HumanMessage, SystemMessage
+
     prompt_template = PromptTemplate(
         template=json_template, input_variables=["document"]
     ).format(document=document_text)
 
-    messages = [
+    return [
         SystemMessage(content="Extract structured information from the document."),
         HumanMessage(content=prompt_template),
     ]
 
-    result = model.invoke(messages)
-    return json.loads(result.content)
-
-def process_files_in_folder(folder_path, model, connector, systemPrompt, json_template):
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        if filename.endswith('.json'):
-            json_data = load_json(file_path)
-            create_knowledge_graph(connector, json_data)
-        elif filename.endswith('.txt'):
-            with open(file_path, 'r', encoding='utf-8') as file:
-                document_text = file.read()
-                structured_data = generate_structured_data(model, document_text, json_template)
-                create_knowledge_graph(connector, [structured_data])
-
-def main():
+async def agenerate_structured_data(engine, document_text, json_template):
+    content = await engine.ainvoke(build_messages(document_text, json_template))
+    return json.loads(content)
+
+def process_file(file_path, loader):
+    """Queues the content of a JSON or Turtle file on the loader."""
+    if file_path.endswith('.json'):
+        json_data = load_json(file_path)
+        create_knowledge_graph(loader.connector, json_data, loader)
+    elif file_path.endswith('.ttl'):
+        try:
+            for record in ttl_records(file_path):
+                loader.add_record(*record)
+        except TurtleError as e:
+            print(f"Skipping {file_path}: {e}")
+
+def main(force=False):
     # Load environment variables
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
@@ -94,13 +313,17 @@ def main():
 
     # Initialize model and Neo4J connector
     model = initialize_model(api_key)
-    connector = Neo4JConnector("bolt://localhost:7687", "neo4j", "topsecret")
-
-    # Read system message
-    with open("./prompts/system_message.txt", "r") as file:
-        systemMessage = file.read()
-
-    systemPrompt = PromptTemplate(template=systemMessage, input_variables=[])
+    llm_cache = LLMCache()
+    llm_cache.invalidate_if_changed("graph", ["./prompts/system_message.txt"])
+    engine = create_engine(model, cache=llm_cache, namespace="graph")
+    connector = Neo4JConnector(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD)
+    connector.create_constraints()
+    loader = GraphLoader(connector, entity_index=EntityIndex.load())
+    # Files already loaded with the same model, prompt and entity index are skipped
+    version_files = ["./prompts/system_message.txt"]
+    if os.path.exists(ENTITY_INDEX_FILE_PATH):
+        version_files.append(ENTITY_INDEX_FILE_PATH)
+    manifest = Manifest("graph", processing_version(model.model_name, prompt_files=version_files), force=force)
 
     # JSON template for ChatGPT prompt
     json_template = """
@@ -111,21 +334,64 @@ def main():
     }
     """
 
-    # Process Documents folder
-    documents_folder = "./Documents"
-    process_files_in_folder(documents_folder, model, connector, systemPrompt, json_template)
+    # Process the Documents and threads folders: JSON and Turtle files are loaded
+    # as they are found, text files go through the extraction stages
+    text_files = []
+    loaded_files = []
+    for file_path, email_processing in manifest.pending(walk_corpus(extensions=('.json', '.ttl', '.txt'))):
+        if file_path.endswith('.txt'):
+            text_files.append((file_path, email_processing))
+        else:
+            process_file(file_path, loader)
+            loaded_files.append(file_path)
+
+    def write(document, entry):
+        create_knowledge_graph(connector, [entry], loader)
+        loaded_files.append(document['file_path'])
+
+    pipeline = StagedPipeline(
+        extract=lambda document: agenerate_structured_data(engine, document['original_text'], json_template),
+        write=write,
+        engine=engine,
+    )
+    pipeline.run(text_files)
+    llm_cache.close()
 
-    # Process threads folder
-    threads_folder = "./threads"
-    for thread_folder in os.listdir(threads_folder):
-        thread_path = os.path.join(threads_folder, thread_folder)
-        if os.path.isdir(thread_path):
-            for email_folder in os.listdir(thread_path):
-                email_path = os.path.join(thread_path, email_folder)
-                if os.path.isdir(email_path):
-                    process_files_in_folder(email_path, model, connector, systemPrompt, json_template)
+    loader.flush()
+    loader.summary()
+    # Only recorded once their rows are committed
+    for file_path in loaded_files:
+        manifest.record(file_path)
+    print(manifest.summary())
+    manifest.close()
+
+    connector.close()
+
+def load_ttl(folders=SOURCE_FOLDERS):
+    connector = Neo4JConnector(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD)
+    connector.create_constraints()
+    loader = GraphLoader(connector, entity_index=EntityIndex.load())
+    load_ttl_outputs(loader, folders)
+    loader.summary()
+    connector.close()
 
+def check_schema():
+    connector = Neo4JConnector(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD)
+    connector.create_constraints()
+    usable = connector.check_constraints()
     connector.close()
+    if not usable:
+        raise SystemExit(1)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Load the extracted metadata into Neo4j.')
+    parser.add_argument('--check-schema', action='store_true', help='Create the constraints and check that every MERGE uses an index, then exit.')
+    parser.add_argument('--ttl', action='store_true', help='Load the rdf_output.ttl files of outputs/ and threads/ instead of running the JSON extraction.')
+    parser.add_argument('--force', action='store_true', help='Load every input, even those unchanged since they were last loaded.')
+    args = parser.parse_args()
+    if args.check_schema:
+        check_schema()
+    elif args.ttl:
+        load_ttl()
+    else:
+        main(force=args.force)
@@ -0,0 +1,271 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+from dotenv import load_dotenv, find_dotenv
+
+import retrieve_emails
+from gmail_fetch import GmailFetcher
+from json_preprocessing import (
+    JSON_MODE,
+    PROMPT_FILES,
+    extract_document,
+    load_prompts,
+    save_document,
+)
+from llm_cache import LLMCache
+from llm_engine import create_engine
+from manifest import Manifest, processing_version
+from ocr import OCR_MODEL_VERSION
+from ocr_cache import OCRCache
+from ocr_executor import OCRExecutor
+from staged_pipeline import (
+    OCR_EXTENSIONS,
+    OCR_WORKERS,
+    TEXT_EXTENSIONS,
+    StagedPipeline,
+    scan_folder,
+    walk_corpus,
+)
+
+load_dotenv(find_dotenv())
+
+# Constants
+POLL_INTERVAL = float(os.getenv("DAEMON_POLL_INTERVAL", "10"))  # Seconds
+INPUT_EXTENSIONS = TEXT_EXTENSIONS + OCR_EXTENSIONS
+
+
+def email_files(email_folders):
+    """Yields (file path, email processing) for the input files of email folders."""
+    for folder in email_folders:
+        for entry in scan_folder(folder):
+            if entry.is_file() and entry.name.endswith(INPUT_EXTENSIONS):
+                yield entry.path, True
+
+
+def arrival_time(email_folder):
+    """Returns the timestamp Gmail received an email at, from its metadata.json."""
+    metadata_file = os.path.join(email_folder, "metadata.json")
+    try:
+        with open(metadata_file, "r") as f:
+            internal_date = json.load(f)["internalDate"]
+    except (OSError, KeyError, json.JSONDecodeError):
+        return None
+    return datetime.strptime(internal_date, "%Y-%m-%d %H:%M:%S").timestamp()
+
+
+class Daemon:
+    """Keeps the Gmail service, OCR workers, LLM client and Neo4j driver warm.
+
+    Every poll reads the mailbox history since the last one, saves the new
+    emails, then extracts and loads them into the graph before the next poll.
+    """
+
+    def __init__(self, graph=True, poll_interval=POLL_INTERVAL):
+        self.graph = graph
+        self.poll_interval = poll_interval
+        self.completed_at = {}  # Email folder: time its last document was loaded
+
+    def start(self):
+        # langchain is only imported by the commands calling a model
+        from langchain_openai import ChatOpenAI
+
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY environment variable not set")
+
+        started_at = time.monotonic()
+        service = retrieve_emails.get_service()
+        self.fetcher = GmailFetcher(service, retrieve_emails.creds)
+        self.threads_metadata = retrieve_emails.load_threads_metadata()
+        self.sync_state = retrieve_emails.load_sync_state()
+        print(f"Gmail service ready in {time.monotonic() - started_at:.1f}s.")
+
+        started_at = time.monotonic()
+        # The workers keep their weights in memory for as long as the daemon runs
+        self.ocr_executor = OCRExecutor(workers=OCR_WORKERS)
+        self.ocr_executor.warm_up()
+        self.ocr_cache = OCRCache()
+        print(
+            f"{self.ocr_executor.workers} OCR workers ready in "
+            f"{time.monotonic() - started_at:.1f}s."
+        )
+
+        model = ChatOpenAI(
+            api_key=api_key, model="gpt-3.5-turbo", model_kwargs=JSON_MODE
+        )
+        self.llm_cache = LLMCache()
+        self.llm_cache.invalidate_if_changed("json", PROMPT_FILES)
+        self.engine = create_engine(model, cache=self.llm_cache, namespace="json")
+        self.prompts = load_prompts()
+        # Shared with json_preprocessing.py, neither processes an email twice
+        version = processing_version(
+            model.model_name, OCR_MODEL_VERSION, prompt_files=PROMPT_FILES
+        )
+        self.manifest = Manifest("json", version)
+
+        self.connector = None
+        self.loader = None
+        if self.graph:
+            import create_graph
+
+            started_at = time.monotonic()
+            self.connector = create_graph.Neo4JConnector(
+                create_graph.NEO4J_URI,
+                create_graph.NEO4J_USER,
+                create_graph.NEO4J_PASSWORD,
+            )
+            self.connector.create_constraints()
+            self.loader = create_graph.GraphLoader(
+                self.connector, entity_index=create_graph.EntityIndex.load()
+            )
+            print(f"Neo4j driver ready in {time.monotonic() - started_at:.1f}s.")
+
+    def close(self):
+        self.fetcher.close()
+        self.ocr_executor.close()
+        self.ocr_cache.close()
+        self.llm_cache.close()
+        self.manifest.close()
+        if self.connector is not None:
+            self.loader.summary()
+            self.connector.close()
+
+    async def serve(self, once=False):
+        # The LLM client and the engine's rate limiters live on this one loop
+        self.engine.start()
+        if not self.sync_state.get("historyId"):
+            self.sync_state["historyId"] = await asyncio.to_thread(
+                retrieve_emails.get_current_history_id
+            )
+            retrieve_emails.save_sync_state(self.sync_state)
+        print(f"Watching the mailbox every {self.poll_interval:.0f}s.")
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                # A failed poll is retried by the next one, from the same history id
+                # and the saved threads, so its new emails are fetched again
+                print(f"Poll failed: {e}")
+                self.threads_metadata = retrieve_emails.load_threads_metadata()
+            if once:
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    async def poll(self):
+        detected_at = time.time()
+        history, history_id = await asyncio.to_thread(
+            retrieve_emails.get_history, self.sync_state["historyId"]
+        )
+        if history is None:
+            # The history expired, resync the latest threads and process whatever
+            # the manifest has not seen
+            history_id = await asyncio.to_thread(
+                retrieve_emails.full_sync, self.threads_metadata, self.fetcher
+            )
+            email_folders = None
+            files = walk_corpus(extensions=INPUT_EXTENSIONS)
+        else:
+            email_folders = await asyncio.to_thread(
+                retrieve_emails.apply_history,
+                history,
+                self.threads_metadata,
+                self.fetcher,
+            )
+            files = email_files(email_folders)
+
+        if email_folders == []:
+            # Nothing new since the last poll
+            await self.commit_history(history_id)
+            return
+
+        pipeline = StagedPipeline(
+            extract=lambda document: extract_document(
+                self.engine, document, *self.prompts
+            ),
+            write=self.write,
+            engine=self.engine,
+            ocr_cache=self.ocr_cache,
+            ocr_executor=self.ocr_executor,
+            manifest=self.manifest,
+            documents_output_dir="./outputs",
+        )
+        results = await pipeline.arun(files)
+        # Saved only once extracted, a crash before that replays the same history
+        await self.commit_history(history_id)
+        if email_folders is not None:
+            self.report(email_folders, detected_at)
+        self.completed_at.clear()
+        failed = sum(1 for _, _, error in results if error is not None)
+        if failed:
+            # Left out of the manifest, json_preprocessing.py processes them again
+            print(f"{failed} documents failed.")
+
+    async def commit_history(self, history_id):
+        if history_id != self.sync_state["historyId"]:
+            await asyncio.to_thread(self.save_state, history_id)
+
+    def save_state(self, history_id):
+        retrieve_emails.save_threads_metadata(self.threads_metadata)
+        retrieve_emails.attachment_store.save()
+        self.sync_state["historyId"] = history_id
+        self.sync_state["synced_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        retrieve_emails.save_sync_state(self.sync_state)
+
+    def write(self, document, json_output):
+        save_document(document, json_output)
+        if self.loader is not None:
+            # Loaded right away, a resident service is measured per message
+            self.loader.add(json_output)
+            self.loader.flush()
+        self.completed_at[document["folder_path"]] = time.time()
+
+    def report(self, email_folders, detected_at):
+        """Prints how long every new email took, from its detection and its arrival."""
+        for folder in email_folders:
+            completed_at = self.completed_at.get(folder)
+            name = os.path.basename(folder)
+            if completed_at is None:
+                print(f"{name}: nothing extracted.")
+                continue
+            arrived_at = arrival_time(folder)
+            message = f"{name}: processed in {completed_at - detected_at:.1f}s"
+            if arrived_at is not None:
+                message += f", {completed_at - arrived_at:.1f}s after it arrived"
+            print(message + ".")
+
+
+def main(graph=True, poll_interval=POLL_INTERVAL, once=False):
+    daemon = Daemon(graph=graph, poll_interval=poll_interval)
+    daemon.start()
+    try:
+        asyncio.run(daemon.serve(once=once))
+    except KeyboardInterrupt:
+        print("Stopping.")
+    finally:
+        daemon.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Retrieve, OCR, extract and load new emails as they arrive."
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=POLL_INTERVAL,
+        help="Seconds between two reads of the mailbox history.",
+    )
+    parser.add_argument(
+        "--no-graph",
+        action="store_true",
+        help="Only save the JSON outputs, without loading them into Neo4j.",
+    )
+    parser.add_argument(
+        "--once", action="store_true", help="Poll the mailbox once, then exit."
+    )
+    args = parser.parse_args()
+    main(graph=not args.no_graph, poll_interval=args.interval, once=args.once)
@@ -0,0 +1,357 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from email.utils import getaddresses
+
+from graph_export import JSON_OUTPUT_FILE, SOURCE_FOLDERS, iter_output_files
+
+# Constants
+DOCUMENT_STORE_PATH = "documents.sqlite"
+DATE_FORMATS = ["%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d"]
+EMAIL_PATTERN = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+QUERY_COLUMNS = [
+    "output_path",
+    "document_name",
+    "document_type",
+    "date",
+    "sender",
+    "company",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    output_path TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    document_name TEXT,
+    document_type TEXT COLLATE NOCASE,
+    date TEXT,
+    sender TEXT COLLATE NOCASE,
+    company TEXT COLLATE NOCASE,
+    data TEXT NOT NULL,
+    indexed_at REAL NOT NULL,
+    UNIQUE (output_path, position)
+);
+CREATE INDEX IF NOT EXISTS documents_type_date ON documents (document_type, date);
+CREATE INDEX IF NOT EXISTS documents_date ON documents (date);
+CREATE INDEX IF NOT EXISTS documents_sender ON documents (sender);
+CREATE INDEX IF NOT EXISTS documents_company_date ON documents (company, date);
+CREATE TABLE IF NOT EXISTS document_emails (
+    email TEXT NOT NULL COLLATE NOCASE,
+    document_id INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    PRIMARY KEY (email, document_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS document_emails_document ON document_emails (document_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5 (
+    document_name, content, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def normalize_date(value):
+    """Returns a date as YYYY-MM-DD, so that date ranges compare as text."""
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    match = re.search(r"\d{4}-\d{2}-\d{2}", value)
+    return match.group() if match else None
+
+
+def entity_name(entity):
+    if isinstance(entity, dict):
+        entity = entity.get("name")
+    if isinstance(entity, str) and entity.strip():
+        return entity.strip()
+    return None
+
+
+def iter_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from iter_strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_strings(item)
+
+
+def email_header(output_path):
+    """Returns the From header of the email an email output belongs to, if any."""
+    email_folder = os.path.dirname(os.path.dirname(output_path))
+    try:
+        with open(os.path.join(email_folder, "metadata.json"), "r") as f:
+            return json.load(f).get("headers", {}).get("From")
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def document_row(entry):
+    """Returns the indexed columns of an extracted document."""
+    return {
+        "document_name": entity_name(entry.get("document_name")),
+        "document_type": str(entry.get("document_type") or "").strip().lower() or None,
+        "date": normalize_date(entry.get("date")),
+        "sender": entity_name(entry.get("sender")),
+        "company": entity_name(entry.get("company")),
+    }
+
+
+class DocumentStore:
+    """SQLite index of the extracted JSON outputs, queried by column or full text.
+
+    Every document keeps its whole JSON output in the data column, next to the
+    indexed columns the queries filter on. The connection is opened on first
+    use, so that the commands never writing JSON outputs do not create the file.
+    """
+
+    def __init__(self, path=DOCUMENT_STORE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA foreign_keys = ON")
+            self.connection.execute("PRAGMA journal_mode = WAL")
+            # With WAL, a crash can only lose the last commits, never corrupt
+            self.connection.execute("PRAGMA synchronous = NORMAL")
+            self.connection.executescript(SCHEMA)
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def put(self, output_path, json_output, emails=()):
+        """Indexes the documents of a JSON output, replacing the previous ones."""
+        output_path = os.path.normpath(output_path)
+        entries = json_output if isinstance(json_output, list) else [json_output]
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                self.delete_rows(connection, output_path)
+                for position, entry in enumerate(entries):
+                    if isinstance(entry, dict):
+                        self.insert_row(
+                            connection, output_path, position, entry, emails
+                        )
+
+    def delete_rows(self, connection, output_path):
+        ids = [
+            row[0]
+            for row in connection.execute(
+                "SELECT id FROM documents WHERE output_path = ?", (output_path,)
+            )
+        ]
+        connection.executemany(
+            "DELETE FROM documents_fts WHERE rowid = ?", [(id,) for id in ids]
+        )
+        connection.execute(
+            "DELETE FROM documents WHERE output_path = ?", (output_path,)
+        )
+
+    def insert_row(self, connection, output_path, position, entry, emails):
+        row = document_row(entry)
+        cursor = connection.execute(
+            "INSERT INTO documents (output_path, position, document_name, "
+            "document_type, date, sender, company, data, indexed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                output_path,
+                position,
+                row["document_name"],
+                row["document_type"],
+                row["date"],
+                row["sender"],
+                row["company"],
+                json.dumps(entry, ensure_ascii=False),
+                time.time(),
+            ),
+        )
+        document_id = cursor.lastrowid
+        strings = list(iter_strings(entry))
+        addresses = {
+            email.lower()
+            for text in strings + list(emails)
+            for email in EMAIL_PATTERN.findall(text)
+        }
+        connection.executemany(
+            "INSERT OR IGNORE INTO document_emails (email, document_id) VALUES (?, ?)",
+            [(email, document_id) for email in sorted(addresses)],
+        )
+        connection.execute(
+            "INSERT INTO documents_fts (rowid, document_name, content) "
+            "VALUES (?, ?, ?)",
+            (document_id, row["document_name"] or "", "\n".join(strings)),
+        )
+
+    def index_file(self, output_path, json_output=None):
+        """Indexes a json_output.json file, read from disk unless given."""
+        if json_output is None:
+            with open(output_path, "r", encoding="UTF-8") as f:
+                json_output = json.load(f)
+        # Email outputs also match on the addresses of their From header
+        sender = email_header(output_path)
+        emails = [email for _, email in getaddresses([sender])] if sender else []
+        self.put(output_path, json_output, emails)
+
+    def query(
+        self,
+        document_type=None,
+        sender=None,
+        company=None,
+        email=None,
+        date_from=None,
+        date_to=None,
+        text=None,
+        limit=100,
+        with_data=False,
+    ):
+        """Returns the documents matching every given filter, latest first.
+
+        Names and types match case-insensitively, dates are YYYY-MM-DD bounds
+        (inclusive) and text is an FTS5 query over every value of the document.
+        """
+        columns = ", ".join(f"d.{column}" for column in QUERY_COLUMNS)
+        if with_data:
+            columns += ", d.data"
+        sql = [f"SELECT {columns} FROM documents d"]
+        conditions = []
+        parameters = []
+        if email:
+            sql.append("JOIN document_emails e ON e.document_id = d.id")
+            conditions.append("e.email = ?")
+            parameters.append(email)
+        if text:
+            sql.append("JOIN documents_fts ON documents_fts.rowid = d.id")
+            conditions.append("documents_fts MATCH ?")
+            parameters.append(text)
+        for column, value in [
+            ("document_type", document_type),
+            ("sender", sender),
+            ("company", company),
+        ]:
+            if value:
+                conditions.append(f"d.{column} = ?")
+                parameters.append(value)
+        if date_from:
+            conditions.append("d.date >= ?")
+            parameters.append(date_from)
+        if date_to:
+            conditions.append("d.date <= ?")
+            parameters.append(date_to)
+        if conditions:
+            sql.append("WHERE " + " AND ".join(conditions))
+        sql.append("ORDER BY d.date DESC LIMIT ?")
+        parameters.append(limit)
+
+        keys = QUERY_COLUMNS + (["data"] if with_data else [])
+        with self.lock:
+            rows = self.connect().execute(" ".join(sql), parameters).fetchall()
+        documents = [dict(zip(keys, row)) for row in rows]
+        for document in documents:
+            if with_data:
+                document["data"] = json.loads(document["data"])
+        return documents
+
+    def stats(self):
+        """Returns the number of documents per type."""
+        with self.lock:
+            return self.connect().execute(
+                "SELECT COALESCE(document_type, ''), COUNT(*) FROM documents "
+                "GROUP BY 1 ORDER BY 2 DESC"
+            ).fetchall()
+
+
+def index_outputs(store, folders=SOURCE_FOLDERS):
+    """Indexes the JSON outputs on disk, e.g. those written before the store existed."""
+    started_at = time.monotonic()
+    files = 0
+    for output_path in iter_output_files(folders, (JSON_OUTPUT_FILE,)):
+        try:
+            store.index_file(output_path)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Skipping {output_path}: {e}")
+            continue
+        files += 1
+    print(f"Indexed {files} JSON outputs in {time.monotonic() - started_at:.1f}s.")
+
+
+def print_documents(documents):
+    columns = ["date", "document_type", "document_name", "sender", "company"]
+    for document in documents:
+        print(" | ".join(str(document[column] or "-") for column in columns))
+        print(f"    {document['output_path']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index and query the JSON outputs.")
+    parser.add_argument("--store", default=DOCUMENT_STORE_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = commands.add_parser("index", help="Index the outputs on disk.")
+    index_parser.add_argument("folders", nargs="*", default=SOURCE_FOLDERS)
+
+    query_parser = commands.add_parser("query", help="Query the indexed documents.")
+    query_parser.add_argument("--type", dest="document_type")
+    query_parser.add_argument("--sender")
+    query_parser.add_argument("--company")
+    query_parser.add_argument("--email")
+    query_parser.add_argument("--year", type=int, help="Documents dated that year.")
+    query_parser.add_argument("--from", dest="date_from", help="First date, inclusive.")
+    query_parser.add_argument("--to", dest="date_to", help="Last date, inclusive.")
+    query_parser.add_argument("--text", help='Full-text query, e.g. "loyer OR bail".')
+    query_parser.add_argument("--limit", type=int, default=100)
+    query_parser.add_argument(
+        "--json", action="store_true", help="Print the whole JSON outputs."
+    )
+
+    commands.add_parser("stats", help="Count the indexed documents per type.")
+    args = parser.parse_args()
+
+    store = DocumentStore(args.store)
+    if args.command == "index":
+        index_outputs(store, args.folders)
+    elif args.command == "query":
+        date_from, date_to = args.date_from, args.date_to
+        if args.year:
+            date_from, date_to = f"{args.year}-01-01", f"{args.year}-12-31"
+        started_at = time.perf_counter()
+        documents = store.query(
+            document_type=args.document_type,
+            sender=args.sender,
+            company=args.company,
+            email=args.email,
+            date_from=date_from,
+            date_to=date_to,
+            text=args.text,
+            limit=args.limit,
+            with_data=args.json,
+        )
+        elapsed = time.perf_counter() - started_at
+        if args.json:
+            print(json.dumps(documents, ensure_ascii=False, indent=4))
+        else:
+            print_documents(documents)
+        print(f"{len(documents)} documents in {elapsed * 1000:.1f} ms.")
+    else:
+        for document_type, count in store.stats():
+            print(f"{document_type or '(no type)'}: {count}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
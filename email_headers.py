@@ -0,0 +1,10 @@
+import re
+
+# Helpers over the headers of the saved emails, without the Gmail client, so
+# that the offline stages can import them
+
+
+def extract_sender_email(header_from):
+    """Returns the address of a From header, e.g. "Name <a@b.ch>" gives "a@b.ch"."""
+    match = re.search(r"<(.+?)>", header_from)
+    return match.group(1) if match else header_from
@@ -0,0 +1,362 @@
+import json
+import os
+import re
+import time
+from collections import Counter
+
+from rapidfuzz import fuzz
+from unidecode import unidecode
+
+from graph_export import SOURCE_FOLDERS, JSON_OUTPUT_FILE, iter_output_files, stable_id
+from email_headers import extract_sender_email
+
+# Constants
+ENTITY_INDEX_FILE_PATH = "entity_index.json"
+ENTITY_KEYS = ["sender", "company"]  # Keys of the JSON outputs holding entities
+NAME_THRESHOLD = 90  # rapidfuzz score above which two names are the same entity
+# Fuzzy blocks larger than this come from tokens too common to tell entities
+# apart, comparing all their pairs would make the stage quadratic
+MAX_BLOCK_SIZE = 200
+# Legal forms and short words that do not identify an entity
+STOP_TOKENS = set(
+    "sa sarl ag gmbh ltd llc inc sas srl co cie and et de du des la le les the of"
+    .split()
+)
+FREE_MAIL_DOMAINS = set(
+    """
+    gmail.com googlemail.com hotmail.com hotmail.ch outlook.com live.com yahoo.com
+    yahoo.fr icloud.com me.com gmx.ch gmx.net bluewin.ch protonmail.com proton.me
+    """.split()
+)
+
+
+def name_tokens(name):
+    tokens = re.findall(r"[a-z0-9]+", unidecode(name).lower())
+    return [token for token in tokens if token not in STOP_TOKENS]
+
+
+def normalize_email(value):
+    email = extract_sender_email(value or "").strip().lower()
+    return email if re.fullmatch(r"[^@\s]+@[^@\s]+\.[a-z]+", email) else None
+
+
+def normalize_phone(value):
+    """Returns the last 9 digits of a phone number, the same with any prefix."""
+    digits = re.sub(r"\D", "", value or "")
+    return digits[-9:] if len(digits) >= 9 else None
+
+
+def company_domain(email):
+    """Returns the domain of an email address, unless it is a free mail provider."""
+    if not email:
+        return None
+    domain = email.split("@", 1)[1]
+    return None if domain in FREE_MAIL_DOMAINS else domain
+
+
+def domain_tokens(domain):
+    # "mail.todan-relocation.ch" names the entity with "todan-relocation"
+    labels = domain.split(".")
+    return name_tokens(labels[-2] if len(labels) > 1 else labels[0])
+
+
+class Mention:
+    """An entity as it appears in one document."""
+
+    def __init__(self, label, name, email=None, phone=None, document=None):
+        self.label = label
+        self.name = (name or "").strip()
+        self.email = normalize_email(email)
+        if "@" in self.name:
+            # The name is an email address, "info@todan.ch" names no one
+            self.email = self.email or normalize_email(self.name)
+            self.name = ""
+        self.phone = normalize_phone(phone)
+        self.document = document
+        self.key = " ".join(name_tokens(self.name))
+        self.domain = company_domain(self.email)
+
+    def blocking_keys(self):
+        """Returns (exact keys, fuzzy keys) of the blocks the mention belongs to."""
+        exact = []
+        if self.key:
+            exact.append("name:" + self.key)
+        if self.email:
+            exact.append("email:" + self.email)
+        if self.phone:
+            exact.append("phone:" + self.phone)
+        tokens = self.key.split()
+        if self.domain:
+            tokens += domain_tokens(self.domain)
+        fuzzy = [f"token:{token}" for token in set(tokens) if len(token) > 2]
+        if self.domain:
+            fuzzy.append("domain:" + self.domain)
+        return exact, fuzzy
+
+
+def same_entity(a, b):
+    """Returns whether two mentions with a name are the same entity."""
+    if a.domain and a.domain == b.domain:
+        # On one domain, a name may leave words out: "Todan" for "Todan Relocation"
+        return fuzz.token_set_ratio(a.key, b.key) >= NAME_THRESHOLD
+    return fuzz.token_sort_ratio(a.key, b.key) >= NAME_THRESHOLD
+
+
+def attachment_score(unnamed, named):
+    """Returns how strongly a mention without a name points to a named one, 0 if not.
+
+    The same address or phone number is the strongest sign. Otherwise the
+    domain of the address points to the entity it is named after, and less so
+    to the people writing from it.
+    """
+    if (unnamed.email and unnamed.email == named.email) or (
+        unnamed.phone and unnamed.phone == named.phone
+    ):
+        return 4
+    if not unnamed.domain:
+        return 0
+    stem = " ".join(domain_tokens(unnamed.domain))
+    named_after = fuzz.token_set_ratio(named.key, stem) >= NAME_THRESHOLD
+    return 2 * named_after + (unnamed.domain == named.domain)
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parents = list(range(size))
+
+    def find(self, index):
+        while self.parents[index] != index:
+            self.parents[index] = self.parents[self.parents[index]]
+            index = self.parents[index]
+        return index
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parents[max(a, b)] = min(a, b)
+
+
+def resolve(mentions):
+    """Groups the mentions of the same entity, returns a list of clusters.
+
+    Mentions are only compared within blocks. Named mentions sharing a name, an
+    email address or a phone number are merged right away, those sharing a name
+    token or an email domain are compared with rapidfuzz, and blocks of common
+    tokens are skipped. Mentions without a name are then grouped by address and
+    each group joins at most one named entity, the one it points to the most,
+    so that an address never links two named entities together.
+    """
+    exact_blocks = {}
+    fuzzy_blocks = {}
+    for index, mention in enumerate(mentions):
+        exact, fuzzy = mention.blocking_keys()
+        for key in exact:
+            exact_blocks.setdefault(key, []).append(index)
+        for key in fuzzy:
+            fuzzy_blocks.setdefault(key, []).append(index)
+
+    clusters = UnionFind(len(mentions))
+    for members in exact_blocks.values():
+        named = [index for index in members if mentions[index].key]
+        unnamed = [index for index in members if not mentions[index].key]
+        for group in (named, unnamed):
+            for index in group[1:]:
+                clusters.union(group[0], index)
+
+    compared = set()
+    skipped = 0
+    for members in fuzzy_blocks.values():
+        named = [index for index in members if mentions[index].key]
+        if len(named) > MAX_BLOCK_SIZE:
+            skipped += 1
+            continue
+        for position, a in enumerate(named):
+            for b in named[position + 1 :]:
+                if (a, b) in compared or clusters.find(a) == clusters.find(b):
+                    continue
+                compared.add((a, b))
+                if same_entity(mentions[a], mentions[b]):
+                    clusters.union(a, b)
+
+    attached = attach_unnamed(mentions, clusters, exact_blocks, fuzzy_blocks)
+    print(
+        f"{len(compared)} comparisons for {len(mentions)} mentions, "
+        f"{skipped} oversized blocks skipped, {attached} addresses attached."
+    )
+
+    groups = {}
+    for index in range(len(mentions)):
+        groups.setdefault(clusters.find(index), []).append(mentions[index])
+    return list(groups.values())
+
+
+def attach_unnamed(mentions, clusters, exact_blocks, fuzzy_blocks):
+    """Joins each group of mentions without a name to its best named cluster.
+
+    Named clusters are final at this point, a group is only attached when a
+    single cluster has its best score. Returns the number of groups attached.
+    """
+    groups = {}
+    for index, mention in enumerate(mentions):
+        if not mention.key:
+            groups.setdefault(clusters.find(index), []).append(index)
+
+    attached = 0
+    for root, members in groups.items():
+        scores = {}  # Named cluster: best score of the group for it
+        for index in members:
+            exact, fuzzy = mentions[index].blocking_keys()
+            blocks = [exact_blocks[key] for key in exact] + [
+                fuzzy_blocks[key]
+                for key in fuzzy
+                if len(fuzzy_blocks[key]) <= MAX_BLOCK_SIZE
+            ]
+            for block in blocks:
+                for other in block:
+                    if not mentions[other].key:
+                        continue
+                    score = attachment_score(mentions[index], mentions[other])
+                    cluster = clusters.find(other)
+                    scores[cluster] = max(scores.get(cluster, 0), score)
+        best = max(scores.values(), default=0)
+        candidates = [cluster for cluster, score in scores.items() if score == best]
+        if best and len(candidates) == 1:
+            clusters.union(candidates[0], root)
+            attached += 1
+    return attached
+
+
+def canonical_name(mentions):
+    """Returns the most frequent spelling, the longest one on a tie, or the email."""
+    names = Counter(mention.name for mention in mentions if mention.key)
+    if names:
+        return max(names, key=lambda name: (names[name], len(name)))
+    return min(mention.email for mention in mentions if mention.email)
+
+
+def cluster_id(mentions):
+    name = canonical_name(mentions)
+    return stable_id("Entity", " ".join(name_tokens(name)) or name)
+
+
+class EntityIndex:
+    """Canonical entities, looked up by normalized name or email address."""
+
+    def __init__(self, entities=None, aliases=None):
+        self.entities = entities or {}
+        self.aliases = aliases or {}
+
+    @classmethod
+    def from_clusters(cls, clusters):
+        # Clusters whose canonical names normalize alike are one entity
+        by_id = {}
+        for cluster in clusters:
+            by_id.setdefault(cluster_id(cluster), []).extend(cluster)
+
+        index = cls()
+        for entity_id, mentions in by_id.items():
+            names = Counter(mention.name for mention in mentions if mention.key)
+            index.entities[entity_id] = {
+                "name": canonical_name(mentions),
+                "labels": sorted({mention.label for mention in mentions}),
+                "aliases": sorted(names),
+                "emails": sorted({m.email for m in mentions if m.email}),
+                "phones": sorted({m.phone for m in mentions if m.phone}),
+                "documents": len({m.document for m in mentions}),
+            }
+            for mention in mentions:
+                if mention.key:
+                    index.aliases["name:" + mention.key] = entity_id
+                if mention.email:
+                    index.aliases["email:" + mention.email] = entity_id
+        return index
+
+    @classmethod
+    def load(cls, path=ENTITY_INDEX_FILE_PATH):
+        """Returns the saved index, or None if the resolution stage never ran."""
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="UTF-8") as f:
+            data = json.load(f)
+        return cls(data["entities"], data["aliases"])
+
+    def save(self, path=ENTITY_INDEX_FILE_PATH):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="UTF-8") as f:
+            json.dump(
+                {"entities": self.entities, "aliases": self.aliases},
+                f,
+                ensure_ascii=False,
+                indent=4,
+            )
+        os.replace(tmp_path, path)
+
+    def lookup(self, name, email=None):
+        """Returns (canonical id, canonical name), or (None, name) if unknown."""
+        mention = Mention(None, name, email)
+        for key in ("name:" + mention.key, "email:" + (mention.email or "")):
+            entity_id = self.aliases.get(key)
+            if entity_id is not None:
+                return entity_id, self.entities[entity_id]["name"]
+        return None, name
+
+
+def email_sender(file_path):
+    """Returns the From header of the email an output folder belongs to, if any."""
+    email_folder = os.path.dirname(os.path.dirname(file_path))
+    metadata_file = os.path.join(email_folder, "metadata.json")
+    if not os.path.exists(metadata_file):
+        return None
+    with open(metadata_file, "r") as f:
+        return json.load(f).get("headers", {}).get("From")
+
+
+def collect_mentions(folders=SOURCE_FOLDERS):
+    mentions = []
+    for file_path in iter_output_files(folders, (JSON_OUTPUT_FILE,)):
+        try:
+            with open(file_path, "r", encoding="UTF-8") as f:
+                data = json.load(f)
+        except json.JSONDecodeError:
+            continue
+        sender_header = email_sender(file_path)
+        for entry in data if isinstance(data, list) else [data]:
+            if not isinstance(entry, dict):
+                continue
+            document = entry.get("document_name") or file_path
+            for key in ENTITY_KEYS:
+                entity = entry.get(key)
+                if not isinstance(entity, dict):
+                    continue
+                email = entity.get("email")
+                # The sender of an email is the author of its From header
+                if key == "sender" and sender_header and not normalize_email(email):
+                    email = sender_header
+                mentions.append(
+                    Mention(
+                        key.capitalize(),
+                        entity.get("name"),
+                        email,
+                        entity.get("phone_number"),
+                        document,
+                    )
+                )
+    return [mention for mention in mentions if mention.key or mention.email]
+
+
+def main(folders=SOURCE_FOLDERS):
+    started_at = time.monotonic()
+    mentions = collect_mentions(folders)
+    clusters = resolve(mentions)
+    index = EntityIndex.from_clusters(clusters)
+    index.save()
+    merged = sum(1 for cluster in clusters if len(cluster) > 1)
+    print(
+        f"{len(mentions)} mentions resolved to {len(index.entities)} entities "
+        f"({merged} merged) in {time.monotonic() - started_at:.1f}s, "
+        f"saved to {ENTITY_INDEX_FILE_PATH}."
+    )
+
+
+if __name__ == "__main__":
+    main()
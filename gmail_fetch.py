@@ -0,0 +1,249 @@
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from google.auth.transport.requests import AuthorizedSession
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
+
+from attachment_store import DEFAULT_CHUNK_SIZE, iter_base64_field
+
+# Gmail quota units per call, see https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "threads": 10,
+    "messages": 5,
+    "attachments": 5,
+}
+DEFAULT_QUOTA_PER_SECOND = 250  # Per-user limit of the Gmail API
+DEFAULT_BATCH_SIZE = 50  # Gmail recommends at most 50 requests per batch
+DEFAULT_WORKERS = 4
+MAX_RETRIES = 5
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Gmail answers per-user rate limits with a 403 carrying one of these reasons
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1"
+
+
+def error_reasons(content):
+    """Returns the reasons listed in a Gmail error body."""
+    try:
+        errors = json.loads(content)["error"].get("errors", [])
+        return {error.get("reason") for error in errors}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+
+
+def is_retryable(status, content):
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and not RATE_LIMIT_REASONS.isdisjoint(error_reasons(content))
+
+
+class TokenBucket:
+    """Blocks callers so that at most `rate` units are spent per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount):
+        # A call costing more than the capacity (a batch of 50 threads.get is 500
+        # units) waits for a full bucket, then leaves it in debt by the rest, so
+        # the next callers wait until the whole cost has been paid back
+        needed = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= needed:
+                    self.tokens -= amount
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GmailFetcher:
+    """Fetches Gmail resources through HTTP batch requests on a worker pool."""
+
+    def __init__(
+        self,
+        service,
+        creds,
+        workers=DEFAULT_WORKERS,
+        batch_size=DEFAULT_BATCH_SIZE,
+        quota_per_second=DEFAULT_QUOTA_PER_SECOND,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        user_id="me",
+    ):
+        self.service = service
+        self.creds = creds
+        self.workers = workers
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.user_id = user_id
+        self.bucket = TokenBucket(quota_per_second)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.local = threading.local()
+        self.stats_lock = threading.Lock()
+        self.stats = {"threads": 0, "messages": 0, "attachments": 0, "retries": 0}
+        self.started_at = time.monotonic()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def _http(self):
+        # httplib2 is not thread-safe, every worker gets its own connection
+        if not hasattr(self.local, "http"):
+            self.local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return self.local.http
+
+    def _session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = AuthorizedSession(self.creds)
+        return self.local.session
+
+    def _count(self, kind, amount):
+        with self.stats_lock:
+            self.stats[kind] += amount
+
+    def _execute_batch(self, kind, keys, make_request):
+        results = {}
+        pending = list(keys)
+
+        for attempt in range(MAX_RETRIES + 1):
+            retry = []
+
+            def callback(request_id, response, exception):
+                key = pending[int(request_id)]
+                if exception is None:
+                    results[key] = response
+                elif isinstance(exception, HttpError) and is_retryable(
+                    exception.resp.status, exception.content
+                ):
+                    retry.append(key)
+                else:
+                    print(f"An error occurred fetching {kind} {key}: {exception}")
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for index, key in enumerate(pending):
+                batch.add(make_request(key), request_id=str(index))
+
+            self.bucket.acquire(QUOTA_UNITS[kind] * len(pending))
+            try:
+                batch.execute(http=self._http())
+            except HttpError as error:
+                if not is_retryable(error.resp.status, error.content):
+                    print(f"An error occurred fetching {kind}: {error}")
+                    break
+                retry = [key for key in pending if key not in results]
+
+            if not retry:
+                break
+            pending = retry
+            self._count("retries", len(retry))
+            if attempt < MAX_RETRIES:
+                # Exponential backoff with jitter, as advised for rate limits and 5xx answers
+                time.sleep(min(2**attempt, 32) + random.random())
+        else:
+            print(f"Giving up on {len(pending)} {kind} after {MAX_RETRIES} retries.")
+
+        self._count(kind, len(results))
+        return results
+
+    def _fetch(self, kind, keys, make_request):
+        keys = list(dict.fromkeys(keys))
+        chunks = [
+            keys[i : i + self.batch_size] for i in range(0, len(keys), self.batch_size)
+        ]
+        if len(chunks) <= 1:
+            # Small requests run inline, which also keeps nested calls off the pool
+            return self._execute_batch(kind, keys, make_request) if keys else {}
+
+        results = {}
+        futures = [
+            self.executor.submit(self._execute_batch, kind, chunk, make_request)
+            for chunk in chunks
+        ]
+        for future in futures:
+            results.update(future.result())
+        return results
+
+    def get_threads(self, thread_ids):
+        """Returns a dict mapping thread id to the full thread resource."""
+        return self._fetch(
+            "threads",
+            thread_ids,
+            lambda thread_id: self.service.users()
+            .threads()
+            .get(userId=self.user_id, id=thread_id),
+        )
+
+    def get_messages(self, message_ids):
+        """Returns a dict mapping message id to the full message resource."""
+        return self._fetch(
+            "messages",
+            message_ids,
+            lambda message_id: self.service.users()
+            .messages()
+            .get(userId=self.user_id, id=message_id, format="full"),
+        )
+
+    def get_attachments(self, keys):
+        """Returns a dict mapping (message id, attachment id) to the attachment."""
+        return self._fetch(
+            "attachments",
+            keys,
+            lambda key: self.service.users()
+            .messages()
+            .attachments()
+            .get(userId=self.user_id, messageId=key[0], id=key[1]),
+        )
+
+    def stream_attachment(self, key):
+        """Yields the decoded bytes of an attachment, chunk_size bytes at a time.
+
+        Large attachments bypass the batch endpoint, which would buffer the whole
+        base64 payload, and are decoded while the response is being read.
+        """
+        message_id, attachment_id = key
+        url = (
+            f"{GMAIL_API_URL}/users/{self.user_id}/messages/{message_id}"
+            f"/attachments/{attachment_id}"
+        )
+        for attempt in range(MAX_RETRIES + 1):
+            self.bucket.acquire(QUOTA_UNITS["attachments"])
+            response = self._session().get(url, stream=True)
+            # Only an error body is read here, a success is streamed below
+            retryable = response.status_code >= 400 and is_retryable(
+                response.status_code, response.content
+            )
+            if not retryable or attempt == MAX_RETRIES:
+                break
+            response.close()
+            self._count("retries", 1)
+            time.sleep(min(2**attempt, 32) + random.random())
+
+        with response:
+            response.raise_for_status()
+            yield from iter_base64_field(
+                response.iter_content(chunk_size=self.chunk_size)
+            )
+        self._count("attachments", 1)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        threads_per_second = self.stats["threads"] / elapsed if elapsed else 0.0
+        return (
+            f"Fetched {self.stats['threads']} threads, {self.stats['messages']} "
+            f"messages and {self.stats['attachments']} attachments in {elapsed:.1f}s "
+            f"({threads_per_second:.2f} threads/s, {self.stats['retries']} retries)."
+        )
@@ -0,0 +1,258 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+
+from turtle_parser import BNode, IRI, RDF_NS, TurtleError, local_name, parse
+
+# Constants
+SOURCE_FOLDERS = ["./outputs", "./threads"]
+EXPORT_FOLDER = "./neo4j_db/import"  # Mounted as the import folder of the container
+CONTAINER_IMPORT_FOLDER = "/var/lib/neo4j/import"
+JSON_OUTPUT_FILE = "json_output.json"
+TTL_OUTPUT_FILE = "rdf_output.ttl"
+# Entities the Bolt loader of create_graph.py knows: label, relationship type and
+# whether the relationship points from the entity to the document
+ENTITY_TYPES = {
+    "sender": ("Sender", "SENT", True),
+    "company": ("Company", "RELATED_TO", True),
+}
+CODE_FENCE_PATTERN = re.compile(r"^```\w*\s*$", re.MULTILINE)
+
+
+def stable_id(*parts):
+    """Returns an id that only depends on what identifies a node, run after run."""
+    return hashlib.sha1("\0".join(parts).encode("UTF-8")).hexdigest()[:20]
+
+
+def snake_case(name):
+    return re.sub(r"(?<=[a-z0-9])([A-Z])", r"_\1", name).lower()
+
+
+def entity_type(key):
+    """Returns (label, relationship type, points to the document) for an entity key.
+
+    Keys come from the model: they are reduced to word characters, and prefixed
+    when they would start with a digit or reuse the Document label.
+    """
+    key = re.sub(r"\W+", "_", snake_case(key)).strip("_") or "entity"
+    if key in ENTITY_TYPES:
+        return ENTITY_TYPES[key]
+    if key[0].isdigit() or key == "document":
+        key = f"entity_{key}"
+    label = "".join(part.capitalize() for part in key.split("_") if part)
+    return label, f"HAS_{key.upper()}", False
+
+
+def property_key(key):
+    """Returns a property key usable in a neo4j-admin import header.
+
+    ":" starts the type of a header column and "," separates columns, Turtle
+    predicates and model keys can hold both.
+    """
+    return re.sub(r"\W+", "_", key).strip("_") or "property"
+
+
+def property_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return "; ".join(property_value(item) for item in value)
+    if isinstance(value, dict):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def json_records(file_path):
+    """Yields (document name, properties, [(key, entity)]) records of a JSON output."""
+    with open(file_path, "r", encoding="UTF-8") as f:
+        data = json.load(f)
+    for entry in data if isinstance(data, list) else [data]:
+        if not isinstance(entry, dict) or not entry.get("document_name"):
+            continue
+        properties = {}
+        entities = []
+        for key, value in entry.items():
+            if key == "document_name":
+                continue
+            if isinstance(value, dict):
+                entities.append((key, value))
+            elif isinstance(value, list) and value and all(
+                isinstance(item, dict) for item in value
+            ):
+                entities.extend((key, item) for item in value)
+            else:
+                properties[snake_case(key)] = value
+        yield entry["document_name"], properties, entities
+
+
+def ttl_records(file_path):
+    """Yields the records of the ex:Document subjects of a Turtle output."""
+    with open(file_path, "r", encoding="UTF-8") as f:
+        yield from ttl_text_records(f.read())
+
+
+def ttl_text_records(text):
+    # Models sometimes wrap their answer in a Markdown code block
+    text = CODE_FENCE_PATTERN.sub("", text)
+    by_subject = {}
+    for subject, predicate, obj in parse(text):
+        by_subject.setdefault(subject, []).append((predicate, obj))
+
+    for subject, statements in by_subject.items():
+        types = [obj for predicate, obj in statements if predicate == RDF_NS + "type"]
+        if isinstance(subject, BNode) or "Document" not in map(local_name, types):
+            continue
+        properties = {}
+        entities = []
+        for predicate, obj in statements:
+            key = snake_case(local_name(predicate))
+            if predicate == RDF_NS + "type":
+                continue
+            if isinstance(obj, BNode):
+                entity = {}
+                for entity_predicate, value in by_subject.get(obj, []):
+                    if not isinstance(value, BNode):
+                        entity_key = snake_case(local_name(entity_predicate))
+                        entity[entity_key] = str(value)
+                entities.append((key, entity))
+            else:
+                value = local_name(obj) if isinstance(obj, IRI) else str(obj)
+                properties[key] = value
+        # The document name is the subject, with "_" for the spaces
+        yield local_name(subject).replace("_", " "), properties, entities
+
+
+def iter_output_files(
+    folders=SOURCE_FOLDERS, file_names=(JSON_OUTPUT_FILE, TTL_OUTPUT_FILE)
+):
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for file_name in sorted(files):
+                if file_name in file_names:
+                    yield os.path.join(root, file_name)
+
+
+class GraphExport:
+    """Nodes and relationships deduplicated by stable id, written as import CSVs."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.relationships = {}
+
+    def add_node(self, label, node_id, properties):
+        node = self.nodes.setdefault(label, {}).setdefault(node_id, {})
+        # The first non-empty value of a property wins
+        for key, value in properties.items():
+            key = property_key(key)
+            value = property_value(value)
+            if value and not node.get(key):
+                node[key] = value
+
+    def add_relationship(self, relationship_type, start, end):
+        key = (relationship_type, start[0], end[0])
+        self.relationships.setdefault(key, set()).add((start[1], end[1]))
+
+    def add_record(self, document_name, properties, entities):
+        document = ("Document", stable_id("Document", document_name))
+        self.add_node(*document, dict(properties, name=document_name))
+        for index, (key, entity) in enumerate(entities):
+            label, relationship_type, to_document = entity_type(key)
+            name = property_value(entity.get("name")).strip()
+            # Named entities are shared between documents, as MERGE on name does
+            if name:
+                node_id = stable_id(label, name)
+            else:
+                node_id = stable_id(label, document[1], key, str(index))
+            self.add_node(label, node_id, entity)
+            if to_document:
+                self.add_relationship(relationship_type, (label, node_id), document)
+            else:
+                self.add_relationship(relationship_type, document, (label, node_id))
+
+    def write(self, folder):
+        """Writes one CSV per label and relationship, returns the import arguments."""
+        os.makedirs(folder, exist_ok=True)
+        arguments = []
+        for label, nodes in sorted(self.nodes.items()):
+            file_name = f"nodes_{label}.csv"
+            keys = sorted({key for node in nodes.values() for key in node} - {"name"})
+            file_path = os.path.join(folder, file_name)
+            with open(file_path, "w", newline="", encoding="UTF-8") as f:
+                writer = csv.writer(f)
+                writer.writerow([f"id:ID({label})", "name"] + keys + [":LABEL"])
+                for node_id, node in sorted(nodes.items()):
+                    writer.writerow(
+                        [node_id, node.get("name", "")]
+                        + [node.get(key, "") for key in keys]
+                        + [label]
+                    )
+            arguments.append(f"--nodes={label}={CONTAINER_IMPORT_FOLDER}/{file_name}")
+
+        for (relationship_type, start_label, end_label), pairs in sorted(
+            self.relationships.items()
+        ):
+            file_name = (
+                f"relationships_{relationship_type}_{start_label}_{end_label}.csv"
+            )
+            file_path = os.path.join(folder, file_name)
+            with open(file_path, "w", newline="", encoding="UTF-8") as f:
+                writer = csv.writer(f)
+                writer.writerow(
+                    [f":START_ID({start_label})", f":END_ID({end_label})", ":TYPE"]
+                )
+                for start, end in sorted(pairs):
+                    writer.writerow([start, end, relationship_type])
+            file_path = f"{CONTAINER_IMPORT_FOLDER}/{file_name}"
+            arguments.append(f"--relationships={relationship_type}={file_path}")
+        return arguments
+
+
+def main(folders=SOURCE_FOLDERS, export_folder=EXPORT_FOLDER):
+    export = GraphExport()
+    files = 0
+    for file_path in iter_output_files(folders):
+        try:
+            if file_path.endswith(".json"):
+                records = list(json_records(file_path))
+            else:
+                records = list(ttl_records(file_path))
+        except (json.JSONDecodeError, TurtleError) as e:
+            print(f"Skipping {file_path}: {e}")
+            continue
+        for record in records:
+            export.add_record(*record)
+        files += 1
+
+    arguments = export.write(export_folder)
+    nodes = sum(len(nodes) for nodes in export.nodes.values())
+    relationships = sum(len(pairs) for pairs in export.relationships.values())
+    print(
+        f"Exported {nodes} nodes and {relationships} relationships from {files} files "
+        f"to {export_folder}."
+    )
+    # Multiline fields: document texts and terms often span several lines
+    print("Import them into an empty database, with the database stopped:")
+    print(
+        "neo4j-admin database import full neo4j --overwrite-destination "
+        "--multiline-fields=true " + " ".join(arguments)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the JSON and Turtle outputs as neo4j-admin import CSVs."
+    )
+    parser.add_argument(
+        "--output", default=EXPORT_FOLDER, help="Folder to write the CSV files to."
+    )
+    parser.add_argument(
+        "folders",
+        nargs="*",
+        default=SOURCE_FOLDERS,
+        help="Folders searched for json_output.json and rdf_output.ttl files.",
+    )
+    args = parser.parse_args()
+    main(args.folders, args.output)
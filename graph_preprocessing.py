@@ -1,29 +1,22 @@
-from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+import argparse
+import asyncio
 import json
 import os
 from dotenv import load_dotenv, find_dotenv
-from doctr.io import DocumentFile
-from doctr.models import ocr_predictor
+from ocr_cache import OCRCache
+from llm_batch import BatchRunner
+from llm_engine import create_engine
+from llm_cache import LLMCache
+from chunking import chunk_document, merge_ttl
+from staged_pipeline import StagedPipeline, walk_corpus
+from graph_export import ttl_text_records
+from turtle_parser import TurtleError
+from ocr import OCR_MODEL_VERSION
+from manifest import Manifest, processing_version
 
 load_dotenv(find_dotenv())
 
-def process_text_file(file_path):
-    with open(file_path, 'r', encoding='UTF-8') as file:
-        return file.read()
-
-def process_pdf_or_image(file_path, predictor):
-    try:
-        doc = DocumentFile.from_pdf(file_path) if file_path.endswith('.pdf') else DocumentFile.from_images(file_path)
-        result = predictor(doc)
-        raw_export = result.render()
-        if len(raw_export.strip()) < 20:
-            return None
-        return raw_export
-    except Exception as e:
-        print(f"Error processing {file_path}: {e}")
-        return None
+PROMPT_FILES = ["./graph_prompts/chatgpt_prompt.txt", "./graph_prompts/system_message.txt"]
 
 def create_folder_and_save_outputs(ttl_content, raw_text=None, original_text=None, output_dir="./outputs", email_processing=False, file_name=None):
     if email_processing:
@@ -34,11 +27,12 @@ def create_folder_and_save_outputs(ttl_content, raw_text=None, original_text=Non
             document_name = os.path.splitext(file_name)[0]
             folder_name = f"output_{document_name}"
     else:
-        # Extract document name from TTL content
-        doc_name_start = ttl_content.find("ex:") + 3
-        doc_name_end = ttl_content.find(" ", doc_name_start)
-        document_name = ttl_content[doc_name_start:doc_name_end]
-        folder_name = document_name
+        # The document name is the subject of the ex:Document of the TTL content
+        try:
+            records = list(ttl_text_records(ttl_content))
+        except TurtleError:
+            records = []
+        folder_name = records[0][0] if records else os.path.splitext(file_name)[0]
 
     folder_path = os.path.join(output_dir, folder_name.replace(" ", "_").replace("/", "_"))
     os.makedirs(folder_path, exist_ok=True)
@@ -53,46 +47,57 @@ def create_folder_and_save_outputs(ttl_content, raw_text=None, original_text=Non
     with open(os.path.join(folder_path, "rdf_output.ttl"), 'w', encoding='UTF-8') as file:
         file.write(ttl_content)
 
-def generate_ttl_data(model, document_text, prompt_template):
-    prompt = prompt_template.format(document=document_text)
+    return folder_path
 
-    messages = [
+def build_messages(document_text, prompt_template):
+    from langchain_core.messages import HumanMessage, SystemMessage
+
+    # The template is full of {placeholders} meant for the model, only fill {document}
+    prompt = prompt_template.replace("{document}", document_text)
+
+    return [
         SystemMessage(content="Extract structured information from the document."),
         HumanMessage(content=prompt),
     ]
 
-    result = model.invoke(messages)
-    return result.content
-
-def process_files_in_folder(folder_path, predictor, model, systemPrompt, prompt_template, email_processing=False):
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        raw_text = None
-        original_text = None
-
-        if filename.endswith('.txt'):
-            original_text = process_text_file(file_path)
-        elif filename.endswith('.pdf') or filename.endswith(('.png', '.jpg', '.jpeg')):
-            raw_text = process_pdf_or_image(file_path, predictor)
-            if not raw_text:
-                continue
-        else:
+async def agenerate_ttl_data(engine, document_text, prompt_template):
+    return await engine.ainvoke(build_messages(document_text, prompt_template))
+
+async def generate_document(engine, document, prompt_template):
+    document_text = document['original_text'] or document['raw_text']
+    # Long documents are extracted chunk by chunk in parallel, then merged
+    chunks = chunk_document(document_text, document['export'], engine.count_text_tokens)
+    results = await asyncio.gather(*[agenerate_ttl_data(engine, chunk, prompt_template) for chunk in chunks])
+    return results[0] if len(results) == 1 else merge_ttl(results)
+
+def save_document(document, ttl_content):
+    create_folder_and_save_outputs(ttl_content, raw_text=document['raw_text'], original_text=document['original_text'], output_dir=document['output_dir'], email_processing=document['email_processing'], file_name=document['file_name'])
+
+def process_documents_in_batch(runner, documents, prompt_template, manifest=None):
+    # Every chunk of every document goes into the batch, results are mapped back by key
+    prompt_keys = []
+    for document in documents:
+        document_text = document['original_text'] or document['raw_text']
+        chunks = chunk_document(document_text, document['export'], runner.count_text_tokens)
+        prompt_keys.append([runner.add(build_messages(chunk, prompt_template)) for chunk in chunks])
+    answers = runner.run()
+
+    failed = 0
+    for document, keys in zip(documents, prompt_keys):
+        missing = [key for key in keys if key not in answers]
+        if missing:
+            print(f"Error processing {document['file_name']}: no answer in the batch output")
+            failed += 1
             continue
+        results = [answers[key] for key in keys]
+        ttl_content = results[0] if len(results) == 1 else merge_ttl(results)
+        create_folder_and_save_outputs(ttl_content, raw_text=document['raw_text'], original_text=document['original_text'], output_dir=document['output_dir'], email_processing=document['email_processing'], file_name=document['file_name'])
+        if manifest is not None:
+            manifest.record(document['file_path'])
+    print(f"{len(documents) - failed} documents extracted, {failed} failed.")
 
-        document_text = original_text if original_text else raw_text
-        ttl_content = generate_ttl_data(model, document_text, prompt_template)
-
-        create_folder_and_save_outputs(ttl_content, raw_text=raw_text, original_text=original_text, output_dir=folder_path, email_processing=email_processing, file_name=filename)
-
-def main():
-    # Load environment variables
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY environment variable not set")
-
-    # Initialize model and predictor
-    model = ChatOpenAI(api_key=api_key, model="gpt-3.5-turbo")
-    predictor = ocr_predictor(pretrained=True)
+def load_prompts():
+    from langchain.prompts import PromptTemplate
 
     # Read prompt and system messages from graph_prompts folder
     with open("./graph_prompts/system_message.txt", "r") as file:
@@ -103,19 +108,55 @@ def main():
     with open("./graph_prompts/chatgpt_prompt.txt", "r") as file:
         chatgptPrompt = file.read()
 
-    # Process Documents folder
-    documents_folder = "./Documents"
-    process_files_in_folder(documents_folder, predictor, model, systemPrompt, chatgptPrompt)
+    return systemPrompt, chatgptPrompt
+
+def main(batch=False, force=False):
+    from langchain_openai import ChatOpenAI
 
-    # Process threads folder
-    threads_folder = "./threads"
-    for thread_folder in os.listdir(threads_folder):
-        thread_path = os.path.join(threads_folder, thread_folder)
-        if os.path.isdir(thread_path):
-            for email_folder in os.listdir(thread_path):
-                email_path = os.path.join(thread_path, email_folder)
-                if os.path.isdir(email_path):
-                    process_files_in_folder(email_path, predictor, model, systemPrompt, chatgptPrompt, email_processing=True)
+    # Load environment variables
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable not set")
+
+    # Initialize model, the OCR predictor is only loaded by documents needing it
+    model = ChatOpenAI(api_key=api_key, model="gpt-3.5-turbo")
+    llm_cache = LLMCache()
+    llm_cache.invalidate_if_changed("ttl", PROMPT_FILES)
+    ocr_cache = OCRCache()
+    # Inputs already extracted with the same model, OCR and prompts are skipped
+    manifest = Manifest("ttl", processing_version(model.model_name, OCR_MODEL_VERSION, prompt_files=PROMPT_FILES), force=force)
+
+    systemPrompt, chatgptPrompt = load_prompts()
+
+    if batch:
+        # A batch needs every prompt up front, documents are only read here
+        documents = StagedPipeline(ocr_cache=ocr_cache, documents_output_dir="./outputs", manifest=manifest).read_all(walk_corpus())
+        runner = BatchRunner(model, cache=llm_cache, namespace="ttl")
+        process_documents_in_batch(runner, documents, chatgptPrompt, manifest)
+    else:
+        # Documents are OCR'd, extracted and saved at the same time, the LLM
+        # requests of the run sharing one pool within the engine's rate limits
+        engine = create_engine(model, cache=llm_cache, namespace="ttl")
+        pipeline = StagedPipeline(
+            extract=lambda document: generate_document(engine, document, chatgptPrompt),
+            write=save_document,
+            engine=engine,
+            ocr_cache=ocr_cache,
+            # Documents/ outputs go to ./outputs, where create_graph.py and
+            # graph_export.py look for them
+            documents_output_dir="./outputs",
+            manifest=manifest,
+        )
+        results = pipeline.run(walk_corpus())
+        failed = sum(1 for _, _, error in results if error is not None)
+        print(f"{len(results) - failed} documents extracted, {failed} failed.")
+    manifest.close()
+    ocr_cache.close()
+    llm_cache.close()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Extract Turtle graphs of documents.')
+    parser.add_argument('--batch', action='store_true', help='Send every prompt through the batch endpoint, slower but cheaper.')
+    parser.add_argument('--force', action='store_true', help='Process every input, even those unchanged since their last extraction.')
+    args = parser.parse_args()
+    main(batch=args.batch, force=args.force)
@@ -1,35 +1,44 @@
-from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
+import argparse
 import json
 import os
+import sqlite3
 from dotenv import load_dotenv, find_dotenv
-from doctr.io import DocumentFile
-from doctr.models import ocr_predictor
+import asyncio
+from ocr import OCR_MODEL_VERSION
+from ocr_cache import OCRCache
+from llm_batch import BatchRunner
+from llm_engine import create_engine
+from llm_cache import LLMCache
+from llm_engine import count_tokens
+from prompt_builder import PromptExamples
+from chunking import chunk_document, merge_json
+from staged_pipeline import StagedPipeline, walk_corpus
+from json_schema import parse_and_validate
+from manifest import Manifest, processing_version
+from document_store import DocumentStore
 
 load_dotenv(find_dotenv())
 
-
-def process_text_file(file_path):
-    with open(file_path, "r", encoding="UTF-8") as file:
-        return file.read()
-
-
-def process_pdf_or_image(file_path, predictor):
-    try:
-        doc = (
-            DocumentFile.from_pdf(file_path)
-            if file_path.endswith(".pdf")
-            else DocumentFile.from_images(file_path)
-        )
-        result = predictor(doc)
-        raw_export = result.render()
-        if len(raw_export.strip()) < 20:
-            return None
-        return raw_export
-    except Exception as e:
-        print(f"Error processing {file_path}: {e}")
-        return None
+EXAMPLE_FILES = [
+    "./prompts/json_data.json",
+    "./prompts/json_data1.json",
+    "./prompts/json_data2.json",
+    "./prompts/json_data3.json",
+]
+PROMPT_FILES = [
+    "./prompts/chatgpt_prompt.txt",
+    "./prompts/system_message.txt",
+] + EXAMPLE_FILES
+FAILED_DOCUMENTS_FILE_PATH = "./outputs/failed_documents.json"
+MAX_REPAIRS = 2  # Repair prompts sent for an answer failing validation
+REPAIR_PROMPT = (
+    "Your answer could not be used: {errors}. "
+    "Answer again with only the corrected JSON object."
+)
+# Makes the model answer with a syntactically valid JSON object
+JSON_MODE = {"response_format": {"type": "json_object"}}
+
+document_store = DocumentStore()
 
 
 def create_folder_and_save_outputs(
@@ -68,78 +77,23 @@ def create_folder_and_save_outputs(
         ) as file:
             file.write(original_text)
 
-    with open(
-        os.path.join(folder_path, "json_output.json"), "w", encoding="UTF-8"
-    ) as file:
+    json_file_path = os.path.join(folder_path, "json_output.json")
+    with open(json_file_path, "w", encoding="UTF-8") as file:
         json.dump(json_output, file, ensure_ascii=False, indent=4)
 
+    # Indexed as it is written, queries never walk the output folders
+    try:
+        document_store.index_file(json_file_path, json_output)
+    except sqlite3.Error as e:
+        print(f"Error indexing {json_file_path}: {e}")
 
-def process_files_in_folder(
-    folder_path,
-    predictor,
-    model,
-    systemPrompt,
-    prompt,
-    json_data,
-    json_data1,
-    json_data2,
-    json_data3,
-    email_processing=False,
-):
-    for filename in os.listdir(folder_path):
-        file_path = os.path.join(folder_path, filename)
-        raw_text = None
-        original_text = None
-
-        if filename.endswith(".txt"):
-            original_text = process_text_file(file_path)
-        elif filename.endswith(".pdf") or filename.endswith((".png", ".jpg", ".jpeg")):
-            raw_text = process_pdf_or_image(file_path, predictor)
-            if not raw_text:
-                continue
-        else:
-            continue
-
-        document_text = original_text if original_text else raw_text
-        prompt_template = PromptTemplate(
-            template=prompt, input_variables=["json_data", "document"]
-        ).format(
-            json_data=str(json_data),
-            json_data1=str(json_data1),
-            json_data2=str(json_data2),
-            json_data3=str(json_data3),
-            document=document_text,
-        )
-
-        messages = [
-            SystemMessage(content=systemPrompt.format()),
-            HumanMessage(content=prompt_template),
-        ]
-
-        result = model.invoke(messages)
-        json_output = json.loads(result.content)
-
-        create_folder_and_save_outputs(
-            json_output,
-            raw_text=raw_text,
-            original_text=original_text,
-            output_dir=folder_path,
-            email_processing=email_processing,
-            file_name=filename,
-        )
-
+    return folder_path
 
-def main():
-    # Load environment variables
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("OPENAI_API_KEY environment variable not set")
 
-    # Initialize model and predictor
-    model = ChatOpenAI(api_key=api_key, model="gpt-3.5-turbo") #TODO: model="gpt-4o"
-    predictor = ocr_predictor(pretrained=True)
+def load_prompts():
+    """Reads the system message, the prompt template and the example JSON files."""
+    from langchain.prompts import PromptTemplate
 
-    # Read prompt and system messages
     with open("./prompts/chatgpt_prompt.txt", "r") as file:
         prompt = file.read()
 
@@ -148,76 +102,234 @@ def main():
 
     systemPrompt = PromptTemplate(template=systemMessage, input_variables=[])
 
-    with open("./prompts/json_data.json", "r", encoding="UTF-8") as file:
-        json_data = json.load(file)
+    examples = []
+    for example_file in EXAMPLE_FILES:
+        with open(example_file, "r", encoding="UTF-8") as file:
+            examples.append(json.load(file))
+
+    # The examples are rendered once here, then picked per document
+    return systemPrompt, prompt, PromptExamples(examples)
 
-    with open("./prompts/json_data1.json", "r", encoding="UTF-8") as file:
-        json_data1 = json.load(file)
 
-    with open("./prompts/json_data2.json", "r", encoding="UTF-8") as file:
-        json_data2 = json.load(file)
+def build_messages(systemPrompt, prompt, examples, document_text):
+    from langchain.prompts import PromptTemplate
+    from langchain_core.messages import HumanMessage, SystemMessage
 
-    with open("./prompts/json_data3.json", "r", encoding="UTF-8") as file:
-        json_data3 = json.load(file)
+    prompt_template = PromptTemplate(
+        template=prompt, input_variables=["schema", "examples", "document"]
+    ).format(
+        schema=examples.schema,
+        examples=examples.render(document_text),
+        document=document_text,
+    )
 
-    documents_folder = "./Documents"
-    for filename in os.listdir(documents_folder):
-        file_path = os.path.join(documents_folder, filename)
-        raw_text = None
-        original_text = None
+    return [
+        SystemMessage(content=systemPrompt.format()),
+        HumanMessage(content=prompt_template),
+    ]
 
-        if filename.endswith(".txt"):
-            original_text = process_text_file(file_path)
-        elif filename.endswith(".pdf") or filename.endswith((".png", ".jpg", ".jpeg")):
-            raw_text = process_pdf_or_image(file_path, predictor)
-            if not raw_text:
-                continue
-        else:
-            continue
-
-        document_text = original_text if original_text else raw_text
-        prompt_template = PromptTemplate(
-            template=prompt, input_variables=["json_data", "document"]
-        ).format(
-            json_data=str(json_data),
-            json_data1=str(json_data1),
-            json_data2=str(json_data2),
-            json_data3=str(json_data3),
-            document=document_text,
-        )
 
-        messages = [
-            SystemMessage(content=systemPrompt.format()),
-            HumanMessage(content=prompt_template),
+def repair_messages(messages, content, errors):
+    """Appends the invalid answer and the validation errors to the conversation."""
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    return messages + [
+        AIMessage(content=content),
+        HumanMessage(content=REPAIR_PROMPT.format(errors="; ".join(errors))),
+    ]
+
+
+async def aextract_json_data(
+    engine, systemPrompt, prompt, examples, document_text, label="Document"
+):
+    messages = build_messages(systemPrompt, prompt, examples, document_text)
+    print(f"{label}: {count_tokens(messages, engine.model_name)} prompt tokens.")
+    for attempt in range(MAX_REPAIRS + 1):
+        content = await engine.ainvoke(messages)
+        json_output, errors = parse_and_validate(content, examples.json_schema)
+        if not errors:
+            return json_output
+        # An invalid answer must not be served from the cache on the next run
+        engine.forget(messages)
+        print(f"{label}: invalid answer ({'; '.join(errors)}), asking for a repair.")
+        messages = repair_messages(messages, content, errors)
+    raise ValueError(f"Invalid answer after {MAX_REPAIRS} repairs: {'; '.join(errors)}")
+
+
+async def extract_document(engine, document, systemPrompt, prompt, examples):
+    document_text = document["original_text"] or document["raw_text"]
+    # Long documents are extracted chunk by chunk in parallel, then merged
+    chunks = chunk_document(document_text, document["export"], engine.count_text_tokens)
+    results = await asyncio.gather(
+        *[
+            aextract_json_data(
+                engine,
+                systemPrompt,
+                prompt,
+                examples,
+                chunk,
+                label=f"{document['file_name']} [{index + 1}/{len(chunks)}]",
+            )
+            for index, chunk in enumerate(chunks)
         ]
+    )
+    return merge_json(results)
+
+
+def save_document(document, json_output):
+    create_folder_and_save_outputs(
+        json_output,
+        raw_text=document["raw_text"],
+        original_text=document["original_text"],
+        output_dir=document["output_dir"],
+        email_processing=document["email_processing"],
+        file_name=document["file_name"],
+    )
 
-        result = model.invoke(messages)
-        json_output = json.loads(result.content)
 
-        create_folder_and_save_outputs(
-            json_output, raw_text=raw_text, original_text=original_text
+def process_documents_in_batch(
+    runner, documents, systemPrompt, prompt, examples, manifest=None
+):
+    """Sends the prompts of every document as one offline batch, then saves them.
+
+    Invalid answers are not repaired here: their documents are listed in the
+    failed documents file, to be run again without --batch.
+    """
+    prompt_keys = []
+    for document in documents:
+        document_text = document["original_text"] or document["raw_text"]
+        chunks = chunk_document(
+            document_text, document["export"], runner.count_text_tokens
+        )
+        prompt_keys.append(
+            [
+                runner.add(build_messages(systemPrompt, prompt, examples, chunk))
+                for chunk in chunks
+            ]
         )
+    answers = runner.run()
+
+    errors = []
+    for document, keys in zip(documents, prompt_keys):
+        try:
+            results = []
+            for key in keys:
+                if key not in answers:
+                    raise ValueError("No answer in the batch output")
+                json_output, problems = parse_and_validate(
+                    answers[key], examples.json_schema
+                )
+                if problems:
+                    runner.forget(key)
+                    raise ValueError(f"Invalid answer: {'; '.join(problems)}")
+                results.append(json_output)
+            create_folder_and_save_outputs(
+                merge_json(results),
+                raw_text=document["raw_text"],
+                original_text=document["original_text"],
+                output_dir=document["output_dir"],
+                email_processing=document["email_processing"],
+                file_name=document["file_name"],
+            )
+            if manifest is not None:
+                manifest.record(document["file_path"])
+            errors.append(None)
+        except Exception as e:
+            print(f"Error processing {document['file_name']}: {e}")
+            errors.append(str(e))
+    save_failed_documents(
+        [
+            (document["file_name"], document["output_dir"], error)
+            for document, error in zip(documents, errors)
+        ]
+    )
+
+
+def save_failed_documents(results):
+    """Lists the documents that failed, so that only they are processed again.
+
+    results holds a (file name, output dir, error or None) tuple per document.
+    """
+    failed = [
+        {"file_name": file_name, "output_dir": output_dir, "error": error}
+        for file_name, output_dir, error in results
+        if error is not None
+    ]
+    print(f"{len(results) - len(failed)} documents extracted, {len(failed)} failed.")
+    if failed:
+        os.makedirs(os.path.dirname(FAILED_DOCUMENTS_FILE_PATH), exist_ok=True)
+        with open(FAILED_DOCUMENTS_FILE_PATH, "w", encoding="UTF-8") as f:
+            json.dump(failed, f, ensure_ascii=False, indent=4)
+        print(f"Failed documents listed in {FAILED_DOCUMENTS_FILE_PATH}.")
+
+
+def main(batch=False, force=False):
+    # langchain is only imported here, a run with nothing to extract never loads it
+    from langchain_openai import ChatOpenAI
+
+    # Load environment variables
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable not set")
+
+    # Initialize model, the OCR predictor is only loaded by documents needing it
+    model = ChatOpenAI(
+        api_key=api_key, model="gpt-3.5-turbo", model_kwargs=JSON_MODE
+    )  # TODO: model="gpt-4o"
+    llm_cache = LLMCache()
+    llm_cache.invalidate_if_changed("json", PROMPT_FILES)
+    ocr_cache = OCRCache()
+    # Inputs already extracted with the same model, OCR and prompts are skipped
+    manifest = Manifest(
+        "json",
+        processing_version(model.model_name, OCR_MODEL_VERSION, prompt_files=PROMPT_FILES),
+        force=force,
+    )
+
+    # Read prompt and system messages
+    systemPrompt, prompt, examples = load_prompts()
 
-    threads_folder = "./threads"
-    for thread_folder in os.listdir(threads_folder):
-        thread_path = os.path.join(threads_folder, thread_folder)
-        if os.path.isdir(thread_path):
-            for email_folder in os.listdir(thread_path):
-                email_path = os.path.join(thread_path, email_folder)
-                if os.path.isdir(email_path):
-                    process_files_in_folder(
-                        email_path,
-                        predictor,
-                        model,
-                        systemPrompt,
-                        prompt,
-                        json_data,
-                        json_data1,
-                        json_data2,
-                        json_data3,
-                        email_processing=True,
-                    )
+    if batch:
+        # A batch needs every prompt up front, documents are only read here
+        pipeline = StagedPipeline(
+            ocr_cache=ocr_cache, documents_output_dir="./outputs", manifest=manifest
+        )
+        documents = pipeline.read_all(walk_corpus())
+        runner = BatchRunner(model, cache=llm_cache, namespace="json")
+        process_documents_in_batch(
+            runner, documents, systemPrompt, prompt, examples, manifest
+        )
+    else:
+        # Documents are OCR'd, extracted and saved at the same time, the LLM
+        # requests of the run sharing one pool within the engine's rate limits
+        engine = create_engine(model, cache=llm_cache, namespace="json")
+        pipeline = StagedPipeline(
+            extract=lambda document: extract_document(
+                engine, document, systemPrompt, prompt, examples
+            ),
+            write=save_document,
+            engine=engine,
+            ocr_cache=ocr_cache,
+            documents_output_dir="./outputs",
+            manifest=manifest,
+        )
+        save_failed_documents(pipeline.run(walk_corpus()))
+    manifest.close()
+    ocr_cache.close()
+    llm_cache.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Extract JSON metadata of documents.")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Send every prompt through the batch endpoint, slower but cheaper.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Process every input, even those unchanged since their last extraction.",
+    )
+    args = parser.parse_args()
+    main(batch=args.batch, force=args.force)
@@ -0,0 +1,67 @@
+import json
+
+JSON_TYPES = {dict: "object", list: "array", str: "string", bool: "boolean"}
+
+
+def json_type(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return "number"
+    return JSON_TYPES.get(type(value), "null")
+
+
+def derive_schema(examples):
+    """Builds a JSON schema from the example files.
+
+    Only "document_name" is required, as the prompt states. Keys shared by
+    several examples get the type they have in every example, so that a sender
+    given as a plain string instead of an object is caught.
+    """
+    properties = {}
+    keys = list(dict.fromkeys(key for example in examples for key in example))
+    for key in keys:
+        values = [example[key] for example in examples if key in example]
+        types = {json_type(value) for value in values}
+        if len(values) < 2 or len(types) != 1:
+            continue
+        schema = {"type": types.pop()}
+        if schema["type"] == "object":
+            fields = {field for value in values for field in value}
+            schema["properties"] = {
+                field: {"type": "string"}
+                for field in sorted(fields)
+                if all(isinstance(value.get(field, ""), str) for value in values)
+            }
+        properties[key] = schema
+
+    properties["document_name"] = {"type": "string", "minLength": 1}
+    return {"type": "object", "required": ["document_name"], "properties": properties}
+
+
+def validate(data, schema, path="$"):
+    """Returns the list of errors of data against a schema built by derive_schema."""
+    expected = schema.get("type")
+    if expected and json_type(data) != expected:
+        # Models often write numbers or null where strings are expected, allow it
+        if not (expected == "string" and json_type(data) in ("number", "null")):
+            return [f"{path} should be of type {expected}, not {json_type(data)}"]
+
+    errors = []
+    if isinstance(data, str) and len(data.strip()) < schema.get("minLength", 0):
+        errors.append(f"{path} should not be empty")
+    if isinstance(data, dict):
+        for key in schema.get("required", []):
+            if key not in data:
+                errors.append(f"{path}.{key} is missing")
+        for key, subschema in schema.get("properties", {}).items():
+            if key in data:
+                errors.extend(validate(data[key], subschema, f"{path}.{key}"))
+    return errors
+
+
+def parse_and_validate(content, schema):
+    """Returns (data, errors) for the raw content of a model answer."""
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError as error:
+        return None, [f"the answer is not valid JSON: {error}"]
+    return data, validate(data, schema)
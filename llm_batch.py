@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import time
+
+from openai import OpenAI
+
+from llm_cache import cache_key
+from llm_engine import get_encoding
+
+# Constants
+BATCH_FOLDER = "./batches"
+BATCH_STATE_FILE_PATH = "./batches/batch_state.json"
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+MAX_BATCH_REQUESTS = 50000  # Limits of a single batch input file
+MAX_BATCH_BYTES = 150 * 1024 * 1024
+POLL_INTERVAL = int(os.getenv("BATCH_POLL_INTERVAL", "60"))  # Seconds
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+ROLES = {"system": "system", "human": "user", "ai": "assistant"}
+
+
+def load_batch_state():
+    if os.path.exists(BATCH_STATE_FILE_PATH):
+        with open(BATCH_STATE_FILE_PATH, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_batch_state(state):
+    # Written atomically, a crash while polling must not lose the submitted batches
+    os.makedirs(os.path.dirname(BATCH_STATE_FILE_PATH), exist_ok=True)
+    tmp_path = BATCH_STATE_FILE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, BATCH_STATE_FILE_PATH)
+
+
+def batch_request(custom_id, messages, body):
+    """Returns one line of a batch input file, a chat completion request."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": dict(
+            body,
+            messages=[
+                {"role": ROLES[message.type], "content": message.content}
+                for message in messages
+            ],
+        ),
+    }
+
+
+def split_requests(lines):
+    """Groups serialized requests into batches within the size limits."""
+    batches = []
+    current = []
+    current_bytes = 0
+    for line in lines:
+        size = len(line.encode("UTF-8")) + 1
+        if current and (
+            len(current) >= MAX_BATCH_REQUESTS or current_bytes + size > MAX_BATCH_BYTES
+        ):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append(line)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def read_results(text):
+    """Returns {custom_id: answer content} for the successful lines of an output file."""
+    results = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            print(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+            continue
+        results[result["custom_id"]] = response["body"]["choices"][0]["message"][
+            "content"
+        ]
+    return results
+
+
+class BatchRunner:
+    """Collects the prompts of a run and answers them through the batch endpoint.
+
+    Prompts are identified by their LLM cache key: cached answers are served
+    directly, identical prompts are sent once and batch answers are stored in the
+    cache, so that an interrupted run or an interactive re-run does not pay twice.
+    """
+
+    def __init__(self, model, cache=None, namespace=None, client=None):
+        self.model_name = getattr(model, "model_name", "gpt-3.5-turbo")
+        self.temperature = getattr(model, "temperature", None)
+        self.body = {"model": self.model_name}
+        if self.temperature is not None:
+            self.body["temperature"] = self.temperature
+        self.body.update(getattr(model, "model_kwargs", None) or {})
+        self.cache = cache
+        self.namespace = namespace or "batch"
+        # The endpoint is read from OPENAI_BASE_URL, e.g. batch_stub_server.py
+        self.client = client or OpenAI()
+        self.pending = {}
+
+    def count_text_tokens(self, text):
+        return len(get_encoding(self.model_name).encode(text))
+
+    def add(self, messages):
+        """Queues a prompt and returns the key its answer will be found under."""
+        key = cache_key(self.model_name, self.temperature, messages)
+        self.pending[key] = messages
+        return key
+
+    def forget(self, key):
+        if self.cache is not None:
+            self.cache.delete(key)
+
+    def run(self):
+        """Returns {key: answer content} for every queued prompt that was answered."""
+        answers = {}
+        to_send = {}
+        for key, messages in self.pending.items():
+            content = self.cache.get(key) if self.cache is not None else None
+            if content is None:
+                to_send[key] = messages
+            else:
+                answers[key] = content
+        print(f"{len(self.pending)} prompts, {len(answers)} cached, {len(to_send)} to send.")
+
+        lines = [
+            json.dumps(batch_request(key, to_send[key], self.body), ensure_ascii=False)
+            for key in sorted(to_send)
+        ]
+        started_at = time.monotonic()
+        answered = 0
+        for batch_lines in split_requests(lines):
+            results = self.run_batch(batch_lines)
+            if self.cache is not None:
+                for key, content in results.items():
+                    self.cache.put(key, content, self.namespace)
+            answers.update(results)
+            answered += len(results)
+        if lines:
+            elapsed = time.monotonic() - started_at
+            print(
+                f"{answered} of {len(lines)} prompts answered by the batch endpoint "
+                f"in {elapsed:.0f}s."
+            )
+        self.pending = {}
+        return answers
+
+    def run_batch(self, batch_lines):
+        content = "\n".join(batch_lines) + "\n"
+        digest = hashlib.sha256(content.encode("UTF-8")).hexdigest()
+        file_path = os.path.join(BATCH_FOLDER, f"{self.namespace}-{digest[:16]}.jsonl")
+        os.makedirs(BATCH_FOLDER, exist_ok=True)
+        with open(file_path, "w", encoding="UTF-8") as f:
+            f.write(content)
+
+        # The same input file is not submitted twice, a restarted run resumes polling
+        state = load_batch_state()
+        batch_id = state.get(digest)
+        if batch_id is None or self.client.batches.retrieve(batch_id).status in (
+            FINAL_STATUSES - {"completed"}
+        ):
+            batch_id = self.submit(file_path)
+            state[digest] = batch_id
+            save_batch_state(state)
+
+        batch = self.wait(batch_id)
+        results = {}
+        if batch.status == "completed" and batch.output_file_id:
+            results = read_results(self.client.files.content(batch.output_file_id).text)
+        else:
+            print(f"Batch {batch_id} ended with status {batch.status}.")
+        if batch.error_file_id:
+            read_results(self.client.files.content(batch.error_file_id).text)
+
+        del state[digest]
+        save_batch_state(state)
+        return results
+
+    def submit(self, file_path):
+        with open(file_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=COMPLETION_WINDOW,
+        )
+        print(f"Submitted {file_path} as batch {batch.id}.")
+        return batch.id
+
+    def wait(self, batch_id):
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in FINAL_STATUSES:
+                return batch
+            counts = batch.request_counts
+            if counts is not None:
+                print(
+                    f"Batch {batch_id} {batch.status}: "
+                    f"{counts.completed}/{counts.total} done, {counts.failed} failed."
+                )
+            time.sleep(POLL_INTERVAL)
@@ -0,0 +1,177 @@
+import argparse
+import hashlib
+import sqlite3
+import threading
+import time
+
+# Constants
+LLM_CACHE_PATH = "llm_cache.sqlite"
+DEFAULT_TTL = 90 * 24 * 3600  # Seconds before a cached answer is asked again
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def hash_files(file_paths):
+    """Returns a hash of the content of the prompt files a namespace depends on."""
+    digest = hashlib.sha256()
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def cache_key(model_name, temperature, messages):
+    digest = hashlib.sha256()
+    digest.update(f"{model_name}\0{temperature}".encode("UTF-8"))
+    for message in messages:
+        digest.update(f"\0{message.type}:{message.content}".encode("UTF-8"))
+    return digest.hexdigest()
+
+
+class LLMCache:
+    """Durable LLM answers keyed by model, temperature and rendered messages."""
+
+    def __init__(
+        self, path=LLM_CACHE_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                key TEXT PRIMARY KEY,
+                namespace TEXT,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS llm_responses_last_access
+                ON llm_responses (last_access);
+            CREATE INDEX IF NOT EXISTS llm_responses_namespace
+                ON llm_responses (namespace);
+            CREATE TABLE IF NOT EXISTS prompt_versions (
+                namespace TEXT PRIMARY KEY,
+                version TEXT NOT NULL
+            );
+            """
+        )
+        self.connection.commit()
+        # Upper bound of the row count, replaced answers count twice until the
+        # next eviction counts the rows again
+        self.entries = self.count()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT content, created_at FROM llm_responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self.connection.execute(
+                    "DELETE FROM llm_responses WHERE key = ?", (key,)
+                )
+                self.connection.commit()
+                return None
+            self.connection.execute(
+                "UPDATE llm_responses SET last_access = ? WHERE key = ?", (now, key)
+            )
+            self.connection.commit()
+        return row[0]
+
+    def put(self, key, content, namespace=None):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO llm_responses VALUES (?, ?, ?, ?, ?)",
+                (key, namespace, content, now, now),
+            )
+            self.entries += 1
+            if self.entries > self.max_entries:
+                self.evict()
+            self.connection.commit()
+
+    def count(self):
+        row = self.connection.execute("SELECT COUNT(*) FROM llm_responses").fetchone()
+        return row[0]
+
+    def evict(self):
+        """Drops the least recently used answers above the size bound.
+
+        A tenth of the bound is freed at once, so that the following puts do not
+        evict again.
+        """
+        excess = self.count() - self.max_entries + self.max_entries // 10
+        if excess > 0:
+            self.connection.execute(
+                """
+                DELETE FROM llm_responses WHERE key IN (
+                    SELECT key FROM llm_responses ORDER BY last_access LIMIT ?
+                )
+                """,
+                (excess,),
+            )
+        self.entries = self.count()
+
+    def delete(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM llm_responses WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def invalidate(self, namespace=None):
+        """Deletes the answers of a namespace, or every answer."""
+        with self.lock:
+            if namespace is None:
+                self.connection.execute("DELETE FROM llm_responses")
+                self.connection.execute("DELETE FROM prompt_versions")
+            else:
+                self.connection.execute(
+                    "DELETE FROM llm_responses WHERE namespace = ?", (namespace,)
+                )
+                self.connection.execute(
+                    "DELETE FROM prompt_versions WHERE namespace = ?", (namespace,)
+                )
+            self.connection.commit()
+
+    def invalidate_if_changed(self, namespace, prompt_files):
+        """Drops a namespace's answers when one of its prompt files was edited."""
+        version = hash_files(prompt_files)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT version FROM prompt_versions WHERE namespace = ?", (namespace,)
+            ).fetchone()
+        if row is not None and row[0] == version:
+            return False
+        if row is not None:
+            print(f"Prompt files of {namespace} changed, invalidating its cache.")
+            self.invalidate(namespace)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO prompt_versions VALUES (?, ?)",
+                (namespace, version),
+            )
+            self.connection.commit()
+        return row is not None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the LLM response cache.")
+    parser.add_argument(
+        "--invalidate",
+        metavar="NAMESPACE",
+        help='Delete the answers of a namespace ("json", "ttl", "graph") or "all".',
+    )
+    args = parser.parse_args()
+
+    cache = LLMCache()
+    if args.invalidate:
+        cache.invalidate(None if args.invalidate == "all" else args.invalidate)
+        print(f"Invalidated {args.invalidate}.")
+    count = cache.connection.execute("SELECT COUNT(*) FROM llm_responses").fetchone()
+    print(f"{count[0]} cached answers.")
+    cache.close()
@@ -0,0 +1,184 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+import tiktoken
+from openai import (
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+
+from llm_cache import cache_key
+
+# Defaults, overridable with the LLM_* environment variables
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200000
+EXPECTED_OUTPUT_TOKENS = 500  # Reserved per request on top of the prompt tokens
+MAX_RETRIES = 6
+RETRYABLE_ERRORS = (
+    RateLimitError,
+    APITimeoutError,
+    APIConnectionError,
+    InternalServerError,
+)
+
+
+class MinuteBudget:
+    """Sliding one-minute window limiting the units (requests or tokens) spent."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.spent = deque()
+        self.total = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.spent and now - self.spent[0][0] >= 60:
+                    self.total -= self.spent.popleft()[1]
+                # A request larger than the whole budget still goes through alone
+                if self.total + amount <= self.limit or not self.spent:
+                    self.spent.append((now, amount))
+                    self.total += amount
+                    return
+                await asyncio.sleep(60 - (now - self.spent[0][0]))
+
+
+def get_encoding(model_name):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(messages, model_name):
+    encoding = get_encoding(model_name)
+    # Every message costs a few tokens of role and separators on top of its content
+    return sum(len(encoding.encode(message.content)) + 4 for message in messages)
+
+
+class AsyncExtractor:
+    """Runs langchain chat model calls concurrently within per-minute budgets."""
+
+    def __init__(
+        self,
+        model,
+        concurrency=DEFAULT_CONCURRENCY,
+        requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+        tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+        cache=None,
+        namespace=None,
+    ):
+        self.model = model
+        self.model_name = getattr(model, "model_name", "gpt-3.5-turbo")
+        self.temperature = getattr(model, "temperature", None)
+        self.cache = cache
+        self.namespace = namespace
+        self.concurrency = concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = {}
+        self.stats = {
+            "requests": 0,
+            "cached": 0,
+            "coalesced": 0,
+            "retries": 0,
+            "tokens": 0,
+        }
+
+    def count_text_tokens(self, text):
+        return len(get_encoding(self.model_name).encode(text))
+
+    def start(self):
+        """Binds the engine to the running loop, done by run() for every run."""
+        # asyncio primitives are bound to the running loop, create them per run
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.requests = MinuteBudget(self.requests_per_minute)
+        self.tokens = MinuteBudget(self.tokens_per_minute)
+        self.in_flight = {}
+
+    async def ainvoke(self, messages):
+        """Returns the answer content, sharing identical calls already in flight."""
+        key = cache_key(self.model_name, self.temperature, messages)
+        if self.cache is not None:
+            content = self.cache.get(key)
+            if content is not None:
+                self.stats["cached"] += 1
+                return content
+
+        if key in self.in_flight:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        task = asyncio.ensure_future(self._invoke(messages))
+        self.in_flight[key] = task
+        try:
+            content = await task
+        finally:
+            self.in_flight.pop(key, None)
+        if self.cache is not None:
+            self.cache.put(key, content, self.namespace)
+        return content
+
+    def forget(self, messages):
+        """Drops a cached answer, e.g. one that failed validation."""
+        if self.cache is not None:
+            self.cache.delete(cache_key(self.model_name, self.temperature, messages))
+
+    async def _invoke(self, messages):
+        tokens = count_tokens(messages, self.model_name) + EXPECTED_OUTPUT_TOKENS
+        async with self.semaphore:
+            for attempt in range(MAX_RETRIES + 1):
+                await self.requests.acquire(1)
+                await self.tokens.acquire(tokens)
+                try:
+                    result = await self.model.ainvoke(messages)
+                    self.stats["requests"] += 1
+                    self.stats["tokens"] += tokens
+                    return result.content
+                except RETRYABLE_ERRORS:
+                    if attempt == MAX_RETRIES:
+                        raise
+                    self.stats["retries"] += 1
+                    # Exponential backoff with jitter so workers do not retry in step
+                    await asyncio.sleep(min(60, 2**attempt) * random.uniform(0.5, 1.5))
+
+    async def _run(self, coroutines):
+        self.start()
+        return await asyncio.gather(*coroutines)
+
+    def run(self, coroutines):
+        """Runs the coroutines concurrently and returns their results in order."""
+        started_at = time.monotonic()
+        results = asyncio.run(self._run(coroutines))
+        print(self.summary(time.monotonic() - started_at))
+        return results
+
+    def summary(self, elapsed):
+        return (
+            f"{self.stats['requests']} LLM requests ({self.stats['cached']} cached, "
+            f"{self.stats['coalesced']} coalesced, {self.stats['retries']} retries) "
+            f"in {elapsed:.1f}s."
+        )
+
+
+def create_engine(model, cache=None, namespace=None):
+    return AsyncExtractor(
+        model,
+        cache=cache,
+        namespace=namespace,
+        concurrency=int(os.getenv("LLM_CONCURRENCY", DEFAULT_CONCURRENCY)),
+        requests_per_minute=int(
+            os.getenv("LLM_REQUESTS_PER_MINUTE", DEFAULT_REQUESTS_PER_MINUTE)
+        ),
+        tokens_per_minute=int(
+            os.getenv("LLM_TOKENS_PER_MINUTE", DEFAULT_TOKENS_PER_MINUTE)
+        ),
+    )
@@ -0,0 +1,140 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+from attachment_store import file_sha256
+from llm_cache import hash_files
+
+# Constants
+MANIFEST_PATH = "manifest.sqlite"
+
+
+def processing_version(model_name, *parts, prompt_files=()):
+    """Identifies what produces an output: model, prompt files and other versions."""
+    return ":".join([model_name, *parts, hash_files(prompt_files)])
+
+
+class Manifest:
+    """Inputs already processed by each stage, with the version that processed them.
+
+    A file is unchanged when its size and modification time are the recorded
+    ones, which costs a stat call. When they differ, its content hash decides,
+    so a file that was only touched or copied is not processed again.
+    """
+
+    def __init__(self, namespace=None, version=None, force=False, path=MANIFEST_PATH):
+        self.namespace = namespace  # The stage whose outputs are tracked
+        self.version = version
+        self.force = force  # Processes every file, and records it again
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS processed (
+                namespace TEXT NOT NULL,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                version TEXT NOT NULL,
+                processed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, path)
+            )
+            """
+        )
+        self.connection.commit()
+        self.pending_files = {}  # path: (size, mtime_ns, sha256)
+        self.skipped = 0
+
+    def close(self):
+        self.connection.close()
+
+    def is_current(self, file_path):
+        stat = os.stat(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT size, mtime_ns, sha256, version FROM processed "
+                "WHERE namespace = ? AND path = ?",
+                (self.namespace, file_path),
+            ).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            if row[3] == self.version and not self.force:
+                return True
+            sha256 = row[2]
+        else:
+            sha256 = file_sha256(file_path)
+
+        current = row is not None and row[2:] == (sha256, self.version)
+        if current and not self.force:
+            # Same content under a new modification time, remember the new one
+            with self.lock:
+                self.connection.execute(
+                    "UPDATE processed SET size = ?, mtime_ns = ? "
+                    "WHERE namespace = ? AND path = ?",
+                    (stat.st_size, stat.st_mtime_ns, self.namespace, file_path),
+                )
+                self.connection.commit()
+            return True
+        with self.lock:
+            self.pending_files[file_path] = (stat.st_size, stat.st_mtime_ns, sha256)
+        return False
+
+    def pending(self, files):
+        """Yields the (file path, ...) items whose file is new or changed."""
+        for item in files:
+            if self.is_current(item[0]):
+                self.skipped += 1
+            else:
+                yield item
+
+    def record(self, file_path):
+        """Marks a file as processed, as it was when pending() saw it."""
+        with self.lock:
+            state = self.pending_files.pop(file_path, None)
+            if state is None:
+                return
+            self.connection.execute(
+                "INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.namespace, file_path, *state, self.version, time.time()),
+            )
+            self.connection.commit()
+
+    def forget(self):
+        """Forgets the files processed by the stage, or by every stage."""
+        with self.lock:
+            if self.namespace is None:
+                self.connection.execute("DELETE FROM processed")
+            else:
+                self.connection.execute(
+                    "DELETE FROM processed WHERE namespace = ?", (self.namespace,)
+                )
+            self.connection.commit()
+
+    def summary(self):
+        return f"{self.skipped} unchanged files skipped."
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the processing manifest.")
+    parser.add_argument(
+        "--forget",
+        metavar="NAMESPACE",
+        help='Forget the files processed by a stage ("json", "ttl", "graph", '
+        '"pipeline:<sinks>") or "all", so that the next run processes them again.',
+    )
+    args = parser.parse_args()
+
+    if args.forget:
+        manifest = Manifest(None if args.forget == "all" else args.forget)
+        manifest.forget()
+        manifest.close()
+        print(f"Forgot {args.forget}.")
+    manifest = Manifest()
+    rows = manifest.connection.execute(
+        "SELECT namespace, COUNT(*) FROM processed GROUP BY namespace"
+    ).fetchall()
+    for namespace, count in rows:
+        print(f"{namespace}: {count} files processed.")
+    manifest.close()
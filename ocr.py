@@ -0,0 +1,120 @@
+import importlib.metadata
+import json
+
+import pypdfium2 as pdfium
+
+from attachment_store import file_sha256
+from ocr_executor import PAGE_BREAK, PDFIUM_LOCK, OCRExecutor, render_pdf_pages
+
+# Architectures passed to ocr_predictor, part of the cache key with the doctr version
+OCR_CONFIG = {
+    "det_arch": "db_resnet50",
+    "reco_arch": "crnn_vgg16_bn",
+    "pretrained": True,
+}
+MIN_TEXT_LENGTH = 20
+MIN_PRINTABLE_RATIO = 0.95  # Broken font encodings extract as control characters
+MIN_ALNUM_RATIO = 0.5  # Pages of symbols or glyph ids are not real text
+
+
+def doctr_version():
+    # Read from the package metadata, importing doctr would load torch
+    try:
+        return importlib.metadata.version("python-doctr")
+    except importlib.metadata.PackageNotFoundError:
+        return "none"
+
+
+OCR_MODEL_VERSION = (
+    f"doctr-{doctr_version()}:{json.dumps(OCR_CONFIG, sort_keys=True)}:text-layer"
+)
+
+
+def create_local_predictor():
+    """Loads torch and the detection and recognition weights, seconds of work."""
+    from doctr.models import ocr_predictor
+
+    return ocr_predictor(**OCR_CONFIG)
+
+
+def extract_text_layer(file_path):
+    """Returns the embedded text of every page of a PDF."""
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        texts = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            texts.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        pdf.close()
+    return texts
+
+
+def is_usable_text(text):
+    stripped = text.strip()
+    if len(stripped) < MIN_TEXT_LENGTH:
+        return False
+    printable = sum(1 for c in stripped if c.isprintable() or c.isspace())
+    alnum = sum(1 for c in stripped if c.isalnum())
+    return (
+        "\ufffd" not in stripped
+        and printable / len(stripped) >= MIN_PRINTABLE_RATIO
+        and alnum / len(stripped) >= MIN_ALNUM_RATIO
+    )
+
+
+def ocr_pages(file_path, page_indices, predictor):
+    """Returns {page index: (text, export)} for the given pages of a PDF."""
+    if isinstance(predictor, OCRExecutor):
+        return predictor.ocr_pages(file_path, page_indices)
+    result = predictor(render_pdf_pages(file_path, page_indices))
+    return {
+        index: (page.render(), page.export())
+        for index, page in zip(page_indices, result.pages)
+    }
+
+
+def ocr_pdf(file_path, predictor):
+    """Uses the PDF text layer, OCRing only the pages where it is missing or garbled."""
+    texts = extract_text_layer(file_path)
+    pages = {
+        index: (text, {"page_idx": index, "source": "text_layer", "text": text})
+        for index, text in enumerate(texts)
+        if is_usable_text(text)
+    }
+    missing = [index for index in range(len(texts)) if index not in pages]
+    if missing:
+        pages.update(ocr_pages(file_path, missing, predictor))
+
+    ordered = [pages[index] for index in range(len(texts))]
+    raw_export = PAGE_BREAK.join(text for text, _ in ordered)
+    return raw_export, {"pages": [export for _, export in ordered]}
+
+
+def ocr_cache_key(file_path):
+    return f"{file_sha256(file_path)}:{OCR_MODEL_VERSION}"
+
+
+def ocr_document(file_path, predictor, cache=None):
+    """Returns the rendered text and the page/block/word export of a document."""
+    key = None
+    if cache is not None:
+        key = ocr_cache_key(file_path)
+        cached = cache.get(key)
+        if cached is not None:
+            # Cache hits never load the page rasters
+            return cached
+
+    if file_path.endswith(".pdf"):
+        raw_export, export = ocr_pdf(file_path, predictor)
+    else:
+        from doctr.io import DocumentFile
+
+        result = predictor(DocumentFile.from_images(file_path))
+        raw_export = result.render()
+        export = result.export()
+
+    if cache is not None:
+        cache.put(key, raw_export, export)
+    return raw_export, export
@@ -0,0 +1,79 @@
+import json
+import sqlite3
+import threading
+import time
+
+# Constants
+OCR_CACHE_PATH = "ocr_cache.sqlite"
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024  # 1 GB of rendered text and exports
+
+
+class OCRCache:
+    """On-disk OCR results keyed by file hash and OCR model version, evicted LRU."""
+
+    def __init__(self, path=OCR_CACHE_PATH, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ocr_results (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                export TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS ocr_results_last_access "
+            "ON ocr_results (last_access)"
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, key):
+        """Returns (text, export) for a cached result, or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT text, export FROM ocr_results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE ocr_results SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self.connection.commit()
+        return row[0], json.loads(row[1])
+
+    def put(self, key, text, export):
+        export = json.dumps(export, ensure_ascii=False, default=float)
+        size = len(text.encode("UTF-8")) + len(export.encode("UTF-8"))
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO ocr_results VALUES (?, ?, ?, ?, ?)",
+                (key, text, export, size, time.time()),
+            )
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        total = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM ocr_results"
+        ).fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self.connection.execute(
+            "SELECT key, size FROM ocr_results ORDER BY last_access"
+        )
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        self.connection.executemany("DELETE FROM ocr_results WHERE key = ?", evicted)
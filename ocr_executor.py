@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pypdfium2 as pdfium
+
+# Memory estimates used to size page batches on CPU-only hosts
+PAGE_MEMORY_ESTIMATE = 300 * 1024 * 1024  # Raster and activations of one page
+MODEL_MEMORY_ESTIMATE = 600 * 1024 * 1024  # Detection and recognition weights
+MAX_BATCH_SIZE = 16
+PDF_RENDER_SCALE = 2  # Same scale as DocumentFile.from_pdf
+PAGE_BREAK = "\n\n\n\n"  # Same separator as doctr's Document.render
+
+# Every worker process loads its own predictor once
+_predictor = None
+# pdfium is not thread-safe, a process opens one PDF at a time
+PDFIUM_LOCK = threading.Lock()
+
+
+def _init_worker(threads_per_worker):
+    global _predictor
+    import torch
+
+    from ocr import create_local_predictor
+
+    # Workers split the cores between them instead of each using all of them
+    torch.set_num_threads(threads_per_worker)
+    _predictor = create_local_predictor()
+
+
+def render_pdf_pages(file_path, page_indices):
+    """Rasterizes only the requested pages of a PDF, as DocumentFile.from_pdf would."""
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        pages = [
+            pdf[index].render(scale=PDF_RENDER_SCALE, rev_byteorder=True).to_numpy()
+            for index in page_indices
+        ]
+        pdf.close()
+    return pages
+
+
+def _ocr_pages(file_path, page_indices):
+    started_at = time.perf_counter()
+    if file_path.endswith(".pdf"):
+        pages = render_pdf_pages(file_path, page_indices)
+    else:
+        from doctr.io import DocumentFile
+
+        pages = DocumentFile.from_images(file_path)
+    result = _predictor(pages)
+    elapsed = time.perf_counter() - started_at
+    return (
+        page_indices,
+        [page.render() for page in result.pages],
+        [page.export() for page in result.pages],
+        elapsed,
+    )
+
+
+def _ocr_document(file_path):
+    from ocr import ocr_document
+
+    started_at = time.perf_counter()
+    text, export = ocr_document(file_path, _predictor)
+    return text, export, time.perf_counter() - started_at
+
+
+def available_memory():
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 * 1024 * 1024
+
+
+def tune_batch_size(workers):
+    """Returns the number of pages a worker can OCR at once in the free RAM."""
+    per_worker = available_memory() // workers - MODEL_MEMORY_ESTIMATE
+    return max(1, min(MAX_BATCH_SIZE, per_worker // PAGE_MEMORY_ESTIMATE))
+
+
+def page_count(file_path):
+    if not file_path.endswith(".pdf"):
+        return 1
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(file_path)
+        count = len(pdf)
+        pdf.close()
+    return count
+
+
+class OCRExecutor:
+    """Spreads the pages of documents over a pool of processes holding a predictor."""
+
+    def __init__(self, workers=None, batch_size=None):
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size or tune_batch_size(self.workers)
+        threads_per_worker = max(1, os.cpu_count() // self.workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(threads_per_worker,),
+        )
+        self.page_timings = []  # (file path, page index, seconds)
+        self.busy_time = 0.0
+        # Busy time is wall time with at least one page batch or document in flight
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.busy_since = None
+
+    def close(self):
+        self.executor.shutdown()
+
+    def warm_up(self):
+        """Starts the workers now, so that the first document does not wait for them.
+
+        Each worker loads its predictor when it starts.
+        """
+        futures = [self.executor.submit(os.getpid) for _ in range(self.workers)]
+        return len({future.result() for future in futures})
+
+    def start_busy(self):
+        with self.lock:
+            if not self.in_flight:
+                self.busy_since = time.perf_counter()
+            self.in_flight += 1
+
+    def end_busy(self):
+        with self.lock:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.busy_time += time.perf_counter() - self.busy_since
+
+    def ocr_pages(self, file_path, page_indices):
+        """Returns {page index: (text, export)} for the requested pages.
+
+        The pages are split in batches over every worker, so that a long scan
+        does not run on a single process.
+        """
+        batches = [
+            page_indices[i : i + self.batch_size]
+            for i in range(0, len(page_indices), self.batch_size)
+        ]
+        futures = [
+            self.executor.submit(_ocr_pages, file_path, batch) for batch in batches
+        ]
+
+        self.start_busy()
+        try:
+            pages = {}
+            for future in futures:
+                indices, texts, exports, elapsed = future.result()
+                for index, text, export in zip(indices, texts, exports):
+                    pages[index] = (text, export)
+                    with self.lock:
+                        self.page_timings.append(
+                            (file_path, index, elapsed / len(indices))
+                        )
+        finally:
+            self.end_busy()
+        return pages
+
+    def submit_document(self, file_path):
+        """Returns a future of (text, export, seconds) for a whole document.
+
+        Used for single pages and images, which cannot be split over the workers.
+        """
+        self.start_busy()
+        future = self.executor.submit(_ocr_document, file_path)
+        future.add_done_callback(lambda future: self.document_done(file_path, future))
+        return future
+
+    def document_done(self, file_path, future):
+        """Records the OCR time of a whole document, spread over its OCR'd pages."""
+        self.end_busy()
+        with self.lock:
+            if future.cancelled() or future.exception() is not None:
+                return
+            _, export, seconds = future.result()
+            pages = [
+                index
+                for index, page in enumerate(export.get("pages", []))
+                if page.get("source") != "text_layer"
+            ]
+            for index in pages:
+                self.page_timings.append((file_path, index, seconds / len(pages)))
+
+    def summary(self):
+        count = len(self.page_timings)
+        if not count:
+            return "No page OCR'd."
+        page_time = sum(seconds for _, _, seconds in self.page_timings)
+        slowest = max(self.page_timings, key=lambda timing: timing[2])
+        return (
+            f"OCR'd {count} pages with {self.workers} workers and batches of "
+            f"{self.batch_size} in {self.busy_time:.1f}s "
+            f"({count / self.busy_time:.2f} pages/s, "
+            f"{page_time / count:.2f}s per page, slowest: {slowest[0]} "
+            f"page {slowest[1] + 1} in {slowest[2]:.2f}s)."
+        )
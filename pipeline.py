@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+from dotenv import load_dotenv, find_dotenv
+
+import graph_preprocessing
+import json_preprocessing
+from llm_cache import LLMCache
+from llm_engine import create_engine
+from manifest import Manifest, processing_version
+from ocr import OCR_MODEL_VERSION
+from ocr_cache import OCRCache
+from staged_pipeline import StagedPipeline, walk_corpus
+
+load_dotenv(find_dotenv())
+
+DOCUMENTS_FOLDER = "./Documents"
+THREADS_FOLDER = "./threads"
+
+
+class JsonSink:
+    """Extracts the JSON metadata of a document, as json_preprocessing.py does."""
+
+    name = "json"
+
+    def __init__(self, model, llm_cache):
+        # JSON mode only for this sink, the other ones answer in Turtle or Cypher
+        self.model = model.bind(**json_preprocessing.JSON_MODE)
+        llm_cache.invalidate_if_changed("json", json_preprocessing.PROMPT_FILES)
+        # Same cache namespace as json_preprocessing.py, which reuses the answers
+        self.engine = create_engine(self.model, cache=llm_cache, namespace="json")
+        self.prompts = json_preprocessing.load_prompts()
+
+    async def process(self, document):
+        json_output = await json_preprocessing.extract_document(
+            self.engine, document, *self.prompts
+        )
+        document["json_output"] = json_output
+        # Documents/ outputs go to ./outputs, email outputs next to the email
+        await asyncio.to_thread(json_preprocessing.save_document, document, json_output)
+
+    def close(self):
+        pass
+
+
+class TurtleSink:
+    """Extracts the RDF Turtle of a document, as graph_preprocessing.py does."""
+
+    name = "ttl"
+
+    def __init__(self, model, llm_cache):
+        llm_cache.invalidate_if_changed("ttl", graph_preprocessing.PROMPT_FILES)
+        self.engine = create_engine(model, cache=llm_cache, namespace="ttl")
+        self.systemPrompt, self.prompt = graph_preprocessing.load_prompts()
+
+    async def process(self, document):
+        ttl_content = await graph_preprocessing.generate_document(
+            self.engine, document, self.prompt
+        )
+        document["ttl_content"] = ttl_content
+        # Documents/ outputs go to ./outputs, email outputs next to the email
+        await asyncio.to_thread(graph_preprocessing.save_document, document, ttl_content)
+
+    def close(self):
+        pass
+
+
+class Neo4jSink:
+    """Loads the JSON metadata produced by the json sink into Neo4j."""
+
+    name = "neo4j"
+    engine = None
+
+    def __init__(self, model, llm_cache):
+        # Neo4j and the entity index are only loaded when this sink runs
+        import create_graph
+
+        self.connector = create_graph.Neo4JConnector(
+            create_graph.NEO4J_URI, create_graph.NEO4J_USER, create_graph.NEO4J_PASSWORD
+        )
+        self.connector.create_constraints()
+        self.loader = create_graph.GraphLoader(
+            self.connector, entity_index=create_graph.EntityIndex.load()
+        )
+        # Documents are processed concurrently, the loader takes one at a time
+        self.lock = threading.Lock()
+
+    async def process(self, document):
+        if "json_output" not in document:
+            print(f"No JSON metadata for {document['file_path']}, skipping.")
+            return
+        # A full batch is written to Neo4j, off the event loop
+        await asyncio.to_thread(self.add, document["json_output"])
+
+    def add(self, json_output):
+        with self.lock:
+            self.loader.add(json_output)
+
+    def close(self):
+        self.loader.flush()
+        self.loader.summary()
+        self.connector.close()
+
+
+# Sinks run in this order for every document
+SINKS = {
+    JsonSink.name: JsonSink,
+    TurtleSink.name: TurtleSink,
+    Neo4jSink.name: Neo4jSink,
+}
+
+
+def iter_corpus(documents_folder=DOCUMENTS_FOLDER, threads_folder=THREADS_FOLDER):
+    """Yields (file path, email processing) for every input file of the corpus."""
+    return walk_corpus(documents_folder, threads_folder)
+
+
+async def process_document(sinks, document):
+    """Hands a document, read once, to every sink in turn."""
+    failed = []
+    for sink in sinks:
+        try:
+            await sink.process(document)
+        except Exception as e:
+            print(f"Error in the {sink.name} sink for {document['file_path']}: {e}")
+            failed.append(sink.name)
+    if failed:
+        raise RuntimeError(f"Failed in the {', '.join(failed)} sinks")
+
+
+async def run_pipeline(pipeline, engines, files):
+    # The rate limiters of every engine are bound to the loop the sinks run on
+    for engine in engines:
+        engine.start()
+    return await pipeline.arun(files)
+
+
+def main(sink_names=list(SINKS), force=False):
+    from langchain_openai import ChatOpenAI
+
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable not set")
+
+    # The OCR models and the LLM client are loaded once for every sink
+    model = ChatOpenAI(api_key=api_key, model="gpt-3.5-turbo")
+    ocr_cache = OCRCache()
+    llm_cache = LLMCache()
+    sinks = [SINKS[name](model, llm_cache) for name in SINKS if name in sink_names]
+    engines = [sink.engine for sink in sinks if sink.engine is not None]
+    # Each set of sinks has its own manifest, inputs it already processed with
+    # the same model, OCR and prompts are skipped
+    manifest = Manifest(
+        "pipeline:" + "+".join(sink.name for sink in sinks),
+        processing_version(
+            model.model_name,
+            OCR_MODEL_VERSION,
+            prompt_files=json_preprocessing.PROMPT_FILES
+            + graph_preprocessing.PROMPT_FILES,
+        ),
+        force=force,
+    )
+
+    # As many documents go through the sinks at once as the first engine allows,
+    # while the OCR processes already read the next documents
+    processed_files = []
+    pipeline = StagedPipeline(
+        extract=lambda document: process_document(sinks, document),
+        write=lambda document, _: processed_files.append(document["file_path"]),
+        engine=engines[0] if engines else None,
+        ocr_cache=ocr_cache,
+        documents_output_dir="./outputs",
+    )
+    started_at = time.monotonic()
+    asyncio.run(run_pipeline(pipeline, engines, manifest.pending(iter_corpus())))
+    for sink in sinks:
+        if sink.engine is not None:
+            print(f"{sink.name}: {sink.engine.summary(time.monotonic() - started_at)}")
+
+    for sink in sinks:
+        sink.close()
+    # Recorded once the sinks flushed what they buffer
+    for file_path in processed_files:
+        manifest.record(file_path)
+    print(manifest.summary())
+    manifest.close()
+    llm_cache.close()
+    ocr_cache.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="OCR the corpus once and fan each document out to the sinks."
+    )
+    parser.add_argument(
+        "--sinks",
+        default=",".join(SINKS),
+        help=f"Comma-separated sinks to run, among {', '.join(SINKS)}.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Process every input, even those unchanged since their last run.",
+    )
+    args = parser.parse_args()
+    main(sink_names=args.sinks.split(","), force=args.force)
@@ -0,0 +1,93 @@
+import json
+import re
+
+from json_schema import derive_schema
+
+# Keywords hinting at the document type of each example, in French and English
+DOCUMENT_TYPE_KEYWORDS = {
+    "contract": ["contrat", "contract", "travail", "employeur", "employer", "clause"],
+    "bill": ["facture", "invoice", "bill", "montant", "amount due", "tva", "paiement"],
+    "reminder": ["rappel", "reminder", "rendez-vous", "appointment", "échéance"],
+    "state_communication": [
+        "administration",
+        "impôt",
+        "tax",
+        "attestation",
+        "canton",
+        "department",
+    ],
+}
+MAX_EXAMPLES = 1
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# Keywords only match at the start of a word, "tax" must not match "syntax"
+KEYWORD_PATTERNS = {
+    document_type: re.compile(
+        r"\b(?:" + "|".join(re.escape(keyword) for keyword in keywords) + ")"
+    )
+    for document_type, keywords in DOCUMENT_TYPE_KEYWORDS.items()
+}
+
+
+def compact_json(data):
+    """Renders JSON without indentation, the cheapest form in tokens."""
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+def describe_value(key, values):
+    if all(isinstance(value, dict) for value in values):
+        fields = list(dict.fromkeys(field for value in values for field in value))
+        return f"- {key}: {{{', '.join(fields)}}}"
+    if all(isinstance(value, str) and DATE_PATTERN.match(value) for value in values):
+        return f"- {key}: YYYY-MM-DD"
+    if key == "document_type":
+        return f"- {key}: {', '.join(values)}, ..."
+    return f"- {key}"
+
+
+def describe_schema(examples):
+    """Lists the keys shared by the examples and the type-specific ones."""
+    keys = list(dict.fromkeys(key for example in examples for key in example))
+    lines = []
+    specific = []
+    for key in keys:
+        values = [example[key] for example in examples if key in example]
+        if len(values) > 1:
+            lines.append(describe_value(key, values))
+        else:
+            specific.append(key)
+    if specific:
+        lines.append(f"- document-specific objects, such as {', '.join(specific)}")
+    return "\n".join(lines)
+
+
+class PromptExamples:
+    """Reference JSON files, rendered once and picked per document."""
+
+    def __init__(self, examples, max_examples=MAX_EXAMPLES):
+        self.examples = examples
+        self.max_examples = max_examples
+        self.rendered = [compact_json(example) for example in examples]
+        self.schema = describe_schema(examples)
+        self.json_schema = derive_schema(examples)
+
+    def select(self, document_text):
+        """Returns the indexes of the examples closest to the document type."""
+        text = document_text.lower()
+        scores = []
+        for index, example in enumerate(self.examples):
+            pattern = KEYWORD_PATTERNS.get(example.get("document_type"))
+            score = len(pattern.findall(text)) if pattern else 0
+            if score:
+                scores.append((-score, index))
+        if scores:
+            return [index for _, index in sorted(scores)[: self.max_examples]]
+
+        # Nothing matched, which is the case of most emails: the shortest example
+        # shows the format at the lowest cost
+        by_length = sorted(
+            range(len(self.rendered)), key=lambda index: len(self.rendered[index])
+        )
+        return by_length[: self.max_examples]
+
+    def render(self, document_text):
+        return "\n\n".join(self.rendered[index] for index in self.select(document_text))
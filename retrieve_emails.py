@@ -8,26 +8,50 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 import re
+import argparse
+from requests import RequestException
+from concurrent.futures import ThreadPoolExecutor
+from gmail_fetch import DEFAULT_BATCH_SIZE, DEFAULT_WORKERS, GmailFetcher
+from attachment_store import DEFAULT_CHUNK_SIZE, AttachmentStore, load_references
+from email_headers import extract_sender_email
 
 # Constants
 JSON_FILE_PATH = "threads_metadata.json"
+SYNC_STATE_FILE_PATH = "sync_state.json"
+BACKFILL_CHECKPOINT_FILE_PATH = "backfill_checkpoint.json"
+STREAM_THRESHOLD = 5 * 1024 * 1024  # Attachments above this size are streamed to disk
 THREADS_FOLDER_PATH = "threads"
+HISTORY_TYPES = ["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"]
 
-# Load credentials from the token file
+# Credentials and Gmail API service, loaded on first use so that the helpers of
+# this module can be imported without a token
 creds = None
-if os.path.exists("token.pickle"):
-    with open("token.pickle", "rb") as token:
-        creds = pickle.load(token)
-
-# If there are no valid credentials, let the user log in
-if not creds or not creds.valid:
-    if creds and creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-    else:
-        raise ValueError("No valid credentials provided.")
+service = None
+
+# Attachments are stored once in a content-addressed store shared by all emails
+attachment_store = AttachmentStore()
+
+
+def get_service():
+    """Loads the credentials from the token file and builds the Gmail API service."""
+    global creds, service
+    if service is not None:
+        return service
 
-# Build the Gmail API service
-service = build("gmail", "v1", credentials=creds)
+    if os.path.exists("token.pickle"):
+        with open("token.pickle", "rb") as token:
+            creds = pickle.load(token)
+
+    # If there are no valid credentials, let the user log in
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            raise ValueError("No valid credentials provided.")
+
+    # Build the Gmail API service
+    service = build("gmail", "v1", credentials=creds)
+    return service
 
 
 def load_threads_metadata():
@@ -42,10 +66,39 @@ def save_threads_metadata(threads_metadata):
         json.dump(threads_metadata, f, indent=4)
 
 
+def load_sync_state():
+    if os.path.exists(SYNC_STATE_FILE_PATH):
+        with open(SYNC_STATE_FILE_PATH, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_sync_state(sync_state):
+    with open(SYNC_STATE_FILE_PATH, "w") as f:
+        json.dump(sync_state, f, indent=4)
+
+
+def load_backfill_checkpoint():
+    if os.path.exists(BACKFILL_CHECKPOINT_FILE_PATH):
+        with open(BACKFILL_CHECKPOINT_FILE_PATH, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_backfill_checkpoint(checkpoint):
+    # Write to a temporary file and rename it, a crash never leaves half a checkpoint
+    tmp_path = f"{BACKFILL_CHECKPOINT_FILE_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, BACKFILL_CHECKPOINT_FILE_PATH)
+
+
 def get_threads(user_id="me", label_ids=[], max_results=10):
     try:
         response = (
-            service.users()
+            get_service().users()
             .threads()
             .list(userId=user_id, labelIds=label_ids, maxResults=max_results)
             .execute()
@@ -57,9 +110,25 @@ def get_threads(user_id="me", label_ids=[], max_results=10):
         return None
 
 
-def extract_sender_email(header_from):
-    match = re.search(r"<(.+?)>", header_from)
-    return match.group(1) if match else header_from
+def iter_thread_pages(user_id="me", label_ids=[], query=None, page_token=None, page_size=100):
+    """Yields (thread ids, next page token) for every page of the thread list."""
+    while True:
+        response = (
+            get_service().users()
+            .threads()
+            .list(
+                userId=user_id,
+                labelIds=label_ids,
+                q=query,
+                maxResults=page_size,
+                pageToken=page_token,
+            )
+            .execute()
+        )
+        page_token = response.get("nextPageToken")
+        yield [thread["id"] for thread in response.get("threads", [])], page_token
+        if not page_token:
+            return
 
 
 def create_thread_folder(thread_id):
@@ -79,19 +148,27 @@ def create_email_folder(thread_folder_path, from_email, internal_date):
     return email_folder_path
 
 
-def get_thread_details(thread_id, user_id="me"):
-    try:
-        thread = service.users().threads().get(userId=user_id, id=thread_id).execute()
-        messages = thread.get("messages", [])
+def get_thread_details(thread_ids, fetcher):
+    """Fetches the threads in batches and saves their messages, keyed by thread id."""
+    threads = fetcher.get_threads(thread_ids)
 
-        for message in messages:
-            process_message(message, thread_id)
+    with ThreadPoolExecutor(max_workers=fetcher.workers) as executor:
+        email_folders = executor.map(
+            lambda thread: process_thread(thread, fetcher), threads.values()
+        )
+        return dict(zip(threads.keys(), email_folders))
 
-    except HttpError as error:
-        print(f"An error occurred: {error}")
+
+def process_thread(thread, fetcher):
+    email_folders = {}
+    for message in thread.get("messages", []):
+        email_folder_path = process_message(message, thread["id"], fetcher)
+        if email_folder_path:
+            email_folders[message["id"]] = email_folder_path
+    return email_folders
 
 
-def process_message(message, thread_id):
+def process_message(message, thread_id, fetcher):
     try:
         headers = {
             header["name"]: header["value"] for header in message["payload"]["headers"]
@@ -147,10 +224,13 @@ def process_message(message, thread_id):
             json.dump(metadata, f, indent=4)
 
         # Download and save attachments
-        get_attachments(message, email_folder_path)
+        get_attachments(message, email_folder_path, fetcher)
+
+        return email_folder_path
 
     except HttpError as error:
         print(f"An error occurred: {error}")
+        return None
 
 
 def extract_latest_text(payload):
@@ -193,48 +273,366 @@ def remove_previous_conversations(email_message):
     return "\n".join(new_lines)
 
 
-def get_attachments(message, folder_name):
-    if "parts" in message["payload"]:
-        for part in message["payload"]["parts"]:
-            if part["filename"]:
-                attachment_id = part["body"]["attachmentId"]
-                attachment = (
-                    service.users()
-                    .messages()
-                    .attachments()
-                    .get(userId="me", messageId=message["id"], id=attachment_id)
-                    .execute()
+def get_attachments(message, folder_name, fetcher):
+    if "parts" not in message["payload"]:
+        return
+
+    references = load_references(folder_name)
+    parts = {}
+    for part in message["payload"]["parts"]:
+        if not part["filename"]:
+            continue
+        filename = part["filename"]
+        attachment_id = part["body"]["attachmentId"]
+
+        if filename in references and os.path.exists(
+            os.path.join(folder_name, filename)
+        ):
+            continue  # Already saved in this email folder
+
+        sha256 = attachment_store.lookup(attachment_id)
+        if sha256:
+            attachment_store.link(sha256, folder_name, filename)
+            print(f"Attachment {filename} already stored, download skipped.")
+            continue
+
+        key = (message["id"], attachment_id)
+        if part["body"].get("size", 0) > STREAM_THRESHOLD:
+            try:
+                sha256 = attachment_store.put_stream(
+                    fetcher.stream_attachment(key),
+                    attachment_id=attachment_id,
+                    filename=filename,
                 )
-                data = base64.urlsafe_b64decode(attachment["data"].encode("UTF-8"))
-                path = os.path.join(folder_name, part["filename"])
-                with open(path, "wb") as f:
-                    f.write(data)
-                    print(f'Attachment {part["filename"]} downloaded.')
+            except (RequestException, ValueError) as error:
+                print(f"An error occurred downloading {filename}: {error}")
+                continue
+            attachment_store.link(sha256, folder_name, filename)
+            print(f"Attachment {filename} downloaded.")
+            continue
+
+        parts[key] = part
+
+    # All the missing small attachments of a message are fetched in a single batch
+    attachments = fetcher.get_attachments(parts.keys())
+
+    for key, part in parts.items():
+        attachment = attachments.get(key)
+        if attachment is None:
+            continue
+        data = base64.urlsafe_b64decode(attachment["data"].encode("UTF-8"))
+        sha256 = attachment_store.put(
+            data, attachment_id=key[1], filename=part["filename"]
+        )
+        attachment_store.link(sha256, folder_name, part["filename"])
+        print(f'Attachment {part["filename"]} downloaded.')
 
 
-def main():
-    threads_metadata = load_threads_metadata()
-    threads = get_threads(max_results=30)  # Retrieve the 30 latest threads
+def get_current_history_id(user_id="me"):
+    profile = get_service().users().getProfile(userId=user_id).execute()
+    return profile["historyId"]
+
+
+def get_history(start_history_id, user_id="me"):
+    """Returns every history record since start_history_id, or None if it expired."""
+    history = []
+    page_token = None
+    try:
+        while True:
+            response = (
+                get_service().users()
+                .history()
+                .list(
+                    userId=user_id,
+                    startHistoryId=start_history_id,
+                    historyTypes=HISTORY_TYPES,
+                    pageToken=page_token,
+                )
+                .execute()
+            )
+            history.extend(response.get("history", []))
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return history, response.get("historyId", start_history_id)
+    except HttpError as error:
+        # Gmail only keeps about a week of history, older ids answer with a 404
+        if error.resp.status == 404:
+            print(f"History {start_history_id} has expired, a full resync is needed.")
+            return None, None
+        raise
+
+
+def record_email_folders(threads_metadata, thread_id, email_folders):
+    current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if thread_id not in threads_metadata:
+        threads_metadata[thread_id] = {
+            "id": thread_id,
+            "created_at": current_datetime,
+        }
+    else:
+        threads_metadata[thread_id]["created_at"] = current_datetime
+    threads_metadata[thread_id].setdefault("messages", {}).update(email_folders)
+
+
+def find_email_folder(threads_metadata, message_id, thread_id):
+    thread_metadata = threads_metadata.get(thread_id, {})
+    return thread_metadata.get("messages", {}).get(message_id)
+
+
+def update_email_metadata(email_folder_path, **changes):
+    metadata_file = os.path.join(email_folder_path, "metadata.json")
+    if not os.path.exists(metadata_file):
+        return
+    with open(metadata_file, "r") as f:
+        metadata = json.load(f)
+    metadata.update(changes)
+    with open(metadata_file, "w") as f:
+        json.dump(metadata, f, indent=4)
+
+
+def apply_history(history, threads_metadata, fetcher):
+    """Applies history records and returns the folders of the newly saved emails."""
+    labels = {}
+    deleted = {}
+
+    # Collapse the records so every message is fetched or updated at most once
+    for record in history:
+        for item in record.get("messagesAdded", []):
+            message = item["message"]
+            labels[message["id"]] = message
+        for item in record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+            message = item["message"]
+            labels[message["id"]] = message
+        for item in record.get("messagesDeleted", []):
+            message = item["message"]
+            deleted[message["id"]] = message
+
+    missing_ids = []
+    for message_id, message in labels.items():
+        if message_id in deleted:
+            continue
+        label_ids = message.get("labelIds", [])
+        email_folder_path = find_email_folder(
+            threads_metadata, message_id, message["threadId"]
+        )
+
+        if email_folder_path:
+            update_email_metadata(email_folder_path, labelIds=label_ids)
+        elif "CATEGORY_PERSONAL" in label_ids:
+            # Unknown message: only download it if it would pass the label filter
+            missing_ids.append(message_id)
+
+    new_email_folders = []
+    for message_id, full_message in fetcher.get_messages(missing_ids).items():
+        thread_id = full_message["threadId"]
+        email_folder_path = process_message(full_message, thread_id, fetcher)
+        if email_folder_path:
+            record_email_folders(
+                threads_metadata, thread_id, {message_id: email_folder_path}
+            )
+            new_email_folders.append(email_folder_path)
+
+    for message_id, message in deleted.items():
+        email_folder_path = find_email_folder(
+            threads_metadata, message_id, message["threadId"]
+        )
+        if email_folder_path:
+            # Keep the files, downstream outputs may still reference them
+            update_email_metadata(email_folder_path, deleted=True)
+
+    return new_email_folders
+
+
+def full_sync(threads_metadata, fetcher, max_results=30):
+    # Read the history id first so changes made during the sync are caught next time
+    history_id = get_current_history_id()
+    threads = get_threads(max_results=max_results)
 
     if threads:
-        for thread in threads:
-            thread_id = thread["id"]
-            current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-            if thread_id not in threads_metadata:
-                # New thread, create a new entry in the JSON file
-                threads_metadata[thread_id] = {
-                    "id": thread_id,
-                    "created_at": current_datetime,
-                }
-            else:
-                # Existing thread, update the "created_at" value with the current time
-                threads_metadata[thread_id]["created_at"] = current_datetime
-
-            # Process thread details only if it's not already processed
-            get_thread_details(thread_id)
+        thread_ids = [thread["id"] for thread in threads]
+        for thread_id, email_folders in get_thread_details(thread_ids, fetcher).items():
+            record_email_folders(threads_metadata, thread_id, email_folders)
+
+    return history_id
+
+
+def incremental_sync(threads_metadata, fetcher, start_history_id):
+    history, history_id = get_history(start_history_id)
+    if history is None:
+        return None
+
+    new_email_folders = apply_history(history, threads_metadata, fetcher)
+    print(
+        f"Applied {len(history)} history records since {start_history_id}, "
+        f"{len(new_email_folders)} new emails saved."
+    )
+    return history_id
+
+
+def backfill(threads_metadata, fetcher, query=None, label_ids=[]):
+    """Walks every page of the mailbox, resuming from the last checkpoint."""
+    checkpoint = load_backfill_checkpoint()
+    if checkpoint.get("query") != query or checkpoint.get("labelIds") != label_ids:
+        if checkpoint:
+            print("Backfill filters changed, starting from the first page.")
+        checkpoint = {
+            "query": query,
+            "labelIds": label_ids,
+            "pageToken": None,
+            "pendingIds": [],
+            "processedIds": [],
+            "listed": False,
+            "completed": False,
+        }
+    elif checkpoint.get("completed"):
+        print("Backfill already completed for these filters.")
+        return
+    else:
+        print(f"Resuming backfill after {len(checkpoint['processedIds'])} threads.")
+
+    processed_ids = set(checkpoint["processedIds"])
+
+    def backfill_threads(thread_ids, next_page_token):
+        thread_ids = [
+            thread_id
+            for thread_id in checkpoint["pendingIds"] + thread_ids
+            if thread_id not in processed_ids
+        ]
+        email_folders = get_thread_details(thread_ids, fetcher)
+        for thread_id, folders in email_folders.items():
+            record_email_folders(threads_metadata, thread_id, folders)
+            processed_ids.add(thread_id)
+
+        # Threads that failed every retry are tried again with the next page
+        checkpoint["pendingIds"] = [
+            thread_id for thread_id in thread_ids if thread_id not in email_folders
+        ]
+        checkpoint["processedIds"] = sorted(processed_ids)
+        checkpoint["pageToken"] = next_page_token
+        checkpoint["listed"] = next_page_token is None
+        checkpoint["completed"] = next_page_token is None and not checkpoint["pendingIds"]
+        save_threads_metadata(threads_metadata)
+        attachment_store.save()
+        save_backfill_checkpoint(checkpoint)
+        print(f"Backfilled {len(processed_ids)} threads. {fetcher.summary()}")
+
+    try:
+        if not checkpoint.get("listed"):
+            # Threads are processed page by page as the listing goes on
+            pages = iter_thread_pages(
+                label_ids=label_ids, query=query, page_token=checkpoint["pageToken"]
+            )
+            for thread_ids, next_page_token in pages:
+                backfill_threads(thread_ids, next_page_token)
+        if checkpoint["pendingIds"]:
+            # The last page's failures have no next page to be retried with
+            backfill_threads([], None)
+        if not checkpoint["completed"]:
+            print(
+                f"{len(checkpoint['pendingIds'])} threads still failing, "
+                "run the backfill again to retry them."
+            )
+    except HttpError as error:
+        if error.resp.status in (403, 429):
+            print(f"Quota exhausted, run the backfill again to resume: {error}")
+            return
+        raise
+
+
+def main(
+    full=False,
+    workers=DEFAULT_WORKERS,
+    batch_size=DEFAULT_BATCH_SIZE,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    backfill_mode=False,
+    query=None,
+    label_ids=[],
+):
+    threads_metadata = load_threads_metadata()
+    sync_state = load_sync_state()
+    fetcher = GmailFetcher(
+        get_service(), creds, workers=workers, batch_size=batch_size, chunk_size=chunk_size
+    )
+
+    if backfill_mode:
+        # Later syncs pick up whatever arrives while the backfill is running
+        if not sync_state.get("historyId"):
+            sync_state["historyId"] = get_current_history_id()
+            save_sync_state(sync_state)
+        backfill(threads_metadata, fetcher, query=query, label_ids=label_ids)
+        fetcher.close()
+        print(fetcher.summary())
+        return
+
+    history_id = None
+    if not full and sync_state.get("historyId"):
+        history_id = incremental_sync(
+            threads_metadata, fetcher, sync_state["historyId"]
+        )
+
+    if history_id is None:
+        # Retrieve the 30 latest threads
+        history_id = full_sync(threads_metadata, fetcher)
+
+    fetcher.close()
+    print(fetcher.summary())
 
     save_threads_metadata(threads_metadata)
+    attachment_store.save()
+    sync_state["historyId"] = history_id
+    sync_state["synced_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    save_sync_state(sync_state)
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Retrieve Gmail threads.")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the stored historyId and resync the latest threads.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Number of concurrent batch requests.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Number of requests grouped in one Gmail HTTP batch.",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="Bytes read at a time when streaming large attachments to disk.",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="Walk every page of the mailbox, resuming from the last checkpoint.",
+    )
+    parser.add_argument(
+        "--query",
+        default=None,
+        help='Gmail search filter for the backfill, e.g. "after:2024/01/01".',
+    )
+    parser.add_argument(
+        "--label",
+        action="append",
+        default=[],
+        dest="label_ids",
+        help="Only backfill threads with this label id (repeatable).",
+    )
+    args = parser.parse_args()
+    main(
+        full=args.full,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size,
+        backfill_mode=args.backfill,
+        query=args.query,
+        label_ids=args.label_ids,
+    )
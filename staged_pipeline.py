@@ -0,0 +1,290 @@
+import asyncio
+import os
+import time
+
+from ocr import MIN_TEXT_LENGTH, ocr_cache_key, ocr_document
+from ocr_executor import OCRExecutor, page_count
+
+# Constants
+DOCUMENTS_FOLDER = "./Documents"
+THREADS_FOLDER = "./threads"
+TEXT_EXTENSIONS = (".txt",)
+OCR_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg")
+# Documents waiting between two stages, bounds the memory held by a slow stage
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "32"))
+# OCR processes, each holding its own predictor (about MODEL_MEMORY_ESTIMATE of
+# RAM). Unset means 2, OCR_WORKERS=0 still means one per core
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+
+
+def scan_folder(folder_path):
+    """Returns the (sorted) file and folder entries of a folder."""
+    with os.scandir(folder_path) as entries:
+        return sorted(entries, key=lambda entry: entry.name)
+
+
+def walk_corpus(
+    documents_folder=DOCUMENTS_FOLDER,
+    threads_folder=THREADS_FOLDER,
+    extensions=TEXT_EXTENSIONS + OCR_EXTENSIONS,
+):
+    """Yields (file path, email processing) for the input files of the corpus.
+
+    The files of Documents/ come first, then those of every
+    threads/<thread>/<email>/ folder. scandir gives the file type with the name,
+    without a stat call per entry.
+    """
+    if os.path.isdir(documents_folder):
+        for entry in scan_folder(documents_folder):
+            if entry.is_file() and entry.name.endswith(extensions):
+                yield entry.path, False
+
+    if not os.path.isdir(threads_folder):
+        return
+    for thread in scan_folder(threads_folder):
+        if not thread.is_dir():
+            continue
+        for email in scan_folder(thread.path):
+            if not email.is_dir():
+                continue
+            for entry in scan_folder(email.path):
+                if entry.is_file() and entry.name.endswith(extensions):
+                    yield entry.path, True
+
+
+def read_text_file(file_path):
+    with open(file_path, "r", encoding="UTF-8") as file:
+        return file.read()
+
+
+class StagedPipeline:
+    """Walks, OCRs, extracts and writes documents in overlapping stages.
+
+    The walker feeds a bounded queue read by as many OCR tasks as there are OCR
+    processes, which feed the LLM tasks, which feed a single writer. A full queue
+    holds back the stage before it, so every stage stays busy without documents
+    piling up in memory.
+    """
+
+    def __init__(
+        self,
+        extract=None,
+        write=None,
+        engine=None,
+        ocr_cache=None,
+        documents_output_dir=None,
+        manifest=None,
+        ocr_executor=None,
+        queue_size=QUEUE_SIZE,
+    ):
+        self.extract = extract
+        self.write = write
+        self.engine = engine
+        self.ocr_cache = ocr_cache
+        self.documents_output_dir = documents_output_dir
+        # Unchanged files are skipped, written ones recorded
+        self.manifest = manifest
+        # Without an executor, one is started by the first document needing OCR
+        # and closed at the end of the run, runs over emails never start it
+        self.ocr_executor = ocr_executor
+        self.owns_ocr_executor = ocr_executor is None
+        if ocr_executor is not None:
+            self.ocr_workers = ocr_executor.workers
+        else:
+            self.ocr_workers = OCR_WORKERS or os.cpu_count()
+        self.queue_size = queue_size
+        self.documents = []  # Read documents, when there is no extract stage
+        self.results = []  # (file name, output dir, error or None)
+        self.stats = {"files": 0, "read": 0, "skipped": 0, "ocr": 0, "written": 0}
+        self.busy = {"ocr": 0.0, "llm": 0.0, "write": 0.0}
+
+    def run(self, files):
+        """Runs every stage over the files, returns [(file name, output dir, error)]."""
+        if self.engine is not None:
+            # The engine's rate limiters are bound to the loop it runs
+            results = self.engine.run([self.arun(files)])[0]
+        else:
+            results = asyncio.run(self.arun(files))
+        if self.manifest is not None:
+            print(self.manifest.summary())
+        return results
+
+    async def arun(self, files):
+        """Same as run() from within a running event loop, e.g. a resident service's.
+
+        The engines the extract stage calls must have been started on that loop.
+        """
+        started_at = time.monotonic()
+        if self.manifest is not None:
+            files = self.manifest.pending(files)
+        try:
+            await self.run_stages(files)
+        finally:
+            if self.ocr_executor is not None and self.stats["ocr"]:
+                print(self.ocr_executor.summary())
+            if self.owns_ocr_executor and self.ocr_executor is not None:
+                await asyncio.to_thread(self.ocr_executor.close)
+                self.ocr_executor = None
+        self.print_summary(time.monotonic() - started_at)
+        return self.results
+
+    def read_all(self, files):
+        """Runs the walk and OCR stages only, returns the documents read."""
+        extract, self.extract = self.extract, None
+        try:
+            self.run(files)
+        finally:
+            self.extract = extract
+        return self.documents
+
+    async def run_stages(self, files):
+        ocr_queue = asyncio.Queue(self.queue_size)
+        llm_queue = asyncio.Queue(self.queue_size)
+        write_queue = asyncio.Queue(self.queue_size)
+        ocr_tasks = [
+            asyncio.create_task(self.ocr_stage(ocr_queue, llm_queue))
+            for _ in range(self.ocr_workers)
+        ]
+        llm_concurrency = self.engine.concurrency if self.engine else 1
+        llm_tasks = [
+            asyncio.create_task(self.llm_stage(llm_queue, write_queue))
+            for _ in range(llm_concurrency)
+        ]
+        writer = asyncio.create_task(self.write_stage(write_queue))
+
+        await self.walk_stage(files, ocr_queue)
+        await self.close_stage(ocr_queue, ocr_tasks)
+        await self.close_stage(llm_queue, llm_tasks)
+        await self.close_stage(write_queue, [writer])
+
+    async def close_stage(self, queue, tasks):
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+
+    async def walk_stage(self, files, ocr_queue):
+        # Listing folders blocks, the walker advances in a thread
+        files = iter(files)
+        while True:
+            item = await asyncio.to_thread(next, files, None)
+            if item is None:
+                return
+            self.stats["files"] += 1
+            await ocr_queue.put(item)
+
+    async def ocr_stage(self, ocr_queue, llm_queue):
+        while (item := await ocr_queue.get()) is not None:
+            file_path, email_processing = item
+            started_at = time.monotonic()
+            try:
+                texts = await self.read(file_path)
+            except Exception as e:
+                print(f"Error processing {file_path}: {e}")
+                texts = None
+            self.busy["ocr"] += time.monotonic() - started_at
+            if texts is None:
+                self.stats["skipped"] += 1
+                continue
+            self.stats["read"] += 1
+            raw_text, original_text, export = texts
+            folder_path = os.path.dirname(file_path)
+            output_dir = folder_path
+            if not email_processing and self.documents_output_dir:
+                output_dir = self.documents_output_dir
+            await llm_queue.put(
+                {
+                    "file_path": file_path,
+                    "file_name": os.path.basename(file_path),
+                    "folder_path": folder_path,
+                    "raw_text": raw_text,
+                    "original_text": original_text,
+                    "export": export,
+                    "output_dir": output_dir,
+                    "email_processing": email_processing,
+                }
+            )
+
+    async def read(self, file_path):
+        """Returns (raw_text, original_text, export) for a supported file, or None."""
+        if file_path.endswith(TEXT_EXTENSIONS):
+            return None, await asyncio.to_thread(read_text_file, file_path), None
+        if not file_path.endswith(OCR_EXTENSIONS):
+            return None
+
+        key = None
+        if self.ocr_cache is not None:
+            key = await asyncio.to_thread(ocr_cache_key, file_path)
+            cached = await asyncio.to_thread(self.ocr_cache.get, key)
+            if cached is not None:
+                raw_text, export = cached
+                return self.checked(raw_text, export)
+
+        if self.ocr_executor is None:
+            self.ocr_executor = OCRExecutor(workers=self.ocr_workers)
+        pages = 1
+        if file_path.endswith(".pdf"):
+            pages = await asyncio.to_thread(page_count, file_path)
+        if pages > 1:
+            # The pages of a PDF are spread over every worker in batches, the
+            # text layer is read here and only the pages missing it are OCR'd
+            raw_text, export = await asyncio.to_thread(
+                ocr_document, file_path, self.ocr_executor
+            )
+        else:
+            future = self.ocr_executor.submit_document(file_path)
+            raw_text, export, _ = await asyncio.wrap_future(future)
+        self.stats["ocr"] += 1
+        if key is not None:
+            await asyncio.to_thread(self.ocr_cache.put, key, raw_text, export)
+        return self.checked(raw_text, export)
+
+    def checked(self, raw_text, export):
+        if len(raw_text.strip()) < MIN_TEXT_LENGTH:
+            return None
+        return raw_text, None, export
+
+    async def llm_stage(self, llm_queue, write_queue):
+        while (document := await llm_queue.get()) is not None:
+            if self.extract is None:
+                self.documents.append(document)
+                continue
+            started_at = time.monotonic()
+            try:
+                result = await self.extract(document)
+            except Exception as e:
+                print(f"Error processing {document['file_name']}: {e}")
+                self.record(document, str(e))
+                continue
+            finally:
+                self.busy["llm"] += time.monotonic() - started_at
+            await write_queue.put((document, result))
+
+    async def write_stage(self, write_queue):
+        while (item := await write_queue.get()) is not None:
+            document, result = item
+            started_at = time.monotonic()
+            try:
+                if self.write is not None:
+                    await asyncio.to_thread(self.write, document, result)
+                if self.manifest is not None:
+                    await asyncio.to_thread(self.manifest.record, document["file_path"])
+                self.stats["written"] += 1
+                self.record(document, None)
+            except Exception as e:
+                print(f"Error saving {document['file_name']}: {e}")
+                self.record(document, str(e))
+            self.busy["write"] += time.monotonic() - started_at
+
+    def record(self, document, error):
+        # Only what identifies the document is kept, not its text
+        self.results.append((document["file_name"], document["output_dir"], error))
+
+    def print_summary(self, elapsed):
+        rate = self.stats["read"] / elapsed if elapsed else 0
+        print(
+            f"{self.stats['files']} files, {self.stats['read']} read "
+            f"({self.stats['ocr']} OCR'd, {self.stats['skipped']} skipped), "
+            f"{self.stats['written']} written in {elapsed:.1f}s ({rate:.2f} docs/s). "
+            f"Busy time: OCR {self.busy['ocr']:.1f}s, LLM {self.busy['llm']:.1f}s, "
+            f"writing {self.busy['write']:.1f}s."
+        )
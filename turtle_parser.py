@@ -0,0 +1,262 @@
+import re
+
+# A small Turtle parser, enough for the TTL produced by graph_preprocessing.py:
+# prefixes, prefixed names, IRIs, literals, "a", ";" and "," lists, blank node
+# property lists [ ... ] and collections ( ... )
+
+RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XSD_NS = "http://www.w3.org/2001/XMLSchema#"
+ESCAPES = {
+    "t": "\t",
+    "b": "\b",
+    "n": "\n",
+    "r": "\r",
+    "f": "\f",
+    '"': '"',
+    "'": "'",
+    "\\": "\\",
+}
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+|\#[^\n]*)
+    | (?P<long_string>\"\"\"(?:[^"\\]|\\.|"(?!""))*\"\"\"|'''(?:[^'\\]|\\.|'(?!''))*''')
+    | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+    | (?P<iri><[^<>"{}|^`\\\s]*>)
+    | (?P<directive>@prefix|@base)\b
+    | (?P<language>@[A-Za-z]+(?:-[A-Za-z0-9]+)*)
+    | (?P<datatype>\^\^)
+    | (?P<bnode>_:[\w-]+(?:\.[\w-]+)*)
+    | (?P<number>[+-]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+    | (?P<name>(?:[A-Za-z][\w-]*)?:(?:[^\s;,\[\]()<>"'\#]*[^\s;,.\[\]()<>"'\#])?
+        |[A-Za-z][\w-]*)
+    | (?P<punctuation>[\[\]();,.])
+    """,
+    re.VERBOSE,
+)
+
+
+class TurtleError(ValueError):
+    pass
+
+
+class IRI(str):
+    pass
+
+
+class BNode(str):
+    pass
+
+
+class Literal(str):
+    def __new__(cls, value, datatype=None, language=None):
+        literal = super().__new__(cls, value)
+        literal.datatype = datatype
+        literal.language = language
+        return literal
+
+
+def unescape(text):
+    return re.sub(
+        r"\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)",
+        lambda match: (
+            chr(int(match.group(1)[1:], 16))
+            if match.group(1)[0] in "uU" and len(match.group(1)) > 1
+            else ESCAPES.get(match.group(1), match.group(1))
+        ),
+        text,
+    )
+
+
+def tokenize(text):
+    position = 0
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if match is None:
+            snippet = text[position : position + 20]
+            raise TurtleError(f"Unexpected {snippet!r} at {position}")
+        position = match.end()
+        if match.lastgroup != "space":
+            yield match.lastgroup, match.group(), match.start()
+
+
+class TurtleParser:
+    """Parses a Turtle document into (subject, predicate, object) triples."""
+
+    def __init__(self, text, base=""):
+        self.tokens = list(tokenize(text))
+        self.index = 0
+        self.prefixes = {}
+        self.base = base
+        self.blank_nodes = 0
+        self.triples = []
+
+    def peek(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None, None, -1
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise TurtleError("Unexpected end of document")
+        self.index += 1
+        return token
+
+    def expect(self, value):
+        kind, token, position = self.next()
+        if token != value:
+            raise TurtleError(f"Expected {value!r}, got {token!r} at {position}")
+
+    def new_blank_node(self):
+        self.blank_nodes += 1
+        return BNode(f"_:genid{self.blank_nodes}")
+
+    def __iter__(self):
+        """Yields the triples statement by statement."""
+        while self.peek()[0] is not None:
+            self.statement()
+            yield from self.triples
+            self.triples = []
+
+    def statement(self):
+        kind, token, _ = self.peek()
+        if kind == "directive" or token.upper() in ("PREFIX", "BASE"):
+            self.directive()
+            return
+        if token == "[":
+            subject = self.blank_node_property_list()
+            if self.peek()[1] != ".":
+                self.predicate_object_list(subject)
+        else:
+            subject = self.subject()
+            self.predicate_object_list(subject)
+        self.expect(".")
+
+    def directive(self):
+        kind, token, _ = self.next()
+        keyword = token.lstrip("@").lower()
+        if keyword == "prefix":
+            _, name, position = self.next()
+            if not name.endswith(":"):
+                raise TurtleError(f"Invalid prefix {name!r} at {position}")
+            self.prefixes[name[:-1]] = self.iri(self.next())
+        else:
+            self.base = self.iri(self.next())
+        # SPARQL style PREFIX and BASE have no final dot
+        if kind == "directive":
+            self.expect(".")
+
+    def iri(self, token):
+        kind, value, position = token
+        if kind == "iri":
+            iri = unescape(value[1:-1])
+            return IRI(iri if re.match(r"[A-Za-z][\w+.-]*:", iri) else self.base + iri)
+        if kind == "name" and ":" in value:
+            prefix, local = value.split(":", 1)
+            if prefix not in self.prefixes:
+                raise TurtleError(f"Unknown prefix {prefix!r} at {position}")
+            return IRI(self.prefixes[prefix] + re.sub(r"\\(.)", r"\1", local))
+        raise TurtleError(f"Expected an IRI, got {value!r} at {position}")
+
+    def subject(self):
+        kind, value, _ = self.peek()
+        if kind == "bnode":
+            self.next()
+            return BNode(value)
+        if value == "(":
+            return self.collection()
+        return self.iri(self.next())
+
+    def predicate_object_list(self, subject):
+        while True:
+            kind, value, _ = self.peek()
+            if value == "a":
+                self.next()
+                predicate = IRI(RDF_NS + "type")
+            else:
+                predicate = self.iri(self.next())
+            self.object_list(subject, predicate)
+            # Repeated and trailing semicolons are allowed
+            if self.peek()[1] != ";":
+                return
+            while self.peek()[1] == ";":
+                self.next()
+            if self.peek()[1] in (".", "]", None):
+                return
+
+    def object_list(self, subject, predicate):
+        self.triples.append((subject, predicate, self.object()))
+        while self.peek()[1] == ",":
+            self.next()
+            self.triples.append((subject, predicate, self.object()))
+
+    def object(self):
+        kind, value, position = self.peek()
+        if value == "[":
+            return self.blank_node_property_list()
+        if value == "(":
+            return self.collection()
+        if kind == "bnode":
+            self.next()
+            return BNode(value)
+        if kind in ("string", "long_string"):
+            return self.literal()
+        if kind == "number":
+            self.next()
+            datatype = "decimal" if "." in value else "integer"
+            if "e" in value.lower():
+                datatype = "double"
+            return Literal(value, datatype=IRI(XSD_NS + datatype))
+        if value in ("true", "false"):
+            self.next()
+            return Literal(value, datatype=IRI(XSD_NS + "boolean"))
+        return self.iri(self.next())
+
+    def literal(self):
+        kind, value, _ = self.next()
+        quotes = 3 if kind == "long_string" else 1
+        text = unescape(value[quotes:-quotes])
+        kind, token, _ = self.peek()
+        if kind == "language":
+            self.next()
+            return Literal(text, language=token[1:])
+        if kind == "datatype":
+            self.next()
+            return Literal(text, datatype=self.iri(self.next()))
+        return Literal(text)
+
+    def blank_node_property_list(self):
+        self.expect("[")
+        node = self.new_blank_node()
+        if self.peek()[1] != "]":
+            self.predicate_object_list(node)
+        self.expect("]")
+        return node
+
+    def collection(self):
+        self.expect("(")
+        head = IRI(RDF_NS + "nil")
+        previous = None
+        while self.peek()[1] != ")":
+            node = self.new_blank_node()
+            if previous is None:
+                head = node
+            else:
+                self.triples.append((previous, IRI(RDF_NS + "rest"), node))
+            self.triples.append((node, IRI(RDF_NS + "first"), self.object()))
+            previous = node
+        self.expect(")")
+        if previous is not None:
+            self.triples.append((previous, IRI(RDF_NS + "rest"), IRI(RDF_NS + "nil")))
+        return head
+
+
+def parse(text, base=""):
+    """Returns the triples of a Turtle document."""
+    return list(TurtleParser(text, base))
+
+
+def local_name(iri):
+    """Returns the part of an IRI after its last "/" or "#"."""
+    return re.split(r"[/#]", iri)[-1]